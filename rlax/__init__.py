@@ -33,11 +33,16 @@ from rlax._src.distributions import multivariate_normal_kl_divergence
 from rlax._src.distributions import softmax
 from rlax._src.distributions import squashed_gaussian
 from rlax._src.embedding import embed_oar
+from rlax._src.episodic_memory import ivf_index_add
+from rlax._src.episodic_memory import ivf_index_init
+from rlax._src.episodic_memory import ivf_knn_query
+from rlax._src.episodic_memory import kmeans_centroids
 from rlax._src.episodic_memory import knn_query
 from rlax._src.exploration import add_dirichlet_noise
 from rlax._src.exploration import add_gaussian_noise
 from rlax._src.exploration import add_ornstein_uhlenbeck_noise
 from rlax._src.exploration import episodic_memory_intrinsic_rewards
+from rlax._src.exploration import EpisodicMemory
 from rlax._src.general_value_functions import feature_control_rewards
 from rlax._src.general_value_functions import pixel_control_rewards
 from rlax._src.interruptions import fix_step_type_on_interruptions
@@ -57,12 +62,17 @@ from rlax._src.mpo_ops import mpo_compute_weights_and_temperature_loss
 from rlax._src.mpo_ops import mpo_loss
 from rlax._src.mpo_ops import vmpo_compute_weights_and_temperature_loss
 from rlax._src.mpo_ops import vmpo_loss
+from rlax._src.multistep import chunked_lambda_returns
+from rlax._src.multistep import chunked_truncated_generalized_advantage_estimation
 from rlax._src.multistep import discounted_returns
 from rlax._src.multistep import general_off_policy_returns_from_action_values
 from rlax._src.multistep import general_off_policy_returns_from_q_and_v
 from rlax._src.multistep import lambda_returns
+from rlax._src.multistep import lambda_returns_bank
 from rlax._src.multistep import n_step_bootstrapped_returns
+from rlax._src.multistep import time_sharded_lambda_returns
 from rlax._src.multistep import truncated_generalized_advantage_estimation
+from rlax._src.multistep import truncated_generalized_advantage_estimation_and_targets
 from rlax._src.nested_updates import conditional_update
 from rlax._src.nested_updates import periodic_update
 from rlax._src.nonlinear_bellman import compose_tx
@@ -78,6 +88,7 @@ from rlax._src.nonlinear_bellman import transformed_n_step_q_learning
 from rlax._src.nonlinear_bellman import transformed_n_step_returns
 from rlax._src.nonlinear_bellman import transformed_q_lambda
 from rlax._src.nonlinear_bellman import transformed_retrace
+from rlax._src.nonlinear_bellman import transformed_retrace_sparse
 from rlax._src.nonlinear_bellman import twohot_pair
 from rlax._src.nonlinear_bellman import TxPair
 from rlax._src.nonlinear_bellman import unbiased_transform_pair
@@ -107,8 +118,11 @@ from rlax._src.transforms import signed_expm1
 from rlax._src.transforms import signed_hyperbolic
 from rlax._src.transforms import signed_logp1
 from rlax._src.transforms import signed_parabolic
+from rlax._src.transforms import sparse_2hot_cross_entropy
 from rlax._src.transforms import transform_from_2hot
 from rlax._src.transforms import transform_to_2hot
+from rlax._src.transforms import transform_to_2hot_sparse
+from rlax._src.transforms import twohot_cross_entropy
 from rlax._src.tree_util import transpose_first_axis_to_last
 from rlax._src.tree_util import transpose_last_axis_to_first
 from rlax._src.tree_util import tree_fn
@@ -122,7 +136,11 @@ from rlax._src.value_learning import categorical_l2_project
 from rlax._src.value_learning import categorical_q_learning
 from rlax._src.value_learning import categorical_td_learning
 from rlax._src.value_learning import double_q_learning
+from rlax._src.value_learning import ensemble_double_q_learning
+from rlax._src.value_learning import ensemble_q_learning
+from rlax._src.value_learning import ensemble_statistics
 from rlax._src.value_learning import expected_sarsa
+from rlax._src.value_learning import expected_sarsa_sparse
 from rlax._src.value_learning import persistent_q_learning
 from rlax._src.value_learning import q_lambda
 from rlax._src.value_learning import q_learning
@@ -133,12 +151,17 @@ from rlax._src.value_learning import qv_learning
 from rlax._src.value_learning import qv_max
 from rlax._src.value_learning import retrace
 from rlax._src.value_learning import retrace_continuous
+from rlax._src.value_learning import retrace_sparse
 from rlax._src.value_learning import sarsa
 from rlax._src.value_learning import sarsa_lambda
 from rlax._src.value_learning import td_lambda
 from rlax._src.value_learning import td_learning
+from rlax._src.vtrace import chunked_vtrace
+from rlax._src.vtrace import impala_loss
 from rlax._src.vtrace import leaky_vtrace
 from rlax._src.vtrace import leaky_vtrace_td_error_and_advantage
+from rlax._src.vtrace import popart_vtrace_td_error_and_advantage
+from rlax._src.vtrace import time_sharded_vtrace
 from rlax._src.vtrace import vtrace
 from rlax._src.vtrace import vtrace_td_error_and_advantage
 
@@ -157,6 +180,9 @@ __all__ = (
     "categorical_l2_project",
     "categorical_q_learning",
     "categorical_td_learning",
+    "chunked_lambda_returns",
+    "chunked_truncated_generalized_advantage_estimation",
+    "chunked_vtrace",
     "clip_gradient",
     "clipped_surrogate_pg_loss",
     "compose_tx",
@@ -169,16 +195,30 @@ __all__ = (
     "dpg_loss",
     "EmaMoments",
     "EmaState",
+    "ensemble_double_q_learning",
+    "ensemble_q_learning",
+    "ensemble_statistics",
     "entropy_loss",
     "episodic_memory_intrinsic_rewards",
+    "EpisodicMemory",
     "epsilon_greedy",
     "expected_sarsa",
+    "expected_sarsa_sparse",
     "expectile_loss",
     "extract_subsequences",
     "feature_control_rewards",
     "fix_step_type_on_interruptions",
     "gaussian_diagonal",
     "HYPERBOLIC_SIN_PAIR",
+    "impala_loss",
+    "ivf_index_add",
+    "ivf_index_init",
+    "ivf_knn_query",
+    "kmeans_centroids",
+    "lambda_returns_bank",
+    "popart_vtrace_td_error_and_advantage",
+    "retrace_sparse",
+    "sparse_2hot_cross_entropy",
     "squashed_gaussian",
     "clipped_entropy_softmax",
     "art",
@@ -242,6 +282,9 @@ __all__ = (
     "softmax",
     "td_lambda",
     "td_learning",
+    "time_sharded_lambda_returns",
+    "time_sharded_vtrace",
+    "transform_to_2hot_sparse",
     "transformed_general_off_policy_returns_from_action_values",
     "transformed_lambda_returns",
     "transformed_n_step_q_learning",
@@ -250,6 +293,7 @@ __all__ = (
     "transformed_retrace",
     "transform_from_2hot",
     "transform_to_2hot",
+    "transformed_retrace_sparse",
     "transpose_last_axis_to_first",
     "transpose_first_axis_to_last",
     "tree_fn",
@@ -259,6 +303,8 @@ __all__ = (
     "tree_split_key",
     "tree_split_leaves",
     "truncated_generalized_advantage_estimation",
+    "truncated_generalized_advantage_estimation_and_targets",
+    "twohot_cross_entropy",
     "twohot_pair",
     "TxPair",
     "unbiased_transform_pair",
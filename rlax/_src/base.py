@@ -14,7 +14,7 @@
 # ==============================================================================
 """Common utilities for RLax functions."""
 
-from typing import Optional, Sequence, Union
+from typing import Callable, Optional, Sequence, Tuple, Union
 import chex
 import jax
 import jax.numpy as jnp
@@ -94,6 +94,183 @@ def replace_masked(
   return jnp.where(lhs_broadcast(mask, data), replacement, data)
 
 
+def compose_affine(
+    earlier: Tuple[Array, Array],
+    later: Tuple[Array, Array],
+) -> Tuple[Array, Array]:
+  """Composes two affine maps xₜ = b + a xₜ₊₁, applying `later` first."""
+  a_earlier, b_earlier = earlier
+  a_later, b_later = later
+  return a_earlier * a_later, b_earlier + a_earlier * b_later
+
+
+def _linear_scan(
+    a_t: Array, b_t: Array, x_init: Array, reverse: bool) -> Array:
+  """Unrolls xₜ = bₜ + aₜ xₜ₋₁ (or xₜ₊₁ if `reverse`) with a sequential scan."""
+  def _body(acc, xs):
+    a, b = xs
+    acc = b + a * acc
+    return acc, acc
+
+  _, x_t = jax.lax.scan(_body, x_init, (a_t, b_t), reverse=reverse)
+  return x_t
+
+
+@jax.custom_jvp
+def _reverse_linear_scan(a_t: Array, b_t: Array, x_bootstrap: Array) -> Array:
+  return _linear_scan(a_t, b_t, x_bootstrap, reverse=True)
+
+
+@_reverse_linear_scan.defjvp
+def _reverse_linear_scan_jvp(primals, tangents):
+  """Expresses the tangents as a linear recurrence with the same coefficients.
+
+  Differentiating xₜ = bₜ + aₜ xₜ₊₁ gives dxₜ = (dbₜ + daₜ xₜ₊₁) + aₜ dxₜ₊₁.
+  This is linear in the tangents, so reverse mode only needs to transpose it
+  into a forward recurrence in time, whose only residuals are the coefficients
+  aₜ and the outputs xₜ, rather than the intermediate values of every step.
+
+  Args:
+    primals: the coefficients aₜ, additive terms bₜ and the bootstrap value.
+    tangents: the corresponding tangents.
+
+  Returns:
+    The solution of the recurrence and its tangent.
+  """
+  a_t, b_t, x_bootstrap = primals
+  da_t, db_t, dx_bootstrap = tangents
+  x_t = _reverse_linear_scan(a_t, b_t, x_bootstrap)
+  x_tp1 = jnp.concatenate([x_t[1:], x_bootstrap[None]], axis=0)
+  dx_t = _linear_scan(a_t, db_t + da_t * x_tp1, dx_bootstrap, reverse=True)
+  return x_t, dx_t
+
+
+def reverse_linear_recurrence(
+    a_t: Array,
+    b_t: Array,
+    x_bootstrap: Array,
+    method: str = "scan",
+) -> Array:
+  """Solves the affine recurrence xₜ = bₜ + aₜ xₜ₊₁ backwards in time.
+
+  With `method='scan'` the recurrence is unrolled sequentially, from `x_{T-1}`
+  to `x_0`. With `method='associative'` each step is treated as an affine map
+  and the maps are composed with a parallel prefix scan, in `O(log T)` depth.
+  Any trailing dimensions of the inputs are treated as batch dimensions.
+
+  The sequential scan has a custom derivative rule: gradients are computed by a
+  second linear recurrence, which does not store the per-step intermediate
+  values of the forward pass.
+
+  Args:
+    a_t: multiplicative coefficients aₜ for timesteps t in [0, T-1].
+    b_t: additive terms bₜ for timesteps t in [0, T-1].
+    x_bootstrap: value of the recurrence at time T, used to bootstrap.
+    method: either 'scan' or 'associative'.
+
+  Returns:
+    The sequence xₜ for timesteps t in [0, T-1].
+  """
+  if method == "scan":
+    x_bootstrap = jnp.broadcast_to(x_bootstrap, b_t.shape[1:]).astype(b_t.dtype)
+    return _reverse_linear_scan(a_t, b_t, x_bootstrap)
+  elif method == "associative":
+    # Fold the bootstrap value into the last step, so that composing the affine
+    # maps of any suffix of the sequence directly yields the solution.
+    b_t = jnp.concatenate(
+        [b_t[:-1], b_t[-1:] + a_t[-1:] * x_bootstrap], axis=0)
+    _, x_t = jax.lax.associative_scan(
+        lambda later, earlier: compose_affine(earlier, later),
+        (a_t, b_t), reverse=True)
+    return x_t
+  else:
+    raise ValueError(f"Unknown method {method}")
+
+
+def carry_from_following_shards(
+    a_t: Array,
+    x_first: Array,
+    x_bootstrap: Array,
+    axis_name: str,
+) -> Array:
+  """Computes the carry into one time shard of a reverse linear recurrence.
+
+  When the time dimension of xₜ = bₜ + aₜ xₜ₊₁ is split in consecutive shards
+  along `axis_name`, each shard maps the carry it receives from the following
+  shard to its own first value as `x_first + prod(a_t) * carry`. Gathering these
+  affine summaries, the carry into every shard is obtained by running the same
+  recurrence over shards, from the last to the first.
+
+  Args:
+    a_t: the multiplicative coefficients aₜ of the local shard.
+    x_first: first value of the local recurrence, computed from a zero carry.
+    x_bootstrap: bootstrap value of the recurrence; only the value held by the
+      last shard is used.
+    axis_name: name of the mapped axis over which time is sharded.
+
+  Returns:
+    The value of the recurrence at the first timestep of the following shard, or
+    the bootstrap value for the last shard.
+  """
+  a_shards = jax.lax.all_gather(jnp.prod(a_t, axis=0), axis_name)
+  b_shards = jax.lax.all_gather(x_first, axis_name)
+  x_bootstrap = jax.lax.all_gather(x_bootstrap, axis_name)[-1]
+  x_shards = reverse_linear_recurrence(a_shards, b_shards, x_bootstrap)
+  carries = jnp.concatenate([x_shards[1:], x_bootstrap[None]], axis=0)
+  return carries[jax.lax.axis_index(axis_name)]
+
+
+def segment_continuation_mask(segment_ids: Array, dtype=jnp.float32) -> Array:
+  """Marks the timesteps whose successor belongs to the same segment.
+
+  Several episodes can be packed end to end along the leading (time) dimension
+  of one sequence, with `segment_ids` identifying the episode of each timestep.
+  Multiplying the trace coefficient of a reverse recurrence by this mask resets
+  the recurrence at every boundary between segments.
+
+  Args:
+    segment_ids: integer ids of the segment each timestep belongs to, with time
+      as the leading dimension.
+    dtype: dtype of the returned mask.
+
+  Returns:
+    A mask with the shape of `segment_ids`, which is 1 where the next timestep
+    has the same segment id, and 0 at the last timestep of each segment.
+  """
+  continues = segment_ids[1:] == segment_ids[:-1]
+  continues = jnp.concatenate(
+      [continues, jnp.zeros_like(continues[:1])], axis=0)
+  return continues.astype(dtype)
+
+
+def sparse_probs_of_actions(
+    pi_indices: Array, pi_probs: Array, actions: Array) -> Array:
+  """Returns the probabilities of `actions` under a sparse policy.
+
+  The policy is given by the indices `pi_indices` of the actions it supports,
+  along the last axis, and their probabilities `pi_probs`.
+  """
+  selected = pi_indices == actions[..., None]
+  return jnp.sum(jnp.where(selected, pi_probs, jnp.zeros_like(pi_probs)), -1)
+
+
+def sparse_expectation(
+    pi_indices: Array,
+    pi_probs: Array,
+    values: Array,
+    value_fn: Optional[Callable[[Array], Array]] = None,
+) -> Array:
+  """Returns the expectation of dense `values` under a sparse policy.
+
+  If given, `value_fn` is applied elementwise to the values of the supported
+  actions only, before taking the expectation.
+  """
+  values = jnp.take_along_axis(values, pi_indices, axis=-1)
+  if value_fn is not None:
+    values = value_fn(values)
+  return jnp.sum(pi_probs * values, axis=-1)
+
+
 class AllSum:
   """Helper for summing over elements in an array and over devices."""
 
@@ -59,6 +59,56 @@ class BroadcastTest(parameterized.TestCase):
       base.lhs_broadcast(source, target)
 
 
+class ReverseLinearRecurrenceTest(parameterized.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    rng = np.random.RandomState(0)
+    self.a_t = rng.uniform(size=(11, 3)).astype(np.float32)
+    self.b_t = rng.normal(size=(11, 3)).astype(np.float32)
+    self.x_bootstrap = rng.normal(size=(3,)).astype(np.float32)
+
+  def _unrolled(self, a_t, b_t, x_bootstrap):
+    x_t = []
+    x = x_bootstrap
+    for a, b in zip(a_t[::-1], b_t[::-1]):
+      x = b + a * x
+      x_t.append(x)
+    return jnp.stack(x_t[::-1])
+
+  @parameterized.parameters('scan', 'associative')
+  def test_values(self, method):
+    expected = self._unrolled(self.a_t, self.b_t, self.x_bootstrap)
+    actual = jax.jit(base.reverse_linear_recurrence, static_argnums=3)(
+        self.a_t, self.b_t, self.x_bootstrap, method)
+    np.testing.assert_allclose(expected, actual, rtol=1e-5, atol=1e-6)
+
+  @parameterized.parameters('scan', 'associative')
+  def test_gradients(self, method):
+    cotangent = np.random.RandomState(1).normal(size=self.b_t.shape)
+    loss = lambda f: lambda *args: jnp.sum(cotangent * f(*args))
+    expected = jax.grad(loss(self._unrolled), argnums=(0, 1, 2))(
+        self.a_t, self.b_t, self.x_bootstrap)
+    actual = jax.grad(loss(lambda *args: base.reverse_linear_recurrence(
+        *args, method=method)), argnums=(0, 1, 2))(
+            self.a_t, self.b_t, self.x_bootstrap)
+    for x, y in zip(expected, actual):
+      np.testing.assert_allclose(x, y, rtol=1e-5, atol=1e-5)
+
+  def test_forward_mode_gradients(self):
+    tangents = (np.ones_like(self.a_t), np.ones_like(self.b_t),
+                np.ones_like(self.x_bootstrap))
+    args = (self.a_t, self.b_t, self.x_bootstrap)
+    _, expected = jax.jvp(self._unrolled, args, tangents)
+    _, actual = jax.jvp(base.reverse_linear_recurrence, args, tangents)
+    np.testing.assert_allclose(expected, actual, rtol=1e-5, atol=1e-5)
+
+  def test_unknown_method_raises(self):
+    with self.assertRaisesRegex(ValueError, 'Unknown method'):
+      base.reverse_linear_recurrence(
+          self.a_t, self.b_t, self.x_bootstrap, method='unknown')
+
+
 class ReplaceTest(parameterized.TestCase):
 
   def setUp(self):
@@ -22,6 +22,7 @@ to compute statistics such as its entropy.
 """
 
 import collections
+from typing import Optional
 import warnings
 
 import chex
@@ -108,48 +109,99 @@ def clipped_entropy_softmax(temperature=1., entropy_clip=1.):
                               kl_fn)
 
 
+def _masked_greedy_probs(preferences: Array, legal_actions_mask: Array):
+  """Greedy probs, with ties broken uniformly, over the legal actions only."""
+  max_preference = jnp.max(preferences, axis=-1, keepdims=True,
+                           where=legal_actions_mask, initial=-jnp.inf)
+  optimal_actions = (preferences == max_preference) & legal_actions_mask
+  return optimal_actions / optimal_actions.sum(axis=-1, keepdims=True)
+
+
+def _greedy(preferences: Array, legal_actions_mask: Optional[Array]):
+  """Returns a greedy distribution restricted to the legal actions."""
+  if legal_actions_mask is None:
+    return distrax.Greedy(preferences)
+  chex.assert_equal_shape([preferences, legal_actions_mask])
+  return distrax.Categorical(
+      probs=_masked_greedy_probs(preferences, legal_actions_mask))
+
+
+def _epsilon_greedy(
+    preferences: Array, epsilon: Numeric, legal_actions_mask: Optional[Array]):
+  """Returns an epsilon-greedy distribution restricted to the legal actions.
+
+  With a mask, the exploratory mass ε is spread uniformly over the legal
+  actions only, so that illegal actions are never sampled.
+  """
+  if legal_actions_mask is None:
+    return distrax.EpsilonGreedy(preferences, epsilon)
+  chex.assert_equal_shape([preferences, legal_actions_mask])
+  greedy_probs = _masked_greedy_probs(preferences, legal_actions_mask)
+  uniform_probs = legal_actions_mask / legal_actions_mask.sum(
+      axis=-1, keepdims=True)
+  return distrax.Categorical(
+      probs=(1 - epsilon) * greedy_probs + epsilon * uniform_probs)
+
+
 def greedy():
-  """A greedy distribution."""
+  """A greedy distribution.
+
+  All functions accept an optional boolean `legal_actions_mask`, with the same
+  shape as the preferences, restricting the distribution to the legal actions.
+  """
   warnings.warn(
       "Rlax greedy will be deprecated. "
       "Please use distrax.Greedy instead.",
       PendingDeprecationWarning, stacklevel=2
   )
-  def sample_fn(key: Array, preferences: Array):
-    return distrax.Greedy(preferences).sample(seed=key)
+  def sample_fn(key: Array, preferences: Array,
+                legal_actions_mask: Optional[Array] = None):
+    return _greedy(preferences, legal_actions_mask).sample(seed=key)
 
-  def probs_fn(preferences: Array):
-    return distrax.Greedy(preferences).probs
+  def probs_fn(preferences: Array, legal_actions_mask: Optional[Array] = None):
+    return _greedy(preferences, legal_actions_mask).probs
 
-  def log_prob_fn(sample: Array, preferences: Array):
-    return distrax.Greedy(preferences).log_prob(sample)
+  def log_prob_fn(sample: Array, preferences: Array,
+                  legal_actions_mask: Optional[Array] = None):
+    return _greedy(preferences, legal_actions_mask).log_prob(sample)
 
-  def entropy_fn(preferences: Array):
-    return distrax.Greedy(preferences).entropy()
+  def entropy_fn(preferences: Array,
+                 legal_actions_mask: Optional[Array] = None):
+    return _greedy(preferences, legal_actions_mask).entropy()
 
   return DiscreteDistribution(sample_fn, probs_fn, log_prob_fn, entropy_fn,
                               None)
 
 
 def epsilon_greedy(epsilon=None):
-  """An epsilon-greedy distribution."""
+  """An epsilon-greedy distribution.
+
+  All functions accept an optional boolean `legal_actions_mask`, with the same
+  shape as the preferences; exploration is then uniform over legal actions.
+  """
 
   warnings.warn(
       "Rlax epsilon_greedy will be deprecated. "
       "Please use distrax.EpsilonGreedy instead.",
       PendingDeprecationWarning, stacklevel=2
   )
-  def sample_fn(key: Array, preferences: Array, epsilon=epsilon):
-    return distrax.EpsilonGreedy(preferences, epsilon).sample(seed=key)
-
-  def probs_fn(preferences: Array, epsilon=epsilon):
-    return distrax.EpsilonGreedy(preferences, epsilon).probs
-
-  def logprob_fn(sample: Array, preferences: Array, epsilon=epsilon):
-    return distrax.EpsilonGreedy(preferences, epsilon).log_prob(sample)
-
-  def entropy_fn(preferences: Array, epsilon=epsilon):
-    return distrax.EpsilonGreedy(preferences, epsilon).entropy()
+  def sample_fn(key: Array, preferences: Array, epsilon=epsilon,
+                legal_actions_mask: Optional[Array] = None):
+    return _epsilon_greedy(
+        preferences, epsilon, legal_actions_mask).sample(seed=key)
+
+  def probs_fn(preferences: Array, epsilon=epsilon,
+               legal_actions_mask: Optional[Array] = None):
+    return _epsilon_greedy(preferences, epsilon, legal_actions_mask).probs
+
+  def logprob_fn(sample: Array, preferences: Array, epsilon=epsilon,
+                 legal_actions_mask: Optional[Array] = None):
+    return _epsilon_greedy(
+        preferences, epsilon, legal_actions_mask).log_prob(sample)
+
+  def entropy_fn(preferences: Array, epsilon=epsilon,
+                 legal_actions_mask: Optional[Array] = None):
+    return _epsilon_greedy(preferences, epsilon, legal_actions_mask).entropy()
 
   return DiscreteDistribution(sample_fn, probs_fn, logprob_fn, entropy_fn, None)
 
@@ -241,6 +241,16 @@ class GreedyTest(parameterized.TestCase):
     actual = entropy_fn(self.preferences)
     np.testing.assert_allclose(self.expected_entropy, actual, atol=1e-4)
 
+  @chex.all_variants()
+  def test_greedy_legal_actions_mask(self):
+    """Tests the greedy action is the best legal one."""
+    distrib = distributions.greedy()
+    probs_fn = self.variant(distrib.probs)
+    legal_actions_mask = np.array([[False, True, True], [True, False, True]])
+    actual = probs_fn(self.preferences, legal_actions_mask=legal_actions_mask)
+    np.testing.assert_allclose(
+        np.array([[0., 1., 0.], [1., 0., 0.]]), actual, atol=1e-4)
+
 
 class EpsilonGreedyTest(parameterized.TestCase):
 
@@ -319,6 +329,31 @@ class EpsilonGreedyTest(parameterized.TestCase):
     actual = entropy_fn(self.preferences)
     np.testing.assert_allclose(self.expected_entropy, actual, atol=1e-4)
 
+  @chex.all_variants()
+  def test_greedy_legal_actions_mask_probs(self):
+    """Tests exploration is uniform over the legal actions only."""
+    distrib = distributions.epsilon_greedy(self.epsilon)
+    probs_fn = self.variant(distrib.probs)
+    legal_actions_mask = np.array(
+        [[False, True, True, True], [True, False, True, False]])
+    actual = probs_fn(self.preferences, legal_actions_mask=legal_actions_mask)
+    expected = np.array(
+        [[0., 0.8 + 0.2 / 3, 0.2 / 3, 0.2 / 3], [0.9, 0., 0.1, 0.]])
+    np.testing.assert_allclose(expected, actual, atol=1e-4)
+
+  @chex.all_variants()
+  def test_greedy_legal_actions_mask_sample(self):
+    """Tests illegal actions are never sampled, even when exploring."""
+    distrib = distributions.epsilon_greedy(epsilon=1.)
+    sample_fn = self.variant(distrib.sample)
+    legal_actions_mask = np.array(
+        [[False, True, False, True], [True, False, True, False]])
+    samples = np.stack([
+        sample_fn(key, self.preferences, legal_actions_mask=legal_actions_mask)
+        for key in jax.random.split(jax.random.PRNGKey(0), 16)])
+    np.testing.assert_array_equal(
+        np.take_along_axis(legal_actions_mask, samples.T, axis=-1), True)
+
 
 class GaussianDiagonalTest(parameterized.TestCase):
 
@@ -20,13 +20,14 @@ functions for querying episodic memory.
 """
 
 import functools
-from typing import Callable
+from typing import Callable, Optional, Tuple, Union
 
 import chex
 import jax
 import jax.numpy as jnp
 
 Array = chex.Array
+Numeric = chex.Numeric
 MetricFn = Callable[[Array, Array], Array]
 
 
@@ -46,24 +47,129 @@ def _cdist(a: Array, b: Array, metric: MetricFn) -> Array:
   return jax.vmap(jax.vmap(metric, (None, 0)), (0, None))(a, b)
 
 
+def _matmul_cdist(a: Array, b: Array, metric: str) -> Array:
+  """Returns pairwise distances of a named metric, using a single matmul.
+
+  Squared euclidean distances are expanded as ‖a‖² − 2a·b + ‖b‖², and cosine
+  distances as 1 − â·b̂ on the normalized inputs, so that no tensor of shape
+  `[len(a), len(b), feature size]` is materialized.
+
+  Args:
+    a: first collection of inputs (num a x feature size).
+    b: second collection of inputs (num b x feature size).
+    metric: either 'sqeuclidean' or 'cosine'.
+
+  Returns:
+    Distances of shape (num a x num b).
+  """
+  dot = functools.partial(
+      jnp.matmul, precision=jax.lax.Precision.HIGHEST)
+  a_sq_norms = jnp.sum(jnp.square(a), axis=-1, keepdims=True)
+  b_sq_norms = jnp.sum(jnp.square(b), axis=-1, keepdims=True)
+  if metric == 'sqeuclidean':
+    distances = a_sq_norms - 2 * dot(a, b.T) + b_sq_norms.T
+    # Cancellation can make the distance of near-identical points negative.
+    distances = jnp.maximum(distances, 0.)
+  elif metric == 'cosine':
+    a_normalized = a / jnp.maximum(jnp.sqrt(a_sq_norms), 1e-12)
+    b_normalized = b / jnp.maximum(jnp.sqrt(b_sq_norms), 1e-12)
+    distances = 1. - dot(a_normalized, b_normalized.T)
+  else:
+    raise ValueError(f'Unknown metric {metric}')
+  # Points with non-finite features, such as the `inf` entries of an unfilled
+  # memory, are infinitely far from any other point.
+  is_finite = jnp.isfinite(a_sq_norms) & jnp.isfinite(b_sq_norms.T)
+  return jnp.where(is_finite, distances, jnp.inf)
+
+
+def _neg_distances(
+    query_points: Array, data: Array, metric: Union[str, MetricFn]) -> Array:
+  """Returns the neg distances between each query point and data point."""
+  if isinstance(metric, str):
+    return -_matmul_cdist(query_points, data, metric)
+  return -_cdist(query_points, data, metric)
+
+
+def _chunked_top_k(
+    data: Array,
+    query_points: Array,
+    k: int,
+    metric: Union[str, MetricFn],
+    chunk_size: int,
+    num_valid: Numeric,
+) -> Tuple[Array, Array]:
+  """Streams over chunks of the data, merging each into a running top-k.
+
+  Chunks past the first `num_valid` elements of the data are skipped.
+  """
+  num_data, feature_size = data.shape
+  num_chunks = -(-num_data // chunk_size)
+  padding = num_chunks * chunk_size - num_data
+  chunks = jnp.pad(data, ((0, padding), (0, 0))).reshape(
+      num_chunks, chunk_size, feature_size)
+  offsets = jnp.arange(num_chunks) * chunk_size
+
+  def merge_chunk(carry, chunk, offset):
+    top_neg_distances, top_indices = carry
+    indices = offset + jnp.arange(chunk_size)
+    neg_distances = _neg_distances(query_points, chunk, metric)
+    neg_distances = jnp.where(indices < num_valid, neg_distances, -jnp.inf)
+    # Running results come first, so ties keep resolving to lower indices.
+    neg_distances = jnp.concatenate([top_neg_distances, neg_distances], -1)
+    indices = jnp.concatenate(
+        [top_indices, jnp.broadcast_to(indices, neg_distances.shape[:1] +
+                                       indices.shape)], -1)
+    top_neg_distances, positions = jax.lax.top_k(neg_distances, k)
+    top_indices = jnp.take_along_axis(indices, positions, axis=-1)
+    return top_neg_distances, top_indices
+
+  def scan_step(carry, xs):
+    chunk, offset = xs
+    carry = jax.lax.cond(
+        offset < num_valid,
+        lambda carry: merge_chunk(carry, chunk, offset),
+        lambda carry: carry,
+        carry)
+    return carry, None
+
+  num_queries = query_points.shape[0]
+  init = (jnp.full((num_queries, k), -jnp.inf, dtype=query_points.dtype),
+          jnp.zeros((num_queries, k), dtype=jnp.int32))
+  (neg_distances, indices), _ = jax.lax.scan(
+      scan_step, init, (chunks, offsets))
+  return neg_distances, indices
+
+
 def knn_query(
     data: Array,
     query_points: Array,
     num_neighbors: int,
-    metric: MetricFn = _sqeuclidian,
+    metric: Union[str, MetricFn] = _sqeuclidian,
+    chunk_size: Optional[int] = None,
+    num_valid: Optional[Numeric] = None,
 ) -> KNNQueryResult:
   """Finds closest neighbors in data to the query points & their neg distances.
 
   NOTE: For this function to be jittable, static_argnums=[2,] must be passed, as
   the internal jax.lax.top_k(neg_distances, num_neighbors) computation cannot be
-  jitted with a dynamic num_neighbors that is passed as an argument.
+  jitted with a dynamic num_neighbors that is passed as an argument. The same
+  holds for `metric` and `chunk_size` when they are passed.
 
   Args:
     data: array of existing data points (elements in database x feature size)
     query_points: array of points to find neighbors of
         (num query points x feature size).
     num_neighbors: number of neighbors to find.
-    metric: Metric to use in calculating distance between two points.
+    metric: Metric to use in calculating distance between two points; either
+      'sqeuclidean' or 'cosine', whose distances are computed for all pairs at
+      once with a matmul, or a function computing the distance of two points,
+      such as the default squared euclidean distance.
+    chunk_size: if set, the data is processed in chunks of this many elements,
+      merging the neighbors found in each chunk into a running top-k. This
+      bounds the peak memory to `num query points x chunk_size` distances.
+    num_valid: if set, only the first `num_valid` elements of the data are
+      searched, e.g. the filled slots of a memory, and chunks past them are
+      skipped. Neighbors beyond the valid elements have -inf neg distances.
 
   Returns:
     KNNQueryResult with (all sorted by neg distance):
@@ -75,11 +181,243 @@ def knn_query(
   """
   chex.assert_rank([data, query_points], 2)
   assert data.shape[-1] == query_points.shape[-1]
-  distance_fn = jax.jit(functools.partial(_cdist, metric=metric))
-  neg_distances = -distance_fn(query_points, data)
-  neg_distances, indices = jax.lax.top_k(
-      neg_distances, k=min(num_neighbors, data.shape[0]))
+  data = jnp.asarray(data)
+  k = min(num_neighbors, data.shape[0])
+  if chunk_size is None or chunk_size >= data.shape[0]:
+    neg_distances = _neg_distances(query_points, data, metric)
+    if num_valid is not None:
+      neg_distances = jnp.where(
+          jnp.arange(data.shape[0]) < num_valid, neg_distances, -jnp.inf)
+    neg_distances, indices = jax.lax.top_k(neg_distances, k=k)
+  else:
+    neg_distances, indices = _chunked_top_k(
+        data, query_points, k, metric, chunk_size,
+        data.shape[0] if num_valid is None else num_valid)
   # Batch index into data using indices shaped [num queries, num neighbors]
-  neighbors = jax.vmap(lambda d, i: d[i], (None, 0))(jnp.array(data), indices)
+  neighbors = jax.vmap(lambda d, i: d[i], (None, 0))(data, indices)
   return KNNQueryResult(neighbors=neighbors, neighbor_indices=indices,
                         neighbor_neg_distances=neg_distances)
+
+
+@chex.dataclass
+class IVFIndex():
+  """An inverted file index for approximate nearest neighbor search.
+
+  Data points are partitioned by their closest coarse centroid, each partition
+  being stored in an inverted list of fixed capacity. When a list is full, its
+  oldest points are overwritten, as in a ring buffer.
+
+  Attributes:
+    centroids: coarse centroids (num lists x feature size).
+    vectors: points in each list (num lists x list capacity x feature size).
+    sq_norms: squared norms of the points in each list
+      (num lists x list capacity).
+    ids: id of the points in each list (num lists x list capacity), that is the
+      number of points added to the index before them, or -1 for empty slots.
+    list_sizes: number of points ever added to each list (num lists).
+    num_added: number of points ever added to the index.
+  """
+  centroids: jnp.ndarray
+  vectors: jnp.ndarray
+  sq_norms: jnp.ndarray
+  ids: jnp.ndarray
+  list_sizes: jnp.ndarray
+  num_added: jnp.ndarray
+
+
+def kmeans_centroids(
+    key: chex.PRNGKey,
+    data: Array,
+    num_centroids: int,
+    num_iterations: int = 10,
+) -> Array:
+  """Fits coarse centroids for an `IVFIndex` with Lloyd's k-means algorithm.
+
+  NOTE: For this function to be jittable, static_argnums=[2, 3] must be passed.
+
+  Args:
+    key: random key used to pick the initial centroids among the data, with
+      the k-means++ seeding of Arthur & Vassilvitskii.
+    data: finite data points (elements in database x feature size), with at
+      least `num_centroids` elements.
+    num_centroids: number of centroids, i.e. of inverted lists.
+    num_iterations: number of k-means iterations.
+
+  Returns:
+    Centroids (num centroids x feature size).
+  """
+  chex.assert_rank(data, 2)
+  data = jnp.asarray(data)
+  first_key, key = jax.random.split(key)
+  sq_norms = jnp.sum(jnp.square(data), axis=-1)
+
+  def sq_distances_to(point):
+    dots = jnp.dot(data, point, precision=jax.lax.Precision.HIGHEST)
+    return jnp.maximum(sq_norms - 2 * dots + jnp.sum(jnp.square(point)), 0.)
+
+  # Pick the initial centroids with k-means++: each is sampled among the data
+  # with probability proportional to its squared distance to the closest one.
+  def init_step(min_sq_distances, step_key):
+    point = data[jax.random.categorical(step_key, jnp.log(min_sq_distances))]
+    return jnp.minimum(min_sq_distances, sq_distances_to(point)), point
+
+  first = data[jax.random.randint(first_key, (), 0, data.shape[0])]
+  _, others = jax.lax.scan(init_step, sq_distances_to(first),
+                           jax.random.split(key, num_centroids - 1))
+  init_centroids = jnp.concatenate([first[None], others])
+
+  def kmeans_step(centroids, unused_x):
+    assignments = jnp.argmin(
+        _matmul_cdist(data, centroids, 'sqeuclidean'), axis=-1)
+    one_hot = jax.nn.one_hot(assignments, num_centroids, dtype=data.dtype)
+    counts = jnp.sum(one_hot, axis=0)[:, None]
+    sums = jnp.matmul(one_hot.T, data, precision=jax.lax.Precision.HIGHEST)
+    # Centroids without any assigned point are kept as they are.
+    centroids = jnp.where(
+        counts > 0, sums / jnp.maximum(counts, 1.), centroids)
+    return centroids, None
+
+  centroids, _ = jax.lax.scan(
+      kmeans_step, init_centroids, None, length=num_iterations)
+  return centroids
+
+
+def ivf_index_init(centroids: Array, list_capacity: int) -> IVFIndex:
+  """Creates an empty `IVFIndex` with the given coarse centroids.
+
+  Args:
+    centroids: coarse centroids (num lists x feature size), e.g. fitted with
+      `kmeans_centroids` on a sample of embeddings.
+    list_capacity: maximum number of points in each inverted list. Lists are
+      not balanced, so a capacity of a few times the expected number of points
+      per list avoids overwriting points early.
+
+  Returns:
+    An empty IVFIndex.
+  """
+  chex.assert_rank(centroids, 2)
+  num_lists, feature_size = centroids.shape
+  return IVFIndex(
+      centroids=jnp.asarray(centroids),
+      vectors=jnp.zeros((num_lists, list_capacity, feature_size),
+                        dtype=centroids.dtype),
+      sq_norms=jnp.zeros((num_lists, list_capacity), dtype=centroids.dtype),
+      ids=jnp.full((num_lists, list_capacity), -1, dtype=jnp.int32),
+      list_sizes=jnp.zeros((num_lists,), dtype=jnp.int32),
+      num_added=jnp.zeros((), dtype=jnp.int32))
+
+
+def ivf_index_add(
+    index: IVFIndex,
+    points: Array,
+    metric: str = 'sqeuclidean',
+) -> IVFIndex:
+  """Inserts points in the inverted lists of their closest centroids.
+
+  Args:
+    index: the IVFIndex to insert the points into.
+    points: finite points to insert (num points x feature size). Each list is
+      assumed to receive at most `list capacity` of them.
+    metric: either 'sqeuclidean' or 'cosine'; the same metric must be used to
+      query the index.
+
+  Returns:
+    The updated IVFIndex, where the points have ids
+    `index.num_added + arange(num points)`.
+  """
+  chex.assert_rank(points, 2)
+  num_lists, list_capacity = index.ids.shape
+  num_points = points.shape[0]
+  assignments = jnp.argmin(
+      _matmul_cdist(points, index.centroids, metric), axis=-1)
+  # Points going to the same list are stored at consecutive positions.
+  one_hot = jax.nn.one_hot(assignments, num_lists, dtype=jnp.int32)
+  ranks = jnp.take_along_axis(
+      jnp.cumsum(one_hot, axis=0) - one_hot, assignments[:, None], axis=-1)
+  positions = (index.list_sizes[assignments] + ranks[:, 0]) % list_capacity
+  ids = index.num_added + jnp.arange(num_points, dtype=jnp.int32)
+  return index.replace(
+      vectors=index.vectors.at[assignments, positions].set(points),
+      sq_norms=index.sq_norms.at[assignments, positions].set(
+          jnp.sum(jnp.square(points), axis=-1)),
+      ids=index.ids.at[assignments, positions].set(ids),
+      list_sizes=index.list_sizes + jnp.sum(one_hot, axis=0),
+      num_added=index.num_added + num_points)
+
+
+def ivf_knn_query(
+    index: IVFIndex,
+    query_points: Array,
+    num_neighbors: int,
+    num_probes: int = 1,
+    metric: str = 'sqeuclidean',
+) -> KNNQueryResult:
+  """Finds approximate closest neighbors in an IVFIndex to the query points.
+
+  Only the points in the inverted lists of the `num_probes` centroids closest
+  to each query point are searched, which trades recall for latency: the
+  search costs `num_probes * list capacity` distances per query point, instead
+  of one per point in the database for `knn_query`. The probed lists are
+  visited one at a time, merging their points into a running top-k.
+
+  NOTE: For this function to be jittable, static_argnums=[2, 3] must be passed,
+  as well as 4 if `metric` is passed.
+
+  Args:
+    index: the IVFIndex to search.
+    query_points: array of points to find neighbors of
+        (num query points x feature size).
+    num_neighbors: number of neighbors to find.
+    num_probes: number of inverted lists searched for each query point.
+    metric: either 'sqeuclidean' or 'cosine'; the metric the index was built
+      with.
+
+  Returns:
+    KNNQueryResult with (all sorted by neg distance):
+      - neighbors (num query points x num neighbors x feature size)
+      - neighbor_indices (num query points x num neighbors), the ids of the
+        neighbors in the index, or -1 if fewer points than num_neighbors were
+        found, in which case their neg distances are -inf.
+      - neighbor_neg_distances (num query points x num neighbors)
+  """
+  chex.assert_rank(query_points, 2)
+  if metric not in ('sqeuclidean', 'cosine'):
+    raise ValueError(f'Unknown metric {metric}')
+  num_queries = query_points.shape[0]
+  vectors, sq_norms, list_ids = [
+      jnp.asarray(x) for x in (index.vectors, index.sq_norms, index.ids)]
+  k = min(num_neighbors, num_probes * list_ids.shape[-1])
+  _, probed_lists = jax.lax.top_k(
+      -_matmul_cdist(query_points, index.centroids, metric), k=num_probes)
+  query_sq_norms = jnp.sum(jnp.square(query_points), axis=-1, keepdims=True)
+
+  def merge_list(carry, lists):
+    top_neg_distances, top_ids, top_positions = carry
+    dots = jnp.einsum('md,mld->ml', query_points, vectors[lists],
+                      precision=jax.lax.Precision.HIGHEST)
+    if metric == 'sqeuclidean':
+      neg_distances = -jnp.maximum(
+          query_sq_norms - 2 * dots + sq_norms[lists], 0.)
+    else:
+      neg_distances = dots * jax.lax.rsqrt(
+          jnp.maximum(query_sq_norms * sq_norms[lists], 1e-24)) - 1.
+    ids = list_ids[lists]
+    neg_distances = jnp.where(ids >= 0, neg_distances, -jnp.inf)
+    # Keep track of where neighbors are stored to gather them at the end.
+    positions = lists[:, None] * ids.shape[-1] + jnp.arange(ids.shape[-1])
+    top_neg_distances, merged = jax.lax.top_k(
+        jnp.concatenate([top_neg_distances, neg_distances], -1), k)
+    top_ids = jnp.take_along_axis(
+        jnp.concatenate([top_ids, ids], -1), merged, axis=-1)
+    top_positions = jnp.take_along_axis(
+        jnp.concatenate([top_positions, positions], -1), merged, axis=-1)
+    return (top_neg_distances, top_ids, top_positions), None
+
+  init = (jnp.full((num_queries, k), -jnp.inf, dtype=query_points.dtype),
+          jnp.full((num_queries, k), -1, dtype=jnp.int32),
+          jnp.zeros((num_queries, k), dtype=jnp.int32))
+  (neg_distances, neighbor_indices, positions), _ = jax.lax.scan(
+      merge_list, init, probed_lists.T)
+  neighbors = vectors.reshape(-1, vectors.shape[-1])[positions]
+  return KNNQueryResult(neighbors=neighbors, neighbor_indices=neighbor_indices,
+                        neighbor_neg_distances=neg_distances)
@@ -83,6 +83,151 @@ class KNNQueryTest(parameterized.TestCase):
     with self.assertRaises(AssertionError):
       episodic_memory.knn_query(data, self.query_points, num_neighbors=2)
 
+  @chex.all_variants()
+  @parameterized.named_parameters(('sqeuclidean', 'sqeuclidean'),
+                                  ('cosine', 'cosine'))
+  def test_matmul_metric_matches_pairwise(self, metric):
+    data = np.random.RandomState(0).normal(size=(50, 8)).astype(np.float32)
+    query_points = data[:5] + 0.1
+    def metric_fn(x, y):
+      if metric == 'sqeuclidean':
+        return np.sum(np.square(x - y))
+      return 1. - np.dot(x, y) / np.sqrt(np.dot(x, x) * np.dot(y, y))
+    expected_neg_distances = -np.array(
+        [[metric_fn(q, d) for d in data] for q in query_points])
+    expected_indices = np.argsort(-expected_neg_distances, axis=-1)[:, :4]
+
+    @self.variant
+    def query_variant(data, points):
+      return episodic_memory.knn_query(data, points, 4, metric)
+    actual = query_variant(data, query_points)
+
+    np.testing.assert_array_equal(actual.neighbor_indices, expected_indices)
+    np.testing.assert_allclose(
+        actual.neighbor_neg_distances,
+        np.take_along_axis(expected_neg_distances, expected_indices, axis=-1),
+        atol=1e-4)
+
+  @chex.all_variants()
+  @parameterized.named_parameters(('divisor', 10),
+                                  ('not_divisor', 7),
+                                  ('smaller_than_k', 2))
+  def test_chunked_query(self, chunk_size):
+    data = np.random.RandomState(0).normal(size=(50, 8)).astype(np.float32)
+    # Unfilled entries of an episodic memory are set to inf.
+    data[40:] = np.inf
+    query_points = data[:5] + 0.1
+
+    @self.variant
+    def query_variant(data, points):
+      return episodic_memory.knn_query(data, points, 4, chunk_size=chunk_size)
+    actual = query_variant(data, query_points)
+    expected = episodic_memory.knn_query(data, query_points, 4)
+
+    np.testing.assert_array_equal(actual.neighbor_indices,
+                                  expected.neighbor_indices)
+    np.testing.assert_allclose(actual.neighbor_neg_distances,
+                               expected.neighbor_neg_distances, atol=1e-5)
+    np.testing.assert_allclose(actual.neighbors, expected.neighbors)
+
+  @chex.all_variants()
+  @parameterized.named_parameters(('unchunked', None), ('chunked', 7))
+  def test_num_valid(self, chunk_size):
+    data = np.random.RandomState(0).normal(size=(50, 8)).astype(np.float32)
+    query_points = data[30:35]
+
+    @self.variant
+    def query_variant(data, points, num_valid):
+      return episodic_memory.knn_query(
+          data, points, 4, chunk_size=chunk_size, num_valid=num_valid)
+    actual = query_variant(data, query_points, 20)
+    expected = episodic_memory.knn_query(data[:20], query_points, 4)
+
+    np.testing.assert_array_equal(actual.neighbor_indices,
+                                  expected.neighbor_indices)
+    np.testing.assert_allclose(actual.neighbor_neg_distances,
+                               expected.neighbor_neg_distances, atol=1e-5)
+
+  def test_unknown_metric(self):
+    with self.assertRaises(ValueError):
+      episodic_memory.knn_query(
+          self.data, self.query_points, num_neighbors=2, metric='manhattan')
+
+
+class IVFIndexTest(parameterized.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    rng = np.random.RandomState(0)
+    cluster_means = 10. * rng.normal(size=(4, 8))
+    self.data = (cluster_means[np.arange(60) % 4] +
+                 rng.normal(size=(60, 8))).astype(np.float32)
+    self.query_points = self.data[:6] + 0.1
+    self.centroids = episodic_memory.kmeans_centroids(
+        jax.random.PRNGKey(0), self.data, num_centroids=4)
+
+  def test_kmeans_centroids(self):
+    # Each centroid is the mean of one of the clusters.
+    cluster_means = np.stack([self.data[i::4].mean(0) for i in range(4)])
+    distances = np.sum(np.square(
+        self.centroids[:, None] - cluster_means[None]), axis=-1)
+    np.testing.assert_allclose(np.min(distances, axis=-1), 0., atol=1e-6)
+
+  @chex.all_variants()
+  @parameterized.named_parameters(('sqeuclidean', 'sqeuclidean'),
+                                  ('cosine', 'cosine'))
+  def test_all_probes_match_exact_query(self, metric):
+    index = episodic_memory.ivf_index_init(self.centroids, list_capacity=60)
+    # Insert the data incrementally.
+    for points in np.split(self.data, 3):
+      index = episodic_memory.ivf_index_add(index, points, metric)
+
+    @self.variant
+    def query_variant(index, points):
+      return episodic_memory.ivf_knn_query(
+          index, points, 5, num_probes=4, metric=metric)
+    actual = query_variant(index, self.query_points)
+    expected = episodic_memory.knn_query(
+        self.data, self.query_points, 5, metric)
+
+    np.testing.assert_array_equal(actual.neighbor_indices,
+                                  expected.neighbor_indices)
+    np.testing.assert_allclose(actual.neighbor_neg_distances,
+                               expected.neighbor_neg_distances, atol=1e-3)
+    np.testing.assert_allclose(actual.neighbors, expected.neighbors)
+
+  @chex.all_variants()
+  def test_full_list_overwrites_oldest_points(self):
+    index = episodic_memory.ivf_index_init(
+        np.zeros((1, 2), dtype=np.float32), list_capacity=2)
+    index = episodic_memory.ivf_index_add(
+        index, np.array([[0., 0.], [1., 0.]], dtype=np.float32))
+    index = episodic_memory.ivf_index_add(
+        index, np.array([[2., 0.]], dtype=np.float32))
+
+    @self.variant
+    def query_variant(index, points):
+      return episodic_memory.ivf_knn_query(index, points, 3)
+    actual = query_variant(index, np.array([[0., 0.]], dtype=np.float32))
+
+    # Only two points fit in the list, the first one was overwritten.
+    np.testing.assert_array_equal(actual.neighbor_indices, [[1, 2]])
+    np.testing.assert_allclose(actual.neighbor_neg_distances, [[-1., -4.]])
+
+  @chex.all_variants()
+  def test_fewer_points_than_neighbors(self):
+    index = episodic_memory.ivf_index_init(self.centroids, list_capacity=60)
+    index = episodic_memory.ivf_index_add(index, self.data[:2])
+
+    @self.variant
+    def query_variant(index, points):
+      return episodic_memory.ivf_knn_query(index, points, 3, num_probes=4)
+    actual = query_variant(index, self.query_points)
+
+    np.testing.assert_array_equal(actual.neighbor_indices[:, 2], -1)
+    np.testing.assert_array_equal(
+        actual.neighbor_neg_distances[:, 2], -np.inf)
+
 
 if __name__ == '__main__':
   jax.config.update('jax_numpy_rank_promotion', 'raise')
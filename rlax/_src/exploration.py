@@ -22,7 +22,8 @@ We also support the computation of intrinsic rewards a la Agent57 / NGU style
 exploration (see docstring), which is to be used as part of recurrent cell to
 process states and a growing memory of previously visited states.
 """
-from typing import Optional, Union
+import functools
+from typing import Optional, Tuple, Union
 
 import chex
 import jax
@@ -144,6 +145,11 @@ def add_dirichlet_noise(
   return noisy_prior
 
 
+_jit_knn_query = jax.jit(
+    functools.partial(episodic_memory.knn_query, metric='sqeuclidean'),
+    static_argnums=[2,])
+
+
 @chex.dataclass
 class IntrinsicRewardState():
   memory: jnp.ndarray
@@ -152,6 +158,57 @@ class IntrinsicRewardState():
   distance_count: Scalar = 0
 
 
+def _intrinsic_rewards_from_neighbors(
+    nn_distances_sq: Array,
+    distance_sum: Union[Array, Scalar],
+    distance_counts: Scalar,
+    reward_scale: float,
+    constant: float,
+    epsilon: float,
+    cluster_distance: float,
+    max_similarity: float,
+) -> Tuple[Array, Array, Array]:
+  """Computes intrinsic rewards from the kNN distances of new embeddings.
+
+  Returns:
+    The intrinsic rewards and the updated running sum and count of distances.
+  """
+  # Update the running distance statistics, used for the running mean dₘ²
+  distance_sum += jnp.sum(nn_distances_sq)
+  distance_counts += nn_distances_sq.size
+
+  # We compute the sum of a kernel similarity with the KNN and set to zero
+  # the reward when this similarity exceeds a given value (max_similarity)
+  # Compute rate = d(xₖ, x)² / dₘ²
+  mean_distance = distance_sum / distance_counts
+  distance_rate = nn_distances_sq / (mean_distance + constant)
+
+  # The distance rate becomes 0 if already small: r <- max(r-ξ, 0).
+  distance_rate = jnp.maximum(distance_rate - cluster_distance,
+                              jnp.zeros_like(distance_rate))
+
+  # Compute the Kernel value K(xₖ, x) = ε/(rate + ε).
+  kernel_output = epsilon / (distance_rate + epsilon)
+
+  # Compute the similarity for the embedding x:
+  # s = √(Σ_{xₖ ∈ Nₖ} K(xₖ, x)) + c
+  similarity = jnp.sqrt(jnp.sum(kernel_output, axis=-1)) + constant
+
+  # Compute the intrinsic reward:
+  # r = 1 / s.
+  reward_new = jnp.ones_like(similarity) / similarity
+
+  # Zero the reward if similarity is greater than max_similarity
+  # r <- 0 if s > sₘₐₓ otherwise r.
+  max_similarity_reached = similarity > max_similarity
+  reward = jnp.where(max_similarity_reached, 0, reward_new)
+
+  # r <- β * r
+  reward *= reward_scale
+
+  return reward, distance_sum, distance_counts
+
+
 def episodic_memory_intrinsic_rewards(
     embeddings: Array,
     num_neighbors: int,
@@ -225,9 +282,8 @@ def episodic_memory_intrinsic_rewards(
 
   # Compute the KNN from the embeddings using the square distances from
   # the KNN d²(xₖ, x). Results are not guaranteed to be ordered.
-  jit_knn_query = jax.jit(episodic_memory.knn_query, static_argnums=[2,])
-  knn_query_result = jit_knn_query(intrinsic_reward_state.memory, embeddings,
-                                   num_neighbors)
+  knn_query_result = _jit_knn_query(intrinsic_reward_state.memory, embeddings,
+                                    num_neighbors)
 
   # Insert embeddings into memory in a ring buffer fashion.
   memory = intrinsic_reward_state.memory
@@ -235,45 +291,173 @@ def episodic_memory_intrinsic_rewards(
   indices = (jnp.arange(embeddings.shape[0]) + start_index) % memory.shape[0]
   memory = jnp.asarray(memory).at[indices].set(embeddings)
 
-  nn_distances_sq = knn_query_result.neighbor_neg_distances
-
-  # Unpack running distance statistics, and update the running mean dₘ²
-  distance_sum = intrinsic_reward_state.distance_sum
-  distance_sum += jnp.sum(nn_distances_sq)
-  distance_counts = intrinsic_reward_state.distance_count
-  distance_counts += nn_distances_sq.size
-
-  # We compute the sum of a kernel similarity with the KNN and set to zero
-  # the reward when this similarity exceeds a given value (max_similarity)
-  # Compute rate = d(xₖ, x)² / dₘ²
-  mean_distance = distance_sum / distance_counts
-  distance_rate = nn_distances_sq / (mean_distance + constant)
-
-  # The distance rate becomes 0 if already small: r <- max(r-ξ, 0).
-  distance_rate = jnp.maximum(distance_rate - cluster_distance,
-                              jnp.zeros_like(distance_rate))
-
-  # Compute the Kernel value K(xₖ, x) = ε/(rate + ε).
-  kernel_output = epsilon / (distance_rate + epsilon)
-
-  # Compute the similarity for the embedding x:
-  # s = √(Σ_{xₖ ∈ Nₖ} K(xₖ, x)) + c
-  similarity = jnp.sqrt(jnp.sum(kernel_output, axis=-1)) + constant
-
-  # Compute the intrinsic reward:
-  # r = 1 / s.
-  reward_new = jnp.ones_like(embeddings[..., 0]) / similarity
-
-  # Zero the reward if similarity is greater than max_similarity
-  # r <- 0 if s > sₘₐₓ otherwise r.
-  max_similarity_reached = similarity > max_similarity
-  reward = jnp.where(max_similarity_reached, 0, reward_new)
-
-  # r <- β * r
-  reward *= reward_scale
+  reward, distance_sum, distance_counts = _intrinsic_rewards_from_neighbors(
+      knn_query_result.neighbor_neg_distances,
+      intrinsic_reward_state.distance_sum,
+      intrinsic_reward_state.distance_count,
+      reward_scale, constant, epsilon, cluster_distance, max_similarity)
 
   return reward, IntrinsicRewardState(
       memory=memory,
       next_memory_index=start_index + embeddings.shape[0] % max_memory_size,
       distance_sum=distance_sum,
       distance_count=distance_counts)
+
+
+def _query_memory(
+    state: IntrinsicRewardState,
+    embeddings: Array,
+    num_neighbors: int,
+    chunk_size: Optional[int],
+) -> episodic_memory.KNNQueryResult:
+  """Queries the filled slots of a memory, and its initial zero padding."""
+  num_valid = jnp.maximum(
+      jnp.minimum(state.next_memory_index, state.memory.shape[0]),
+      num_neighbors)
+  return episodic_memory.knn_query(
+      state.memory, embeddings, num_neighbors, metric='sqeuclidean',
+      chunk_size=chunk_size, num_valid=num_valid)
+
+
+def _insert_into_memory(
+    state: IntrinsicRewardState,
+    embeddings: Array,
+) -> IntrinsicRewardState:
+  """Inserts embeddings into a memory in a ring buffer fashion."""
+  indices = (state.next_memory_index + jnp.arange(embeddings.shape[0])
+            ) % state.memory.shape[0]
+  return state.replace(
+      memory=state.memory.at[indices].set(embeddings),
+      next_memory_index=state.next_memory_index + embeddings.shape[0])
+
+
+def _memory_intrinsic_rewards(
+    state: IntrinsicRewardState,
+    embeddings: Array,
+    num_neighbors: int,
+    chunk_size: Optional[int],
+    **reward_kwargs,
+) -> Tuple[Array, IntrinsicRewardState]:
+  """Computes intrinsic rewards, then inserts the embeddings into memory."""
+  knn_query_result = _query_memory(state, embeddings, num_neighbors, chunk_size)
+  reward, distance_sum, distance_count = _intrinsic_rewards_from_neighbors(
+      knn_query_result.neighbor_neg_distances, state.distance_sum,
+      state.distance_count, **reward_kwargs)
+  state = state.replace(distance_sum=distance_sum,
+                        distance_count=distance_count)
+  return reward, _insert_into_memory(state, embeddings)
+
+
+class EpisodicMemory:
+  """An episodic memory of embeddings, computing NGU intrinsic rewards.
+
+  This is a stateful counterpart of `episodic_memory_intrinsic_rewards`,
+  computing the same rewards, for use outside of jitted code e.g. in an actor.
+  Its query, insert and reward functions are jitted once on construction, and
+  so compiled once per shape of embeddings. The memory keeps count of its
+  filled slots, and only those are searched, and state buffers are donated so
+  that the ring buffer may be updated in place.
+
+  As in `episodic_memory_intrinsic_rewards`, the memory initially holds
+  `num_neighbors` zero embeddings, which are overwritten by the first inserted
+  ones. The `next_memory_index` of its state counts all inserted embeddings.
+  """
+
+  def __init__(
+      self,
+      num_neighbors: int,
+      reward_scale: float,
+      constant: float = 1e-3,
+      epsilon: float = 1e-4,
+      cluster_distance: float = 8e-3,
+      max_similarity: float = 8.,
+      max_memory_size: int = 30_000,
+      chunk_size: Optional[int] = None):
+    """Creates an empty episodic memory.
+
+    Args:
+      num_neighbors: int for K neighbors used in kNN query
+      reward_scale: The β term used in the Agent57 paper to scale the reward.
+      constant: float; small constant used for numerical stability used during
+        normalizing distances.
+      epsilon: float; small constant used for numerical stability when
+        computing kernel output.
+      cluster_distance: float; the ξ term used in the Agent57 paper to bound the
+        distance rate used in the kernel computation.
+      max_similarity: float; max limit of similarity; used to zero rewards when
+        similarity between memories is too high to be considered 'useful' for
+        an agent.
+      max_memory_size: int; the maximum number of memories to store.
+      chunk_size: optional number of memories processed at once by the kNN
+        query, see `knn_query`; chunks past the filled slots are skipped.
+    """
+    self._num_neighbors = num_neighbors
+    self._max_memory_size = max_memory_size
+    self._query = jax.jit(functools.partial(
+        _query_memory, num_neighbors=num_neighbors, chunk_size=chunk_size))
+    self._insert = jax.jit(_insert_into_memory, donate_argnums=0)
+    self._intrinsic_rewards = jax.jit(
+        functools.partial(
+            _memory_intrinsic_rewards,
+            num_neighbors=num_neighbors,
+            chunk_size=chunk_size,
+            reward_scale=reward_scale,
+            constant=constant,
+            epsilon=epsilon,
+            cluster_distance=cluster_distance,
+            max_similarity=max_similarity),
+        donate_argnums=0)
+    self._state = None
+
+  @property
+  def state(self) -> Optional[IntrinsicRewardState]:
+    """The state of the memory, or None if nothing was inserted since reset."""
+    return self._state
+
+  def reset(self):
+    """Empties the memory, e.g. at the start of an episode."""
+    self._state = None
+
+  def _get_state(self, embeddings: Array) -> IntrinsicRewardState:
+    chex.assert_rank(embeddings, 2)
+    if self._state is None:
+      feature_size = embeddings.shape[-1]
+      self._state = IntrinsicRewardState(
+          memory=jnp.zeros((self._max_memory_size, feature_size)),
+          next_memory_index=jnp.zeros((), dtype=jnp.int32),
+          distance_sum=jnp.zeros(()),
+          distance_count=jnp.zeros((), dtype=jnp.int32))
+    return self._state
+
+  def query(self, embeddings: Array) -> episodic_memory.KNNQueryResult:
+    """Finds the closest neighbors in memory of the embeddings.
+
+    Args:
+      embeddings: Array, shaped [M, D] for M state embeddings of dim D.
+
+    Returns:
+      KNNQueryResult with the `num_neighbors` closest embeddings in memory, see
+      `knn_query`.
+    """
+    return self._query(self._get_state(embeddings), embeddings)
+
+  def insert(self, embeddings: Array):
+    """Inserts embeddings into memory, overwriting the oldest when full.
+
+    Args:
+      embeddings: Array, shaped [M, D] for M state embeddings of dim D.
+    """
+    self._state = self._insert(self._get_state(embeddings), embeddings)
+
+  def intrinsic_rewards(self, embeddings: Array) -> Array:
+    """Computes intrinsic rewards for embeddings, then inserts them in memory.
+
+    Args:
+      embeddings: Array, shaped [M, D] for M new state embeddings of dim D.
+
+    Returns:
+      Intrinsic reward for each embedding, shaped [M].
+    """
+    reward, self._state = self._intrinsic_rewards(
+        self._get_state(embeddings), embeddings)
+    return reward
@@ -136,6 +136,43 @@ class EMIntrinsicRewardTest(parameterized.TestCase):
         np.array([[4., 4.,], [1., 1.], [2., 2.], [3., 3.]]))
 
 
+class EpisodicMemoryTest(parameterized.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.num_neighbors = 2
+    self.reward_scale = 1.
+    self.embeddings = np.random.RandomState(0).normal(
+        size=(4, 3, 2)).astype(np.float32)
+
+  @parameterized.named_parameters(('unchunked', None), ('chunked', 3))
+  def test_matches_functional_rewards(self, chunk_size):
+    memory = exploration.EpisodicMemory(
+        self.num_neighbors, self.reward_scale, max_memory_size=8,
+        chunk_size=chunk_size)
+    state = None
+    # Insert enough embeddings for the ring buffer to wrap around.
+    for embeddings in self.embeddings:
+      expected, state = exploration.episodic_memory_intrinsic_rewards(
+          embeddings, self.num_neighbors, self.reward_scale, state,
+          max_memory_size=8)
+      actual = memory.intrinsic_rewards(embeddings)
+      np.testing.assert_allclose(expected, actual, rtol=1e-5)
+    np.testing.assert_allclose(state.memory, memory.state.memory)
+
+  def test_query_filled_slots(self):
+    memory = exploration.EpisodicMemory(
+        self.num_neighbors, self.reward_scale, max_memory_size=8)
+    memory.insert(self.embeddings[0])
+    memory.insert(self.embeddings[1][:1])
+    actual = memory.query(self.embeddings[1][:1])
+    # The closest is the inserted embedding itself, in the fourth slot.
+    np.testing.assert_array_equal(actual.neighbor_indices[0, 0], 3)
+    self.assertTrue(np.all(actual.neighbor_indices < 4))
+    memory.reset()
+    self.assertIsNone(memory.state)
+
+
 if __name__ == '__main__':
   jax.config.update('jax_numpy_rank_promotion', 'raise')
   absltest.main()
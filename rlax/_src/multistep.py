@@ -20,7 +20,8 @@ rewards collected by an agent). These estimate compute returns from trajectories
 of experience; trajectories are not assumed to align with episode boundaries,
 and bootstrapping is used to estimate returns beyond the end of a trajectory.
 """
-from typing import Union
+import collections
+from typing import Optional, Tuple, Union
 import chex
 import jax
 import jax.numpy as jnp
@@ -29,6 +30,75 @@ from rlax._src import base
 Array = chex.Array
 Scalar = chex.Scalar
 Numeric = chex.Numeric
+# Largest `n` for which n-step returns are computed by unrolling the recursion.
+_MAX_UNROLLED_N_STEPS = 16
+AdvantagesAndTargets = collections.namedtuple(
+    'advantages_and_targets',
+    ['advantages', 'value_targets', 'normalized_advantages'])
+
+
+def _sliding_window_affine(
+    a_t: Array,
+    b_t: Array,
+    window: int,
+) -> Tuple[Array, Array]:
+  """Composes the affine maps xₜ = bₜ + aₜ xₜ₊₁ over windows of fixed length.
+
+  For each t, returns `(A_t, B_t)` such that xₜ = B_t + A_t xₜ₊ₙ, where `n` is
+  the `window` length. Steps past the end of the sequence are identity maps.
+  Any trailing dimensions of the inputs are treated as batch dimensions.
+
+  The sequence is split in blocks of length `window`, so that every window spans
+  at most two consecutive blocks. Windows are then obtained by composing the
+  suffix of one block with the prefix of the next, which requires `O(T)` work
+  and a traced graph whose size does not depend on `window`.
+
+  Args:
+    a_t: multiplicative coefficients aₜ for timesteps t in [0, T-1].
+    b_t: additive terms bₜ for timesteps t in [0, T-1].
+    window: number of consecutive maps to compose.
+
+  Returns:
+    The coefficients `A_t` and `B_t` of the composed maps, for t in [0, T-1].
+  """
+  seq_len, batch_shape = a_t.shape[0], a_t.shape[1:]
+  num_blocks = -(-seq_len // window) + 1
+  pad_size = num_blocks * window - seq_len
+  a = jnp.concatenate([a_t, jnp.ones((pad_size,) + batch_shape, a_t.dtype)])
+  b = jnp.concatenate([b_t, jnp.zeros((pad_size,) + batch_shape, b_t.dtype)])
+  # Lay blocks out along a batch axis, so each scan step updates all blocks.
+  a = jnp.swapaxes(a.reshape((num_blocks, window) + batch_shape), 0, 1)
+  b = jnp.swapaxes(b.reshape((num_blocks, window) + batch_shape), 0, 1)
+
+  # Compose the maps from each step to the end, and from the start, of a block.
+  def _suffix_body(acc, xs):
+    acc = base.compose_affine(xs, acc)
+    return acc, acc
+
+  def _prefix_body(acc, xs):
+    acc = base.compose_affine(acc, xs)
+    return acc, acc
+
+  identity = (jnp.ones_like(a[0]), jnp.zeros_like(b[0]))
+  _, (suffix_a, suffix_b) = jax.lax.scan(
+      _suffix_body, identity, (a, b), reverse=True)
+  _, (prefix_a, prefix_b) = jax.lax.scan(_prefix_body, identity, (a, b))
+  suffix_a, suffix_b, prefix_a, prefix_b = (
+      jnp.swapaxes(x, 0, 1).reshape((-1,) + batch_shape)
+      for x in (suffix_a, suffix_b, prefix_a, prefix_b))
+
+  # The window starting at t ends in the following block, at t + window - 1,
+  # unless it starts at the beginning of a block and so spans exactly one block.
+  suffix_a = suffix_a[:seq_len]
+  suffix_b = suffix_b[:seq_len]
+  prefix_a = prefix_a[window - 1:window - 1 + seq_len]
+  prefix_b = prefix_b[window - 1:window - 1 + seq_len]
+  starts_block = base.lhs_broadcast(
+      jnp.arange(seq_len) % window == 0, prefix_a)
+  prefix_a = jnp.where(starts_block, jnp.ones_like(prefix_a), prefix_a)
+  prefix_b = jnp.where(starts_block, jnp.zeros_like(prefix_b), prefix_b)
+
+  return base.compose_affine((suffix_a, suffix_b), (prefix_a, prefix_b))
 
 
 def lambda_returns(
@@ -37,6 +107,9 @@ def lambda_returns(
     v_t: Array,
     lambda_: Numeric = 1.,
     stop_target_gradients: bool = False,
+    method: str = 'scan',
+    time_major: bool = False,
+    segment_ids: Optional[Array] = None,
 ) -> Array:
   """Estimates a multistep truncated lambda return from a trajectory.
 
@@ -83,6 +156,16 @@ def lambda_returns(
 
   Estimated return are then often used to define a td error, e.g.:  ρₜ(Gₜ - vₜ).
 
+  The recursion is affine in Gₜ₊₁, so besides a sequential scan it can also be
+  evaluated with a parallel associative scan (`method='associative'`), whose
+  depth is logarithmic rather than linear in the sequence length. The two
+  methods agree up to floating point rounding.
+
+  Variable-length episodes can be packed end to end into one sequence, with
+  `segment_ids` identifying the episode of each timestep. The recursion is then
+  reset at the last timestep of every episode, which bootstraps from its own
+  `v_t`, so the returns match those of separate calls on each episode.
+
   See "Reinforcement Learning: An Introduction" by Sutton and Barto.
   (http://incompleteideas.net/sutton/book/ebook/node74.html).
 
@@ -93,25 +176,190 @@ def lambda_returns(
     lambda_: mixing parameter; a scalar or a vector for timesteps t in [1, T].
     stop_target_gradients: bool indicating whether or not to apply stop gradient
       to targets.
+    method: either 'scan' (sequential) or 'associative' (parallel prefix scan).
+    time_major: if True, all sequences have shape `[T, B]`, and the returns of
+      the whole batch are computed in a single scan over time.
+    segment_ids: optional integer ids of the packed episode each timestep
+      belongs to, with the same shape as `r_t`.
 
   Returns:
     Multistep lambda returns.
   """
-  chex.assert_rank([r_t, discount_t, v_t, lambda_], [1, 1, 1, {0, 1}])
+  if segment_ids is not None:
+    chex.assert_equal_shape([segment_ids, discount_t])
+    lambda_ = lambda_ * base.segment_continuation_mask(
+        segment_ids, discount_t.dtype)
+  returns, _ = chunked_lambda_returns(
+      r_t, discount_t, v_t, lambda_, carry=None,
+      stop_target_gradients=stop_target_gradients, method=method,
+      time_major=time_major)
+  return returns
+
+
+def chunked_lambda_returns(
+    r_t: Array,
+    discount_t: Array,
+    v_t: Array,
+    lambda_: Numeric = 1.,
+    carry: Optional[Array] = None,
+    stop_target_gradients: bool = False,
+    method: str = 'scan',
+    time_major: bool = False,
+) -> Tuple[Array, Array]:
+  """Estimates lambda returns for one chunk of a longer trajectory.
+
+  A long trajectory can be split into consecutive chunks, which are then
+  processed from the last to the first: the carry returned for each chunk is
+  passed as `carry` to the chunk that precedes it. The concatenated returns are
+  identical to those computed by `lambda_returns` on the whole trajectory,
+  while only one chunk needs to be in memory at any time.
+
+  Args:
+    r_t: sequence of rewards rₜ for timesteps t in [1, T].
+    discount_t: sequence of discounts γₜ for timesteps t in [1, T].
+    v_t: sequence of state values estimates under π for timesteps t in [1, T].
+    lambda_: mixing parameter; a scalar or a vector for timesteps t in [1, T].
+    carry: the lambda return at the first timestep of the following chunk. If
+      `None`, the chunk ends the trajectory and bootstraps from `v_t[-1]`.
+    stop_target_gradients: bool indicating whether or not to apply stop gradient
+      to targets.
+    method: either 'scan' (sequential) or 'associative' (parallel prefix scan).
+    time_major: if True, all sequences have shape `[T, B]` and `carry` has
+      shape `[B]`.
+
+  Returns:
+    A tuple of the lambda returns for this chunk, and the carry to pass to the
+    preceding chunk.
+  """
+  seq_rank = 2 if time_major else 1
+  chex.assert_rank([r_t, discount_t, v_t, lambda_],
+                   [seq_rank, seq_rank, seq_rank, {0, seq_rank}])
   chex.assert_type([r_t, discount_t, v_t, lambda_], float)
   chex.assert_equal_shape([r_t, discount_t, v_t])
+  if carry is None:
+    carry = v_t[-1]
+  chex.assert_shape(carry, r_t.shape[1:])
 
   # If scalar make into vector.
   lambda_ = jnp.ones_like(discount_t) * lambda_
 
   # Work backwards to compute `G_{T-1}`, ..., `G_0`.
-  def _body(acc, xs):
-    returns, discounts, values, lambda_ = xs
-    acc = returns + discounts * ((1-lambda_) * values + lambda_ * acc)
-    return acc, acc
+  returns = base.reverse_linear_recurrence(
+      a_t=discount_t * lambda_,
+      b_t=r_t + discount_t * (1 - lambda_) * v_t,
+      x_bootstrap=carry,
+      method=method)
+
+  returns = jax.lax.select(stop_target_gradients,
+                           jax.lax.stop_gradient(returns),
+                           returns)
+  return returns, returns[0]
+
+
+def time_sharded_lambda_returns(
+    r_t: Array,
+    discount_t: Array,
+    v_t: Array,
+    lambda_: Numeric = 1.,
+    axis_name: str = 'time',
+    stop_target_gradients: bool = False,
+    time_major: bool = False,
+) -> Array:
+  """Estimates lambda returns for a trajectory sharded in time across devices.
+
+  Each device along `axis_name` holds a consecutive shard of the trajectory,
+  ordered by device index. Every device first summarises its shard as one
+  affine map of the return that follows it, the summaries are exchanged with a
+  single `all_gather`, and each device then completes its shard locally from
+  the carry of the shards that follow it. The concatenated returns match those
+  of `lambda_returns` on the whole trajectory, up to floating point rounding.
+
+  This function must be called in a mapped context, such as `jax.pmap` or
+  `shard_map` over the time dimension, e.g.:
+
+    shard_map(functools.partial(time_sharded_lambda_returns, axis_name='t'),
+              mesh, in_specs=P('t'), out_specs=P('t'))
+
+  Args:
+    r_t: local shard of rewards rₜ.
+    discount_t: local shard of discounts γₜ.
+    v_t: local shard of state values estimates under π.
+    lambda_: mixing parameter; a scalar or a local shard of lambdas.
+    axis_name: name of the mapped axis over which time is sharded.
+    stop_target_gradients: bool indicating whether or not to apply stop gradient
+      to targets.
+    time_major: if True, all local shards have shape `[T, B]`.
+
+  Returns:
+    Multistep lambda returns for the local shard.
+  """
+  lambda_ = jnp.ones_like(discount_t) * lambda_
+
+  # Summarise the shard as Gₜ₀ = B + A G, where G follows the shard.
+  _, x_first = chunked_lambda_returns(
+      r_t, discount_t, v_t, lambda_, carry=jnp.zeros_like(v_t[-1]),
+      time_major=time_major)
+  carry = base.carry_from_following_shards(
+      discount_t * lambda_, x_first, v_t[-1], axis_name)
+
+  returns, _ = chunked_lambda_returns(
+      r_t, discount_t, v_t, lambda_, carry=carry,
+      stop_target_gradients=stop_target_gradients, time_major=time_major)
+  return returns
+
 
-  _, returns = jax.lax.scan(
-      _body, v_t[-1], (r_t, discount_t, v_t, lambda_), reverse=True)
+def lambda_returns_bank(
+    r_t: Array,
+    discount_t: Array,
+    v_t: Array,
+    gammas: Array,
+    lambdas: Numeric = 1.,
+    stop_target_gradients: bool = False,
+    method: str = 'scan',
+) -> Array:
+  """Estimates lambda returns for a bank of `K` discounts and lambdas at once.
+
+  Agents with multiple value heads, e.g. one per discount as in Agent57, need
+  the return of the same reward stream under `K` different discount factors
+  γₖ and mixing parameters λₖ. Rather than calling `lambda_returns` once per
+  head, all returns are computed by one scan over time that carries a vector
+  of `K` accumulators:
+
+    Gₜₖ = rₜ₊₁ + γₜ₊₁ γₖ [(1 - λₖ) vₜ₊₁ₖ + λₖ Gₜ₊₁ₖ].
+
+  With `lambdas=1` this computes discounted returns bootstrapped from the last
+  value of each head, as `discounted_returns` does.
+
+  Args:
+    r_t: sequence of rewards rₜ for timesteps t in [1, T], shared by all heads.
+    discount_t: sequence of discounts γₜ for timesteps t in [1, T], e.g. zero
+      at episode terminations, shared by all heads.
+    v_t: state values estimates of each head, with shape `[T, K]`.
+    gammas: discount factor γₖ of each head, with shape `[K]`.
+    lambdas: mixing parameter of each head; a scalar or a vector of shape `[K]`.
+    stop_target_gradients: bool indicating whether or not to apply stop gradient
+      to targets.
+    method: either 'scan' (sequential) or 'associative' (parallel prefix scan).
+
+  Returns:
+    Multistep lambda returns of each head, with shape `[T, K]`.
+  """
+  chex.assert_rank([r_t, discount_t, v_t, gammas, lambdas],
+                   [1, 1, 2, 1, {0, 1}])
+  chex.assert_type([r_t, discount_t, v_t, gammas, lambdas], float)
+  chex.assert_equal_shape([r_t, discount_t, v_t[:, 0]])
+  chex.assert_equal_shape([gammas, v_t[0]])
+
+  # If scalar make into vector.
+  lambdas = jnp.ones_like(gammas) * lambdas
+  discount_tk = discount_t[:, None] * gammas[None, :]
+
+  # Work backwards to compute `G_{T-1}`, ..., `G_0` for all heads together.
+  returns = base.reverse_linear_recurrence(
+      a_t=discount_tk * lambdas[None, :],
+      b_t=r_t[:, None] + discount_tk * (1 - lambdas[None, :]) * v_t,
+      x_bootstrap=v_t[-1],
+      method=method)
 
   return jax.lax.select(stop_target_gradients,
                         jax.lax.stop_gradient(returns),
@@ -125,6 +373,7 @@ def n_step_bootstrapped_returns(
     n: int,
     lambda_t: Numeric = 1.,
     stop_target_gradients: bool = False,
+    time_major: bool = False,
 ) -> Array:
   """Computes strided n-step bootstrapped return targets over a sequence.
 
@@ -136,6 +385,10 @@ def n_step_bootstrapped_returns(
 
      Gₜ = rₜ₊₁ + γₜ₊₁ * (rₜ₊₂ + γₜ₊₂ * (... * (rₜ₊ₙ + γₜ₊ₙ * vₜ₊ₙ ))).
 
+  For small `n` the `n` iterations are unrolled. For larger `n` they are
+  evaluated as a composition of affine maps over sliding windows instead, so
+  the cost of computing the returns does not grow with `n`.
+
   Args:
     r_t: rewards at times [1, ..., T].
     discount_t: discounts at times [1, ..., T].
@@ -144,35 +397,50 @@ def n_step_bootstrapped_returns(
     lambda_t: lambdas at times [1, ..., T]. Shape is [], or [T-1].
     stop_target_gradients: bool indicating whether or not to apply stop gradient
       to targets.
+    time_major: if True, all sequences have shape `[T, B]`, and the returns of
+      the whole batch are computed at once.
 
   Returns:
     estimated bootstrapped returns at times [0, ...., T-1]
   """
-  chex.assert_rank([r_t, discount_t, v_t, lambda_t], [1, 1, 1, {0, 1}])
+  seq_rank = 2 if time_major else 1
+  chex.assert_rank([r_t, discount_t, v_t, lambda_t],
+                   [seq_rank, seq_rank, seq_rank, {0, seq_rank}])
   chex.assert_type([r_t, discount_t, v_t, lambda_t], float)
   chex.assert_equal_shape([r_t, discount_t, v_t])
   seq_len = r_t.shape[0]
+  # Windows longer than the sequence are truncated at its end anyway.
+  n = min(n, seq_len)
 
   # Maybe change scalar lambda to an array.
   lambda_t = jnp.ones_like(discount_t) * lambda_t
 
   # Shift bootstrap values by n and pad end of sequence with last value v_t[-1].
-  pad_size = min(n - 1, seq_len)
-  targets = jnp.concatenate([v_t[n - 1:], jnp.array([v_t[-1]] * pad_size)])
-
-  # Pad sequences. Shape is now (T + n - 1,).
-  r_t = jnp.concatenate([r_t, jnp.zeros(n - 1)])
-  discount_t = jnp.concatenate([discount_t, jnp.ones(n - 1)])
-  lambda_t = jnp.concatenate([lambda_t, jnp.ones(n - 1)])
-  v_t = jnp.concatenate([v_t, jnp.array([v_t[-1]] * (n - 1))])
-
-  # Work backwards to compute n-step returns.
-  for i in reversed(range(n)):
-    r_ = r_t[i:i + seq_len]
-    discount_ = discount_t[i:i + seq_len]
-    lambda_ = lambda_t[i:i + seq_len]
-    v_ = v_t[i:i + seq_len]
-    targets = r_ + discount_ * ((1. - lambda_) * v_ + lambda_ * targets)
+  bootstrap_t = jnp.concatenate(
+      [v_t[n - 1:], jnp.repeat(v_t[-1:], n - 1, axis=0)])
+
+  if n <= _MAX_UNROLLED_N_STEPS:
+    # Pad sequences to length T + n - 1, and work backwards from the bootstrap.
+    pad = lambda x, v: jnp.concatenate([x, jnp.repeat(v, n - 1, axis=0)])
+    r_t = pad(r_t, jnp.zeros_like(r_t[:1]))
+    discount_t = pad(discount_t, jnp.ones_like(discount_t[:1]))
+    lambda_t = pad(lambda_t, jnp.ones_like(lambda_t[:1]))
+    v_t = pad(v_t, v_t[-1:])
+    targets = bootstrap_t
+    for i in reversed(range(n)):
+      r_ = r_t[i:i + seq_len]
+      discount_ = discount_t[i:i + seq_len]
+      lambda_ = lambda_t[i:i + seq_len]
+      v_ = v_t[i:i + seq_len]
+      targets = r_ + discount_ * ((1. - lambda_) * v_ + lambda_ * targets)
+  else:
+    # Each step of the recursion is an affine map of the return Gₜ₊₁; compose
+    # the `n` maps following each timestep, and apply them to the bootstrap.
+    a_t, b_t = _sliding_window_affine(
+        a_t=discount_t * lambda_t,
+        b_t=r_t + discount_t * (1. - lambda_t) * v_t,
+        window=n)
+    targets = b_t + a_t * bootstrap_t
 
   return jax.lax.select(stop_target_gradients,
                         jax.lax.stop_gradient(targets), targets)
@@ -183,6 +451,7 @@ def discounted_returns(
     discount_t: Array,
     v_t: Array,
     stop_target_gradients: bool = False,
+    time_major: bool = False,
 ) -> Array:
   """Calculates a discounted return from a trajectory.
 
@@ -199,17 +468,22 @@ def discounted_returns(
     v_t: value sequence or scalar at time t.
     stop_target_gradients: bool indicating whether or not to apply stop gradient
       to targets.
+    time_major: if True, `r_t` and `discount_t` have shape `[T, B]`, and `v_t`
+      has shape `[T, B]` or `[B]`.
 
   Returns:
     Discounted returns.
   """
-  chex.assert_rank([r_t, discount_t, v_t], [1, 1, {0, 1}])
+  seq_rank = 2 if time_major else 1
+  chex.assert_rank([r_t, discount_t, v_t],
+                   [seq_rank, seq_rank, {seq_rank - 1, seq_rank}])
   chex.assert_type([r_t, discount_t, v_t], float)
 
   # If scalar make into vector.
-  bootstrapped_v = jnp.ones_like(discount_t) * v_t
+  bootstrapped_v = jnp.broadcast_to(v_t, discount_t.shape)
   return lambda_returns(r_t, discount_t, bootstrapped_v, lambda_=1.,
-                        stop_target_gradients=stop_target_gradients)
+                        stop_target_gradients=stop_target_gradients,
+                        time_major=time_major)
 
 
 def importance_corrected_td_errors(
@@ -219,6 +493,7 @@ def importance_corrected_td_errors(
     lambda_: Array,
     values: Array,
     stop_target_gradients: bool = False,
+    time_major: bool = False,
 ) -> Array:
   """Computes the multistep td errors with per decision importance sampling.
 
@@ -246,30 +521,31 @@ def importance_corrected_td_errors(
     values: sequence of state values under π for all timesteps t in [0, T].
     stop_target_gradients: bool indicating whether or not to apply stop gradient
       to targets.
+    time_major: if True, all sequences have shape `[T, B]` (`[T+1, B]` for
+      `values`), and the errors of the whole batch are computed in one scan.
 
   Returns:
     Off-policy estimates of the multistep td errors.
   """
-  chex.assert_rank([r_t, discount_t, rho_tm1, values], [1, 1, 1, 1])
+  seq_rank = 2 if time_major else 1
+  chex.assert_rank([r_t, discount_t, rho_tm1, values], seq_rank)
   chex.assert_type([r_t, discount_t, rho_tm1, values], float)
   chex.assert_equal_shape([r_t, discount_t, rho_tm1, values[1:]])
 
   v_tm1 = values[:-1]  # Predictions to compute errors for.
   v_t = values[1:]  # Values for bootstrapping.
-  rho_t = jnp.concatenate((rho_tm1[1:], jnp.array([1.])))  # Unused dummy value.
+  rho_t = jnp.concatenate(  # Unused dummy value.
+      (rho_tm1[1:], jnp.ones_like(rho_tm1[:1])))
   lambda_ = jnp.ones_like(discount_t) * lambda_  # If scalar, make into vector.
 
   # Compute the one step temporal difference errors.
   one_step_delta = r_t + discount_t * v_t - v_tm1
 
   # Work backwards to compute `delta_{T-1}`, ..., `delta_0`.
-  def _body(acc, xs):
-    deltas, discounts, rho_t, lambda_ = xs
-    acc = deltas + discounts * rho_t * lambda_ * acc
-    return acc, acc
-
-  _, errors = jax.lax.scan(
-      _body, 0.0, (one_step_delta, discount_t, rho_t, lambda_), reverse=True)
+  errors = base.reverse_linear_recurrence(
+      a_t=discount_t * rho_t * lambda_,
+      b_t=one_step_delta,
+      x_bootstrap=jnp.zeros_like(one_step_delta[0]))
 
   errors = rho_tm1 * errors
   return jax.lax.select(stop_target_gradients,
@@ -282,6 +558,9 @@ def truncated_generalized_advantage_estimation(
     lambda_: Union[Array, Scalar],
     values: Array,
     stop_target_gradients: bool = False,
+    time_major: bool = False,
+    segment_ids: Optional[Array] = None,
+    bootstrap_values: Optional[Array] = None,
 ) -> Array:
   """Computes truncated generalized advantage estimates for a sequence length k.
 
@@ -296,6 +575,13 @@ def truncated_generalized_advantage_estimation(
   convention that follows Sutton & Barto. We use rₜ₊₁ to denote the reward
   received after acting in state sₜ, while the PPO paper uses rₜ.
 
+  Episodes packed end to end can be separated by `segment_ids`, which resets
+  the accumulation of advantages at the last timestep of each episode. As
+  `values[t+1]` then holds the first value of the next episode, the last step
+  of every episode but the final one bootstraps from `bootstrap_values`
+  instead; if these are not given, the episodes are treated as terminating at
+  their boundaries. The final episode bootstraps from `values[-1]` as usual.
+
   Args:
     r_t: Sequence of rewards at times [1, k]
     discount_t: Sequence of discounts at times [1, k]
@@ -303,28 +589,156 @@ def truncated_generalized_advantage_estimation(
     values: Sequence of values under π at times [0, k]
     stop_target_gradients: bool indicating whether or not to apply stop gradient
       to targets.
+    time_major: if True, all sequences have shape `[k, B]` (`[k+1, B]` for
+      `values`), and the advantages of the whole batch are computed in one scan.
+    segment_ids: optional integer ids of the packed episode each timestep
+      belongs to, with the same shape as `r_t`.
+    bootstrap_values: optional values to bootstrap from at the last timestep of
+      each packed episode, with the same shape as `r_t`; only the entries at
+      the boundaries between episodes are used.
 
   Returns:
     Multistep truncated generalized advantage estimation at times [0, k-1].
   """
-  chex.assert_rank([r_t, values, discount_t], 1)
+  if segment_ids is not None:
+    chex.assert_equal_shape([segment_ids, discount_t])
+    lambda_ = lambda_ * base.segment_continuation_mask(
+        segment_ids, discount_t.dtype)
+    # The last timestep of every episode except the final one.
+    ends = segment_ids[1:] != segment_ids[:-1]
+    ends = jnp.concatenate(
+        [ends, jnp.zeros_like(ends[:1])], axis=0).astype(discount_t.dtype)
+    if bootstrap_values is not None:
+      chex.assert_equal_shape([bootstrap_values, discount_t])
+      r_t = r_t + ends * discount_t * bootstrap_values
+    discount_t = discount_t * (1. - ends)
+  elif bootstrap_values is not None:
+    raise ValueError('`bootstrap_values` requires `segment_ids`.')
+  advantage_t, _ = chunked_truncated_generalized_advantage_estimation(
+      r_t, discount_t, lambda_, values, carry=None,
+      stop_target_gradients=stop_target_gradients, time_major=time_major)
+  return advantage_t
+
+
+def chunked_truncated_generalized_advantage_estimation(
+    r_t: Array,
+    discount_t: Array,
+    lambda_: Union[Array, Scalar],
+    values: Array,
+    carry: Optional[Array] = None,
+    stop_target_gradients: bool = False,
+    time_major: bool = False,
+) -> Tuple[Array, Array]:
+  """Computes truncated GAE for one chunk of a longer trajectory.
+
+  A long trajectory can be split into consecutive chunks, which are then
+  processed from the last to the first: the carry returned for each chunk is
+  passed as `carry` to the chunk that precedes it. Consecutive chunks share one
+  value, as `values` includes the bootstrap value at the end of each chunk. The
+  concatenated advantages are identical to those computed by
+  `truncated_generalized_advantage_estimation` on the whole trajectory.
+
+  Args:
+    r_t: Sequence of rewards at times [1, k]
+    discount_t: Sequence of discounts at times [1, k]
+    lambda_: Mixing parameter; a scalar or sequence of lambda_t at times [1, k]
+    values: Sequence of values under π at times [0, k]
+    carry: the advantage at the first timestep of the following chunk. If
+      `None`, the chunk ends the trajectory.
+    stop_target_gradients: bool indicating whether or not to apply stop gradient
+      to targets.
+    time_major: if True, all sequences have shape `[k, B]` (`[k+1, B]` for
+      `values`), and `carry` has shape `[B]`.
+
+  Returns:
+    A tuple of the advantages at times [0, k-1], and the carry to pass to the
+    preceding chunk.
+  """
+  seq_rank = 2 if time_major else 1
+  chex.assert_rank([r_t, values, discount_t], seq_rank)
   chex.assert_type([r_t, values, discount_t], float)
   lambda_ = jnp.ones_like(discount_t) * lambda_  # If scalar, make into vector.
 
   delta_t = r_t + discount_t * values[1:] - values[:-1]
+  if carry is None:
+    carry = jnp.zeros_like(delta_t[0])
+  chex.assert_shape(carry, delta_t.shape[1:])
 
   # Iterate backwards to calculate advantages.
-  def _body(acc, xs):
-    deltas, discounts, lambda_ = xs
-    acc = deltas + discounts * lambda_ * acc
-    return acc, acc
+  advantage_t = base.reverse_linear_recurrence(
+      a_t=discount_t * lambda_,
+      b_t=delta_t,
+      x_bootstrap=carry)
 
-  _, advantage_t = jax.lax.scan(
-      _body, 0.0, (delta_t, discount_t, lambda_), reverse=True)
+  advantage_t = jax.lax.select(stop_target_gradients,
+                               jax.lax.stop_gradient(advantage_t),
+                               advantage_t)
+  return advantage_t, advantage_t[0]
 
-  return jax.lax.select(stop_target_gradients,
-                        jax.lax.stop_gradient(advantage_t),
-                        advantage_t)
+
+def truncated_generalized_advantage_estimation_and_targets(
+    r_t: Array,
+    discount_t: Array,
+    lambda_: Union[Array, Scalar],
+    values: Array,
+    normalize_advantages: bool = False,
+    axis_name: Optional[str] = None,
+    epsilon: float = 1e-8,
+    stop_target_gradients: bool = False,
+    time_major: bool = False,
+) -> AdvantagesAndTargets:
+  """Computes truncated GAE together with value targets and normalized GAE.
+
+  PPO style learners use the advantages Âₜ of
+  `truncated_generalized_advantage_estimation` both as policy gradient
+  advantages, usually after normalizing them across the whole batch, and to
+  construct value targets Âₜ + v(sₜ). This function computes all of them with a
+  single scan over time, followed by one reduction of the sum and the sum of
+  squares of the advantages. If `axis_name` is given, the two statistics are
+  aggregated across devices with a single `psum`.
+
+  Args:
+    r_t: Sequence of rewards at times [1, k]
+    discount_t: Sequence of discounts at times [1, k]
+    lambda_: Mixing parameter; a scalar or sequence of lambda_t at times [1, k]
+    values: Sequence of values under π at times [0, k]
+    normalize_advantages: whether to also return advantages normalized to zero
+      mean and unit variance.
+    axis_name: optional name of a mapped axis to normalize advantages over.
+    epsilon: small value added to the standard deviation for numerical
+      stability.
+    stop_target_gradients: bool indicating whether or not to apply stop gradient
+      to advantages and targets.
+    time_major: if True, all sequences have shape `[k, B]` (`[k+1, B]` for
+      `values`), and advantages are normalized over time and batch.
+
+  Returns:
+    A tuple of the advantages at times [0, k-1], the value targets at times
+    [0, k-1], and the normalized advantages (or `None`).
+  """
+  advantages = truncated_generalized_advantage_estimation(
+      r_t, discount_t, lambda_, values,
+      stop_target_gradients=stop_target_gradients, time_major=time_major)
+  value_targets = advantages + values[:-1]
+  value_targets = jax.lax.select(stop_target_gradients,
+                                 jax.lax.stop_gradient(value_targets),
+                                 value_targets)
+
+  normalized_advantages = None
+  if normalize_advantages:
+    moments = jnp.stack([
+        jnp.sum(advantages), jnp.sum(jnp.square(advantages)),
+        jnp.array(advantages.size, advantages.dtype)])
+    if axis_name is not None:
+      moments = jax.lax.psum(moments, axis_name=axis_name)
+    total, total_sq, count = moments
+    mean = total / count
+    std = jnp.sqrt(jnp.maximum(total_sq / count - jnp.square(mean), 0.))
+    normalized_advantages = (advantages - mean) / (std + epsilon)
+
+  return AdvantagesAndTargets(
+      advantages=advantages, value_targets=value_targets,
+      normalized_advantages=normalized_advantages)
 
 
 def general_off_policy_returns_from_action_values(
@@ -335,6 +749,7 @@ def general_off_policy_returns_from_action_values(
     c_t: Array,
     pi_t: Array,
     stop_target_gradients: bool = False,
+    time_major: bool = False,
 ) -> Array:
   """Calculates targets for various off-policy correction algorithms.
 
@@ -364,12 +779,17 @@ def general_off_policy_returns_from_action_values(
     pi_t: target policy probs at times [1, ..., K - 1].
     stop_target_gradients: bool indicating whether or not to apply stop gradient
       to targets.
+    time_major: if True, all sequences have an additional batch dimension after
+      the time dimension, e.g. `q_t` has shape `[K, B, A]` and `r_t` `[K, B]`.
 
   Returns:
     Off-policy estimates of the generalized returns from states visited at times
     [0, ..., K - 1].
   """
-  chex.assert_rank([q_t, a_t, r_t, discount_t, c_t, pi_t], [2, 1, 1, 1, 1, 2])
+  seq_rank = 2 if time_major else 1
+  chex.assert_rank([q_t, a_t, r_t, discount_t, c_t, pi_t],
+                   [seq_rank + 1, seq_rank, seq_rank, seq_rank, seq_rank,
+                    seq_rank + 1])
   chex.assert_type([q_t, a_t, r_t, discount_t, c_t, pi_t],
                    [float, int, float, float, float, float])
   chex.assert_equal_shape(
@@ -383,7 +803,7 @@ def general_off_policy_returns_from_action_values(
   c_t = c_t[:-1]
 
   return general_off_policy_returns_from_q_and_v(
-      q_a_t, exp_q_t, r_t, discount_t, c_t, stop_target_gradients)
+      q_a_t, exp_q_t, r_t, discount_t, c_t, stop_target_gradients, time_major)
 
 
 def general_off_policy_returns_from_q_and_v(
@@ -393,6 +813,7 @@ def general_off_policy_returns_from_q_and_v(
     discount_t: Array,
     c_t: Array,
     stop_target_gradients: bool = False,
+    time_major: bool = False,
 ) -> Array:
   """Calculates targets for various off-policy evaluation algorithms.
 
@@ -421,24 +842,24 @@ def general_off_policy_returns_from_q_and_v(
     c_t: weights at times [1, ..., K - 1].
     stop_target_gradients: bool indicating whether or not to apply stop gradient
       to targets.
+    time_major: if True, all sequences have shape `[K, B]` (`[K-1, B]` for `q_t`
+      and `c_t`), and the returns of the whole batch are computed in one scan.
 
   Returns:
     Off-policy estimates of the generalized returns from states visited at times
     [0, ..., K - 1].
   """
-  chex.assert_rank([q_t, v_t, r_t, discount_t, c_t], 1)
+  chex.assert_rank([q_t, v_t, r_t, discount_t, c_t], 2 if time_major else 1)
   chex.assert_type([q_t, v_t, r_t, discount_t, c_t], float)
   chex.assert_equal_shape([q_t, v_t[:-1], r_t[:-1], discount_t[:-1], c_t])
 
   g = r_t[-1] + discount_t[-1] * v_t[-1]  # G_K-1.
 
-  def _body(acc, xs):
-    reward, discount, c, v, q = xs
-    acc = reward + discount * (v - c * q + c * acc)
-    return acc, acc
-
-  _, returns = jax.lax.scan(
-      _body, g, (r_t[:-1], discount_t[:-1], c_t, v_t[:-1], q_t), reverse=True)
+  # Work backwards to compute `G_{K-2}`, ..., `G_0`.
+  returns = base.reverse_linear_recurrence(
+      a_t=discount_t[:-1] * c_t,
+      b_t=r_t[:-1] + discount_t[:-1] * (v_t[:-1] - c_t * q_t),
+      x_bootstrap=g)
   returns = jnp.concatenate([returns, g[jnp.newaxis]], axis=0)
 
   return jax.lax.select(stop_target_gradients,
@@ -52,6 +52,83 @@ class LambdaReturnsTest(parameterized.TestCase):
     # Test return estimate.
     np.testing.assert_allclose(self.expected, actual, rtol=1e-5)
 
+  @chex.all_variants()
+  def test_lambda_returns_associative_batch(self):
+    """Tests the associative scan matches the expected returns."""
+    lambda_returns = self.variant(jax.vmap(functools.partial(
+        multistep.lambda_returns, lambda_=self.lambda_, method='associative')))
+    actual = lambda_returns(self.r_t, self.discount_t, self.v_t)
+    np.testing.assert_allclose(self.expected, actual, rtol=1e-5)
+
+  @chex.all_variants()
+  @parameterized.named_parameters(
+      ('short', 1), ('odd', 7), ('long', 64))
+  def test_associative_matches_scan(self, seq_len):
+    """Tests both methods agree on random sequences of different lengths."""
+    r_t, discount_t, v_t, lambda_ = np.random.RandomState(seq_len).uniform(
+        size=(4, seq_len)).astype(np.float32)
+    scan = self.variant(functools.partial(
+        multistep.lambda_returns, method='scan'))
+    associative = self.variant(functools.partial(
+        multistep.lambda_returns, method='associative'))
+    np.testing.assert_allclose(
+        scan(r_t, discount_t, v_t, lambda_),
+        associative(r_t, discount_t, v_t, lambda_), rtol=1e-5)
+
+  def test_unknown_method_raises(self):
+    with self.assertRaises(ValueError):
+      multistep.lambda_returns(
+          self.r_t[0], self.discount_t[0], self.v_t[0], method='unknown')
+
+  @chex.all_variants()
+  def test_gradients_match_associative(self):
+    """Tests scan gradients against autodiff through the associative scan."""
+    inputs = np.random.RandomState(0).uniform(size=(4, 17)).astype(np.float32)
+
+    def loss(method):
+      return lambda *args: jnp.sum(jnp.sin(multistep.lambda_returns(
+          *args, method=method)))
+
+    expected = jax.grad(loss('associative'), argnums=(0, 1, 2, 3))(*inputs)
+    actual = self.variant(
+        jax.grad(loss('scan'), argnums=(0, 1, 2, 3)))(*inputs)
+    for x, y in zip(expected, actual):
+      np.testing.assert_allclose(x, y, rtol=1e-5, atol=1e-5)
+
+
+class LambdaReturnsBankTest(parameterized.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    rng = np.random.RandomState(0)
+    self.r_t = rng.normal(size=12).astype(np.float32)
+    self.discount_t = rng.choice([0., 1.], size=12).astype(np.float32)
+    self.v_t = rng.normal(size=(12, 5)).astype(np.float32)
+    self.gammas = np.array([0.9, 0.95, 0.99, 0.997, 1.], dtype=np.float32)
+    self.lambdas = np.array([0., 0.5, 0.8, 0.95, 1.], dtype=np.float32)
+
+  @chex.all_variants()
+  @parameterized.named_parameters(
+      ('scan', 'scan'), ('associative', 'associative'))
+  def test_matches_separate_calls(self, method):
+    bank = self.variant(functools.partial(
+        multistep.lambda_returns_bank, method=method))
+    actual = bank(self.r_t, self.discount_t, self.v_t, self.gammas,
+                  self.lambdas)
+    for k, (gamma, lambda_) in enumerate(zip(self.gammas, self.lambdas)):
+      expected = multistep.lambda_returns(
+          self.r_t, self.discount_t * gamma, self.v_t[:, k], lambda_)
+      np.testing.assert_allclose(expected, actual[:, k], rtol=1e-5, atol=1e-6)
+
+  @chex.all_variants()
+  def test_reduces_to_discounted_returns(self):
+    bank = self.variant(multistep.lambda_returns_bank)
+    actual = bank(self.r_t, self.discount_t, self.v_t, self.gammas)
+    for k, gamma in enumerate(self.gammas):
+      expected = multistep.discounted_returns(
+          self.r_t, self.discount_t * gamma, self.v_t[-1, k])
+      np.testing.assert_allclose(expected, actual[:, k], rtol=1e-5, atol=1e-6)
+
 
 class DiscountedReturnsTest(parameterized.TestCase):
 
@@ -119,6 +196,38 @@ class NStepBootstrappedReturnsTest(parameterized.TestCase):
     # Test return estimate.
     np.testing.assert_allclose(self.expected[n], actual, rtol=1e-5)
 
+  @chex.all_variants()
+  @parameterized.named_parameters(
+      ('n_1_scalar_lambda', 1, False),
+      ('n_4_scalar_lambda', 4, False),
+      ('n_4_vector_lambda', 4, True),
+      ('n_13_vector_lambda', 13, True),
+      ('n_20_vector_lambda', 20, True),
+      ('n_larger_than_sequence', 40, True))
+  def test_matches_unrolled_recursion(self, n, vector_lambda):
+    """Tests against iterating the recursion `n` times from each timestep."""
+    seq_len = 29
+    rng = np.random.RandomState(n)
+    r_t, v_t = rng.normal(size=(2, seq_len)).astype(np.float32)
+    discount_t = rng.choice([0., 0.5, 0.9, 1.], size=seq_len).astype(
+        np.float32)
+    lambda_t = rng.uniform(size=seq_len).astype(np.float32)
+    if not vector_lambda:
+      lambda_t = np.float32(0.8)
+    lambdas = np.ones_like(discount_t) * lambda_t
+    expected = np.zeros_like(r_t)
+    for t in range(seq_len):
+      end = min(t + n, seq_len) - 1
+      g = v_t[end]
+      for k in reversed(range(t, end + 1)):
+        g = r_t[k] + discount_t[k] * ((1. - lambdas[k]) * v_t[k] +
+                                      lambdas[k] * g)
+      expected[t] = g
+    n_step_returns = self.variant(functools.partial(
+        multistep.n_step_bootstrapped_returns, n=n))
+    actual = n_step_returns(r_t, discount_t, v_t, lambda_t=lambda_t)
+    np.testing.assert_allclose(expected, actual, rtol=1e-5, atol=1e-5)
+
   def test_reduces_to_lambda_returns(self):
     """Test function is the same as lambda_returns when n is sequence length."""
     lambda_t = 0.75
@@ -253,6 +362,366 @@ class TruncatedGeneralizedAdvantageEstimationTest(parameterized.TestCase):
         self.v_t)
     np.testing.assert_allclose(gae_result, ictd_errors_result, atol=1e-3)
 
+
+class TruncatedGeneralizedAdvantageEstimationAndTargetsTest(
+    parameterized.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    rng = np.random.RandomState(0)
+    self.r_t = rng.normal(size=(10, 4)).astype(np.float32)
+    self.discount_t = rng.choice([0., 0.99], size=(10, 4)).astype(np.float32)
+    self.values = rng.normal(size=(11, 4)).astype(np.float32)
+
+  @chex.all_variants()
+  def test_matches_separate_ops(self):
+    fn = self.variant(functools.partial(
+        multistep.truncated_generalized_advantage_estimation_and_targets,
+        normalize_advantages=True, time_major=True))
+    actual = fn(self.r_t, self.discount_t, 0.95, self.values)
+    advantages = jax.vmap(
+        multistep.truncated_generalized_advantage_estimation,
+        in_axes=(1, 1, None, 1), out_axes=1)(
+            self.r_t, self.discount_t, 0.95, self.values)
+    np.testing.assert_allclose(advantages, actual.advantages, rtol=1e-5)
+    np.testing.assert_allclose(
+        advantages + self.values[:-1], actual.value_targets, rtol=1e-5)
+    np.testing.assert_allclose(
+        (advantages - advantages.mean()) / (advantages.std() + 1e-8),
+        actual.normalized_advantages, rtol=1e-4, atol=1e-5)
+
+  @chex.all_variants()
+  @parameterized.named_parameters(
+      ('stop_target_gradients', True), ('no_stop_target_gradients', False))
+  def test_gradients_match_separate_ops(self, stop_target_gradients):
+    """Tests gradients through the value targets match the unfused ops."""
+    def fused_loss(values):
+      outputs = (
+          multistep.truncated_generalized_advantage_estimation_and_targets(
+              self.r_t, self.discount_t, 0.95, values,
+              stop_target_gradients=stop_target_gradients, time_major=True))
+      return jnp.sum(outputs.advantages + outputs.value_targets)
+
+    def separate_loss(values):
+      advantages = jax.vmap(
+          functools.partial(
+              multistep.truncated_generalized_advantage_estimation,
+              stop_target_gradients=stop_target_gradients),
+          in_axes=(1, 1, None, 1), out_axes=1)(
+              self.r_t, self.discount_t, 0.95, values)
+      value_targets = advantages + values[:-1]
+      if stop_target_gradients:
+        value_targets = jax.lax.stop_gradient(value_targets)
+      return jnp.sum(advantages + value_targets)
+
+    expected = jax.grad(separate_loss)(self.values)
+    actual = self.variant(jax.grad(fused_loss))(self.values)
+    np.testing.assert_allclose(expected, actual, rtol=1e-5, atol=1e-6)
+
+  def test_no_normalization(self):
+    actual = multistep.truncated_generalized_advantage_estimation_and_targets(
+        self.r_t[:, 0], self.discount_t[:, 0], 0.95, self.values[:, 0])
+    self.assertIsNone(actual.normalized_advantages)
+
+  @chex.all_variants()
+  def test_normalizes_across_mapped_axis(self):
+    """Tests normalizing over an axis gives global mean and variance."""
+    fn = functools.partial(
+        multistep.truncated_generalized_advantage_estimation_and_targets,
+        normalize_advantages=True, axis_name='batch')
+    # Each batch element is mapped over separately.
+    mapped = self.variant(jax.vmap(fn, in_axes=(1, 1, None, 1), out_axes=1,
+                                   axis_name='batch'))
+    actual = mapped(self.r_t, self.discount_t, 0.95, self.values)
+    expected = fn(self.r_t, self.discount_t, 0.95, self.values,
+                  axis_name=None, time_major=True)
+    np.testing.assert_allclose(
+        expected.normalized_advantages, actual.normalized_advantages,
+        rtol=1e-4, atol=1e-5)
+
+
+class GeneralOffPolicyReturnsFromQAndVTest(parameterized.TestCase):
+
+  @chex.all_variants()
+  def test_gradients_match_unrolled_recursion(self):
+    """Tests values and gradients against an unrolled recursion."""
+    rng = np.random.RandomState(0)
+    q_t, c_t = rng.uniform(size=(2, 6)).astype(np.float32)
+    v_t, r_t, discount_t = rng.uniform(size=(3, 7)).astype(np.float32)
+
+    def unrolled(q_t, v_t, r_t, discount_t, c_t):
+      g = r_t[-1] + discount_t[-1] * v_t[-1]
+      returns = [g]
+      for t in reversed(range(len(q_t))):
+        g = r_t[t] + discount_t[t] * (v_t[t] - c_t[t] * q_t[t] + c_t[t] * g)
+        returns.append(g)
+      return jnp.stack(returns[::-1])
+
+    def loss(f):
+      return lambda *args: jnp.sum(jnp.sin(f(*args)))
+
+    args = (q_t, v_t, r_t, discount_t, c_t)
+    np.testing.assert_allclose(
+        unrolled(*args),
+        self.variant(multistep.general_off_policy_returns_from_q_and_v)(*args),
+        rtol=1e-5)
+    expected = jax.grad(loss(unrolled), argnums=(0, 1, 2, 3, 4))(*args)
+    actual = self.variant(jax.grad(
+        loss(multistep.general_off_policy_returns_from_q_and_v),
+        argnums=(0, 1, 2, 3, 4)))(*args)
+    for x, y in zip(expected, actual):
+      np.testing.assert_allclose(x, y, rtol=1e-5, atol=1e-5)
+
+
+class ChunkedTest(parameterized.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    rng = np.random.RandomState(0)
+    self.seq_len = 23
+    self.r_t = rng.normal(size=self.seq_len).astype(np.float32)
+    self.discount_t = rng.choice(
+        [0., 0.9, 1.], size=self.seq_len).astype(np.float32)
+    self.lambda_t = rng.uniform(size=self.seq_len).astype(np.float32)
+    self.values = rng.normal(size=self.seq_len + 1).astype(np.float32)
+
+  @chex.all_variants()
+  @parameterized.named_parameters(
+      ('one_chunk', 23), ('even_chunks', 1), ('uneven_chunks', 5))
+  def test_lambda_returns(self, chunk_size):
+    """Tests processing chunks back to front matches the one-shot call."""
+    v_t = self.values[1:]
+    expected = self.variant(multistep.lambda_returns)(
+        self.r_t, self.discount_t, v_t, self.lambda_t)
+    chunked_lambda_returns = self.variant(multistep.chunked_lambda_returns)
+    carry, chunks = None, []
+    for start in reversed(range(0, self.seq_len, chunk_size)):
+      end = start + chunk_size
+      returns, carry = chunked_lambda_returns(
+          self.r_t[start:end], self.discount_t[start:end], v_t[start:end],
+          self.lambda_t[start:end], carry)
+      chunks.insert(0, returns)
+    np.testing.assert_array_equal(expected, np.concatenate(chunks))
+
+  @chex.all_variants()
+  @parameterized.named_parameters(
+      ('one_chunk', 23), ('even_chunks', 1), ('uneven_chunks', 5))
+  def test_truncated_generalized_advantage_estimation(self, chunk_size):
+    """Tests processing chunks back to front matches the one-shot call."""
+    expected = self.variant(
+        multistep.truncated_generalized_advantage_estimation)(
+            self.r_t, self.discount_t, self.lambda_t, self.values)
+    chunked_gae = self.variant(
+        multistep.chunked_truncated_generalized_advantage_estimation)
+    carry, chunks = None, []
+    for start in reversed(range(0, self.seq_len, chunk_size)):
+      end = start + chunk_size
+      advantages, carry = chunked_gae(
+          self.r_t[start:end], self.discount_t[start:end],
+          self.lambda_t[start:end], self.values[start:end + 1], carry)
+      chunks.insert(0, advantages)
+    np.testing.assert_array_equal(expected, np.concatenate(chunks))
+
+
+class SegmentIdsTest(parameterized.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    rng = np.random.RandomState(0)
+    self.seq_len = 23
+    self.r_t = rng.normal(size=self.seq_len).astype(np.float32)
+    self.discount_t = rng.choice(
+        [0., 0.9, 1.], size=self.seq_len).astype(np.float32)
+    self.lambda_t = rng.uniform(size=self.seq_len).astype(np.float32)
+    self.values = rng.normal(size=self.seq_len + 1).astype(np.float32)
+    # Four episodes of lengths 5, 1, 8 and 9, packed end to end.
+    self.boundaries = [0, 5, 6, 14, 23]
+    self.segment_ids = np.repeat(np.arange(4), np.diff(self.boundaries))
+
+  @chex.all_variants()
+  @parameterized.named_parameters(
+      ('scan', 'scan'), ('associative', 'associative'))
+  def test_lambda_returns(self, method):
+    """Tests packed episodes match separate calls on each episode."""
+    v_t = self.values[1:]
+    lambda_returns = self.variant(functools.partial(
+        multistep.lambda_returns, method=method))
+    actual = lambda_returns(self.r_t, self.discount_t, v_t, self.lambda_t,
+                            segment_ids=self.segment_ids)
+    for start, end in zip(self.boundaries[:-1], self.boundaries[1:]):
+      expected = multistep.lambda_returns(
+          self.r_t[start:end], self.discount_t[start:end], v_t[start:end],
+          self.lambda_t[start:end])
+      np.testing.assert_allclose(expected, actual[start:end], rtol=1e-5)
+
+  @chex.all_variants()
+  def test_lambda_returns_time_major(self):
+    """Tests each batch entry is reset at its own episode boundaries."""
+    v_t = self.values[1:]
+    stack = lambda x: np.stack([x, x[::-1]], axis=1)
+    segment_ids = stack(self.segment_ids)
+    actual = self.variant(functools.partial(
+        multistep.lambda_returns, time_major=True))(
+            stack(self.r_t), stack(self.discount_t), stack(v_t),
+            stack(self.lambda_t), segment_ids=segment_ids)
+    expected = jax.vmap(multistep.lambda_returns)(
+        stack(self.r_t).T, stack(self.discount_t).T, stack(v_t).T,
+        stack(self.lambda_t).T, segment_ids=segment_ids.T)
+    np.testing.assert_allclose(expected, actual.T, rtol=1e-5)
+
+  @chex.all_variants()
+  @parameterized.named_parameters(
+      ('truncated', True), ('terminated', False))
+  def test_truncated_generalized_advantage_estimation(self, truncated):
+    """Tests packed episodes match separate calls on each episode."""
+    rng = np.random.RandomState(1)
+    # Each episode has its own values, including its own bootstrap value.
+    episode_values = [
+        rng.normal(size=end - start + 1).astype(np.float32)
+        for start, end in zip(self.boundaries[:-1], self.boundaries[1:])]
+    values = np.concatenate([v[:-1] for v in episode_values] +
+                            [episode_values[-1][-1:]])
+    bootstrap_values = np.zeros_like(self.r_t)
+    for end, v in zip(self.boundaries[1:], episode_values):
+      bootstrap_values[end - 1] = v[-1]
+    gae = self.variant(multistep.truncated_generalized_advantage_estimation)
+    actual = gae(self.r_t, self.discount_t, self.lambda_t, values,
+                 segment_ids=self.segment_ids,
+                 bootstrap_values=bootstrap_values if truncated else None)
+    for i, (start, end) in enumerate(
+        zip(self.boundaries[:-1], self.boundaries[1:])):
+      discount_t = self.discount_t[start:end].copy()
+      if not truncated and i < len(episode_values) - 1:
+        discount_t[-1] = 0.
+      expected = multistep.truncated_generalized_advantage_estimation(
+          self.r_t[start:end], discount_t, self.lambda_t[start:end],
+          episode_values[i])
+      np.testing.assert_allclose(expected, actual[start:end], rtol=1e-5)
+
+  def test_bootstrap_values_require_segment_ids(self):
+    with self.assertRaises(ValueError):
+      multistep.truncated_generalized_advantage_estimation(
+          self.r_t, self.discount_t, self.lambda_t, self.values,
+          bootstrap_values=self.r_t)
+
+
+class TimeShardedLambdaReturnsTest(parameterized.TestCase):
+
+  @chex.all_variants()
+  @parameterized.named_parameters(
+      ('one_shard', 1, False), ('four_shards', 4, False),
+      ('four_shards_time_major', 4, True))
+  def test_matches_lambda_returns(self, num_shards, time_major):
+    """Tests sharding time along a mapped axis matches the one-shot call."""
+    shape = (24, 3) if time_major else (24,)
+    rng = np.random.RandomState(0)
+    r_t, v_t, lambda_t = rng.uniform(size=(3,) + shape).astype(np.float32)
+    discount_t = rng.choice([0., 0.9, 1.], size=shape).astype(np.float32)
+    expected = multistep.lambda_returns(
+        r_t, discount_t, v_t, lambda_t, time_major=time_major)
+    # Map over time shards with `vmap`, which supports the same collectives.
+    sharded_fn = self.variant(jax.vmap(functools.partial(
+        multistep.time_sharded_lambda_returns, axis_name='time',
+        time_major=time_major), axis_name='time'))
+    shard = lambda x: x.reshape((num_shards, -1) + x.shape[1:])
+    actual = sharded_fn(
+        shard(r_t), shard(discount_t), shard(v_t), shard(lambda_t))
+    np.testing.assert_allclose(
+        expected, actual.reshape(shape), rtol=1e-5, atol=1e-6)
+
+
+class TimeMajorTest(parameterized.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    rng = np.random.RandomState(0)
+    self.seq_len, self.batch_size, self.num_actions = 9, 4, 3
+    shape = (self.seq_len, self.batch_size)
+    self.r_t = rng.normal(size=shape).astype(np.float32)
+    self.discount_t = rng.choice([0., 0.9, 1.], size=shape).astype(np.float32)
+    self.lambda_t = rng.uniform(size=shape).astype(np.float32)
+    self.c_t = rng.uniform(size=shape).astype(np.float32)
+    self.values = rng.normal(size=(self.seq_len + 1,) + shape[1:]).astype(
+        np.float32)
+    self.q_t = rng.normal(size=shape + (self.num_actions,)).astype(np.float32)
+    self.pi_t = jax.nn.softmax(
+        rng.normal(size=shape + (self.num_actions,)).astype(np.float32))
+    self.a_t = rng.randint(self.num_actions, size=shape).astype(np.int32)
+
+  @chex.all_variants()
+  @parameterized.named_parameters(
+      ('scan', 'scan'), ('associative', 'associative'))
+  def test_lambda_returns(self, method):
+    args = (self.r_t, self.discount_t, self.values[1:], self.lambda_t)
+    expected = jax.vmap(
+        multistep.lambda_returns, in_axes=1, out_axes=1)(*args)
+    actual = self.variant(functools.partial(
+        multistep.lambda_returns, method=method, time_major=True))(*args)
+    np.testing.assert_allclose(expected, actual, rtol=1e-5, atol=1e-6)
+
+  @chex.all_variants()
+  @parameterized.named_parameters(('unrolled', 4), ('sliding_window', 20))
+  def test_n_step_bootstrapped_returns(self, n):
+    # Repeat the sequences so that they are longer than `n`.
+    tile = lambda x: np.concatenate([x] * 3)
+    args = (tile(self.r_t), tile(self.discount_t), tile(self.values[1:]))
+    lambda_t = tile(self.lambda_t)
+    n_step_returns = functools.partial(
+        multistep.n_step_bootstrapped_returns, n=n)
+    expected = jax.vmap(
+        lambda r, d, v, l: n_step_returns(r, d, v, lambda_t=l),
+        in_axes=1, out_axes=1)(*args, lambda_t)
+    actual = self.variant(functools.partial(
+        n_step_returns, time_major=True))(*args, lambda_t=lambda_t)
+    np.testing.assert_allclose(expected, actual, rtol=1e-5, atol=1e-6)
+
+  @chex.all_variants()
+  def test_discounted_returns(self):
+    args = (self.r_t, self.discount_t, self.values[-1])
+    expected = jax.vmap(
+        multistep.discounted_returns, in_axes=(1, 1, 0), out_axes=1)(*args)
+    actual = self.variant(functools.partial(
+        multistep.discounted_returns, time_major=True))(*args)
+    np.testing.assert_allclose(expected, actual, rtol=1e-5, atol=1e-6)
+
+  @chex.all_variants()
+  def test_truncated_generalized_advantage_estimation(self):
+    args = (self.r_t, self.discount_t, self.lambda_t, self.values)
+    expected = jax.vmap(
+        multistep.truncated_generalized_advantage_estimation,
+        in_axes=1, out_axes=1)(*args)
+    actual = self.variant(functools.partial(
+        multistep.truncated_generalized_advantage_estimation,
+        time_major=True))(*args)
+    np.testing.assert_allclose(expected, actual, rtol=1e-5, atol=1e-6)
+
+  @chex.all_variants()
+  def test_importance_corrected_td_errors(self):
+    args = (self.r_t, self.discount_t, self.c_t, self.lambda_t, self.values)
+    expected = jax.vmap(
+        multistep.importance_corrected_td_errors, in_axes=1, out_axes=1)(*args)
+    actual = self.variant(functools.partial(
+        multistep.importance_corrected_td_errors, time_major=True))(*args)
+    np.testing.assert_allclose(expected, actual, rtol=1e-5, atol=1e-6)
+
+  @chex.all_variants()
+  def test_general_off_policy_returns_from_action_values(self):
+    args = (self.q_t, self.a_t, self.r_t, self.discount_t, self.c_t, self.pi_t)
+    expected = jax.vmap(
+        multistep.general_off_policy_returns_from_action_values,
+        in_axes=1, out_axes=1)(*args)
+    actual = self.variant(functools.partial(
+        multistep.general_off_policy_returns_from_action_values,
+        time_major=True))(*args)
+    np.testing.assert_allclose(expected, actual, rtol=1e-5, atol=1e-6)
+
+  def test_rank_one_inputs_raise(self):
+    with self.assertRaises(AssertionError):
+      multistep.lambda_returns(
+          self.r_t[:, 0], self.discount_t[:, 0], self.values[1:, 0],
+          time_major=True)
+
+
 if __name__ == '__main__':
   jax.config.update('jax_numpy_rank_promotion', 'raise')
   absltest.main()
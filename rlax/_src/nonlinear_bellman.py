@@ -32,6 +32,7 @@ import jax.numpy as jnp
 from rlax._src import base
 from rlax._src import multistep
 from rlax._src import transforms
+from rlax._src import value_learning
 
 Array = chex.Array
 TxPair = collections.namedtuple('TxPair', ['apply', 'apply_inv'])
@@ -268,6 +269,73 @@ def transformed_retrace(
   return target_tm1 - q_a_tm1
 
 
+def transformed_retrace_sparse(
+    q_tm1: Array,
+    q_t: Array,
+    a_tm1: Array,
+    a_t: Array,
+    r_t: Array,
+    discount_t: Array,
+    pi_indices_t: Array,
+    pi_probs_t: Array,
+    mu_t: Array,
+    lambda_: float,
+    eps: float = 1e-8,
+    stop_target_gradients: bool = True,
+    tx_pair: TxPair = IDENTITY_PAIR,
+) -> Array:
+  """Calculates transformed Retrace errors for a sparse target policy.
+
+  The target policy at each step is given by the `K` actions it supports and
+  their probabilities, e.g. `K = 1` for a greedy policy. The inverse transform
+  `tx_pair.apply_inv` is then only applied to the Q-values that the returns
+  consume: those of the supported actions, and of the actions taken at times
+  [1, T - 1], rather than to the whole `[T, A]` tensor `q_t`.
+
+  See "Recurrent Experience Replay in Distributed Reinforcement Learning" by
+  Kapturowski et al. (https://openreview.net/pdf?id=r1lyTjAqYX).
+
+  Args:
+    q_tm1: Q-values at time t-1.
+    q_t: Q-values at time t.
+    a_tm1: action index at time t-1.
+    a_t: action index at time t.
+    r_t: reward at time t.
+    discount_t: discount at time t.
+    pi_indices_t: indices of the `K` actions supported by the target policy at
+      time t, of shape `[T, K]`.
+    pi_probs_t: target policy probs of the actions `pi_indices_t` at time t.
+    mu_t: behavior policy probs at time t.
+    lambda_: scalar mixing parameter lambda.
+    eps: small value to add to mu_t for numerical stability.
+    stop_target_gradients: bool indicating whether or not to apply stop gradient
+      to targets.
+    tx_pair: TxPair of value function transformation and its inverse.
+
+  Returns:
+    Transformed Retrace error.
+  """
+  chex.assert_rank(
+      [q_tm1, q_t, a_tm1, a_t, r_t, discount_t, pi_indices_t, pi_probs_t, mu_t],
+      [2, 2, 1, 1, 1, 1, 2, 2, 1])
+  chex.assert_type(
+      [q_tm1, q_t, a_tm1, a_t, r_t, discount_t, pi_indices_t, pi_probs_t, mu_t],
+      [float, float, int, int, float, float, int, float, float])
+  chex.assert_equal_shape([pi_indices_t, pi_probs_t])
+
+  # Only invert the transform on the Q-values the returns depend on.
+  q_a_t = tx_pair.apply_inv(base.batched_index(q_t[:-1], a_t[:-1]))
+  exp_q_t = base.sparse_expectation(
+      pi_indices_t, pi_probs_t, q_t, value_fn=tx_pair.apply_inv)
+  pi_a_t = base.sparse_probs_of_actions(
+      pi_indices_t[:-1], pi_probs_t[:-1], a_t[:-1])
+  # pylint: disable-next=protected-access
+  return value_learning._retrace_from_action_values(
+      q_tm1, a_tm1, q_a_t, pi_a_t, exp_q_t, r_t, discount_t, mu_t, lambda_,
+      eps, stop_target_gradients, time_major=False, segment_ids=None,
+      target_fn=tx_pair.apply)
+
+
 def transformed_n_step_q_learning(
     q_tm1: Array,
     a_tm1: Array,
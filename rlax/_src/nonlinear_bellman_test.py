@@ -237,6 +237,50 @@ class TransformedRetraceTest(parameterized.TestCase):
     # Test output.
     np.testing.assert_allclose(self.expected_td[td_index], actual_td, rtol=1e-3)
 
+  @chex.all_variants()
+  @parameterized.named_parameters(
+      ('identity0', nonlinear_bellman.IDENTITY_PAIR, 0),
+      ('signed_logp11', nonlinear_bellman.SIGNED_LOGP1_PAIR, 1),
+      ('signed_hyperbolic2', nonlinear_bellman.SIGNED_HYPERBOLIC_PAIR, 2),
+      ('hyperbolic_sin3', nonlinear_bellman.HYPERBOLIC_SIN_PAIR, 3))
+  def test_transformed_retrace_sparse_batch(self, tx_pair, td_index):
+    """Tests a target policy given by its support matches the dense one."""
+    transformed_retrace_sparse = self.variant(jax.vmap(functools.partial(
+        nonlinear_bellman.transformed_retrace_sparse,
+        tx_pair=tx_pair, lambda_=self._lambda)))
+    # List the support of the target policy in reverse order.
+    pi_indices = np.broadcast_to(
+        np.array([1, 0], dtype=np.int32), self._target_policy_probs.shape)
+    pi_probs = self._target_policy_probs[..., ::-1]
+    actual_td = transformed_retrace_sparse(
+        self._qs[:, :-1], self._targnet_qs[:, 1:], self._actions[:, :-1],
+        self._actions[:, 1:], self._rewards[:, :-1], self._pcontinues[:, :-1],
+        pi_indices[:, 1:], pi_probs[:, 1:], self._behavior_policy_probs[:, 1:])
+    np.testing.assert_allclose(self.expected_td[td_index], actual_td, rtol=1e-3)
+
+  @chex.all_variants()
+  def test_transformed_retrace_sparse_greedy(self):
+    """Tests a greedy target policy given by a single action."""
+    tx_pair = nonlinear_bellman.SIGNED_HYPERBOLIC_PAIR
+    transformed_retrace = jax.vmap(functools.partial(
+        nonlinear_bellman.transformed_retrace,
+        tx_pair=tx_pair, lambda_=self._lambda))
+    transformed_retrace_sparse = self.variant(jax.vmap(functools.partial(
+        nonlinear_bellman.transformed_retrace_sparse,
+        tx_pair=tx_pair, lambda_=self._lambda)))
+    greedy_actions = np.argmax(self._targnet_qs, axis=-1).astype(np.int32)
+    greedy_probs = np.eye(2, dtype=np.float32)[greedy_actions]
+    inputs = (
+        self._qs[:, :-1], self._targnet_qs[:, 1:], self._actions[:, :-1],
+        self._actions[:, 1:], self._rewards[:, :-1], self._pcontinues[:, :-1])
+    expected_td = transformed_retrace(
+        *inputs, greedy_probs[:, 1:], self._behavior_policy_probs[:, 1:])
+    actual_td = transformed_retrace_sparse(
+        *inputs, greedy_actions[:, 1:, None],
+        np.ones_like(greedy_actions[:, 1:, None], dtype=np.float32),
+        self._behavior_policy_probs[:, 1:])
+    np.testing.assert_allclose(expected_td, actual_td, rtol=1e-5)
+
 
 if __name__ == '__main__':
   jax.config.update('jax_numpy_rank_promotion', 'raise')
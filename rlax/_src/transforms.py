@@ -18,6 +18,8 @@ This is a collection of element-wise non-linear transformations that may be
 used to transform losses, value estimates, or other multidimensional data.
 """
 
+from typing import Tuple
+
 import chex
 import jax
 import jax.numpy as jnp
@@ -109,6 +111,87 @@ def transform_to_2hot(
   return lower_one_hot + upper_one_hot
 
 
+def transform_to_2hot_sparse(
+    scalar: Array,
+    min_value: float,
+    max_value: float,
+    num_bins: int) -> Tuple[Array, Array]:
+  """Transforms a scalar tensor to a sparse 2 hot representation.
+
+  The 2 hot representation of `transform_to_2hot` has at most two non-zero
+  entries, at adjacent bins. This returns them as the index of the lower bin
+  and its probability, the upper bin `lower_index + 1` holding the rest of the
+  mass, without materializing tensors of shape `[..., num_bins]`.
+
+  Args:
+    scalar: values to transform.
+    min_value: value of the first bin.
+    max_value: value of the last bin.
+    num_bins: number of evenly spaced bins.
+
+  Returns:
+    A tuple `(lower_index, p_lower)` of arrays with the shape of `scalar`, with
+    `lower_index` in `[0, num_bins - 2]`.
+  """
+  scalar = jnp.clip(scalar, min_value, max_value)
+  scalar_bin = (scalar - min_value) / (max_value - min_value) * (num_bins - 1)
+  lower = jnp.clip(jnp.floor(scalar_bin), 0, num_bins - 2)
+  p_lower = 1. - (scalar_bin - lower)
+  return lower.astype(jnp.int32), p_lower
+
+
+def sparse_2hot_cross_entropy(
+    logits: Array,
+    lower_index: Array,
+    p_lower: Array) -> Array:
+  """Cross-entropy between logits and a sparse 2 hot target distribution.
+
+  Only the two logits of the target's bins are gathered, so that neither the
+  dense target nor the log-probabilities need to be materialized.
+
+  Args:
+    logits: logits over bins, of shape `[..., num_bins]`.
+    lower_index: index of the lower bin of the targets, of shape `[...]`.
+    p_lower: probability of the lower bin of the targets, of shape `[...]`.
+
+  Returns:
+    The cross-entropy of each element, of shape `[...]`.
+  """
+  chex.assert_equal_shape([logits[..., 0], lower_index, p_lower])
+  indices = jnp.stack([lower_index, lower_index + 1], axis=-1)
+  lower_logit, upper_logit = jnp.moveaxis(
+      jnp.take_along_axis(logits, indices, axis=-1), -1, 0)
+  target_logit = p_lower * lower_logit + (1. - p_lower) * upper_logit
+  return jax.nn.logsumexp(logits, axis=-1) - target_logit
+
+
+def twohot_cross_entropy(
+    logits: Array,
+    scalar: Array,
+    min_value: float,
+    max_value: float,
+    num_bins: int) -> Array:
+  """Cross-entropy between logits and the 2 hot representation of a scalar.
+
+  Equivalent to the cross-entropy against `transform_to_2hot(scalar, ...)`,
+  but fused through the sparse representation of `transform_to_2hot_sparse`.
+
+  Args:
+    logits: logits over bins, of shape `[..., num_bins]`.
+    scalar: target values, of shape `[...]`.
+    min_value: value of the first bin.
+    max_value: value of the last bin.
+    num_bins: number of evenly spaced bins.
+
+  Returns:
+    The cross-entropy of each element, of shape `[...]`.
+  """
+  chex.assert_axis_dimension(logits, -1, num_bins)
+  lower_index, p_lower = transform_to_2hot_sparse(
+      scalar, min_value, max_value, num_bins)
+  return sparse_2hot_cross_entropy(logits, lower_index, p_lower)
+
+
 def transform_from_2hot(
     probs: Array,
     min_value: float,
@@ -121,18 +204,39 @@ def transform_from_2hot(
   return scalar
 
 
+def transform_to_2hot_nonlinear_sparse(
+    scalar: Array, bins: Array) -> Tuple[Array, Array]:
+  """Transforms a scalar tensor to a sparse 2 hot representation using bins.
+
+  The bin of each scalar is found by binary search over the sorted `bins`, in
+  O(log(num_bins)) per element, and the representation is returned as the
+  index of the lower bin and its probability, as in `transform_to_2hot_sparse`.
+
+  Args:
+    scalar: values to transform.
+    bins: sorted values of the bins, of shape `[num_bins]`.
+
+  Returns:
+    A tuple `(lower_index, p_lower)` of arrays with the shape of `scalar`, with
+    `lower_index` in `[0, num_bins - 2]`.
+  """
+  bins = jnp.asarray(bins)
+  scalar = jnp.clip(scalar, bins[0], bins[-1])
+  upper_index = jnp.searchsorted(bins, scalar, side='left')
+  lower_index = jnp.clip(upper_index - 1, 0, len(bins) - 2)
+  upper_value = bins[lower_index + 1]
+  lower_value = bins[lower_index]
+  p_lower = (upper_value - scalar) / (upper_value - lower_value)
+  return lower_index.astype(jnp.int32), p_lower
+
+
 def transform_to_2hot_nonlinear(scalar: Array, bins: Array) -> Array:
   """Transforms a scalar tensor to a 2 hot representation defined using bins."""
-  min_value, max_value = bins[0], bins[-1]
   num_bins = len(bins)
-  scalar = jnp.clip(scalar, min_value, max_value)
-  upper_index = jnp.argmax(scalar[..., None] <= bins.reshape(1, -1), axis=-1)
-  upper_value = bins[upper_index]
-  lower_value = bins[upper_index - 1]
-  p_lower = (upper_value - scalar) / (upper_value - lower_value)
-  p_upper = 1 - p_lower
-  lower_one_hot = jax.nn.one_hot(upper_index - 1, num_bins) * p_lower[..., None]
-  upper_one_hot = jax.nn.one_hot(upper_index, num_bins) * p_upper[..., None]
+  lower_index, p_lower = transform_to_2hot_nonlinear_sparse(scalar, bins)
+  lower_one_hot = jax.nn.one_hot(lower_index, num_bins) * p_lower[..., None]
+  upper_one_hot = (
+      jax.nn.one_hot(lower_index + 1, num_bins) * (1 - p_lower)[..., None])
   return lower_one_hot + upper_one_hot
 
 
@@ -172,6 +172,71 @@ class TransformsTest(parameterized.TestCase):
 
     np.testing.assert_almost_equal(value, restored, decimal=5)
 
+  def test_transform_to_2hot_sparse(self):
+    lower_index, p_lower = transforms.transform_to_2hot_sparse(
+        scalar=jnp.array(TWO_HOT_SCALARS),
+        min_value=-1.0,
+        max_value=1.0,
+        num_bins=TWO_HOT_BINS)
+
+    dense = (jax.nn.one_hot(lower_index, TWO_HOT_BINS) * p_lower[:, None] +
+             jax.nn.one_hot(lower_index + 1, TWO_HOT_BINS) *
+             (1 - p_lower[:, None]))
+    np.testing.assert_allclose(
+        dense, np.array(TWO_HOT_PROBABILITIES), atol=1e-4)
+
+  def test_twohot_cross_entropy(self):
+    num_bins = 11
+    scalar = jnp.array(TWO_HOT_SCALARS)
+    logits = jax.random.normal(
+        jax.random.PRNGKey(0), (len(TWO_HOT_SCALARS), num_bins))
+
+    def dense_cross_entropy(logits):
+      targets = transforms.transform_to_2hot(scalar, -1.0, 1.0, num_bins)
+      return -jnp.sum(targets * jax.nn.log_softmax(logits), axis=-1)
+
+    def fused_cross_entropy(logits):
+      return transforms.twohot_cross_entropy(logits, scalar, -1.0, 1.0,
+                                             num_bins)
+
+    np.testing.assert_allclose(
+        dense_cross_entropy(logits), fused_cross_entropy(logits), atol=1e-4)
+    np.testing.assert_allclose(
+        jax.grad(lambda x: dense_cross_entropy(x).sum())(logits),
+        jax.grad(lambda x: fused_cross_entropy(x).sum())(logits), atol=1e-4)
+
+  def test_transform_to_2hot_nonlinear(self):
+    bins = np.array([-1.0, -0.5, 0.0, 0.8, 1.0], dtype=np.float32)
+    y = transforms.transform_to_2hot_nonlinear(
+        scalar=jnp.array(TWO_HOT_SCALARS), bins=bins)
+
+    expected = np.array([
+        [1.0, 0.0, 0.0, 0.0, 0.0],
+        [1.0, 0.0, 0.0, 0.0, 0.0],
+        [1.0, 0.0, 0.0, 0.0, 0.0],
+        [0.0, 0.8, 0.2, 0.0, 0.0],
+        [0.0, 0.0, 1.0, 0.0, 0.0],
+        [0.0, 0.0, 0.625, 0.375, 0.0],
+        [0.0, 0.0, 0.0, 0.0, 1.0],
+        [0.0, 0.0, 0.0, 0.0, 1.0],
+        [0.0, 0.0, 0.0, 0.0, 1.0]])
+    np.testing.assert_allclose(y, expected, atol=1e-4)
+
+  def test_2hot_nonlinear_sparse_matches_dense(self):
+    bins = np.sinh(np.linspace(-3.0, 3.0, 21)).astype(np.float32)
+    value = np.concatenate(
+        [np.linspace(-12.0, 12.0, 101), bins]).astype(np.float32)
+
+    dense = transforms.transform_to_2hot_nonlinear(value, bins)
+    lower_index, p_lower = transforms.transform_to_2hot_nonlinear_sparse(
+        value, bins)
+    np.testing.assert_allclose(
+        np.take_along_axis(dense, lower_index[:, None], axis=-1)[:, 0],
+        p_lower, atol=1e-6)
+    np.testing.assert_allclose(
+        transforms.transform_from_2hot_nonlinear(dense, bins),
+        np.clip(value, bins[0], bins[-1]), rtol=1e-5, atol=1e-5)
+
 
 if __name__ == '__main__':
   jax.config.update('jax_numpy_rank_promotion', 'raise')
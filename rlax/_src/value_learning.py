@@ -20,18 +20,21 @@ implements a number of functions for value learning in discrete scalar action
 spaces. Actions are assumed to be represented as indices in the range `[0, A)`
 where `A` is the number of distinct actions.
 """
-from typing import Union
+import collections
+from typing import Callable, Optional, Tuple, Union
 import chex
 import jax
 import jax.numpy as jnp
 from rlax._src import base
 from rlax._src import clipping
-from rlax._src import distributions
 from rlax._src import multistep
 
 Array = chex.Array
 Numeric = chex.Numeric
 
+EnsembleStatistics = collections.namedtuple(
+    'EnsembleStatistics', ['mean', 'std', 'disagreement'])
+
 
 def td_learning(
     v_tm1: Numeric,
@@ -72,6 +75,7 @@ def td_lambda(
     v_t: Array,
     lambda_: Numeric,
     stop_target_gradients: bool = True,
+    time_major: bool = False,
 ) -> Array:
   """Calculates the TD(lambda) temporal difference error.
 
@@ -86,13 +90,17 @@ def td_lambda(
     lambda_: mixing parameter lambda, either a scalar or a sequence.
     stop_target_gradients: bool indicating whether or not to apply stop gradient
       to targets.
+    time_major: if True, all sequences have shape `[T, B]`.
   Returns:
     TD(lambda) temporal difference error.
   """
-  chex.assert_rank([v_tm1, r_t, discount_t, v_t, lambda_], [1, 1, 1, 1, {0, 1}])
+  seq_rank = 2 if time_major else 1
+  chex.assert_rank([v_tm1, r_t, discount_t, v_t, lambda_],
+                   [seq_rank] * 4 + [{0, seq_rank}])
   chex.assert_type([v_tm1, r_t, discount_t, v_t, lambda_], float)
 
-  target_tm1 = multistep.lambda_returns(r_t, discount_t, v_t, lambda_)
+  target_tm1 = multistep.lambda_returns(
+      r_t, discount_t, v_t, lambda_, time_major=time_major)
   target_tm1 = jax.lax.select(stop_target_gradients,
                               jax.lax.stop_gradient(target_tm1), target_tm1)
   return target_tm1 - v_tm1
@@ -143,6 +151,7 @@ def expected_sarsa(
     q_t: Array,
     probs_a_t: Array,
     stop_target_gradients: bool = True,
+    legal_actions_mask: Optional[Array] = None,
 ) -> Numeric:
   """Calculates the expected SARSA (SARSE) temporal difference error.
 
@@ -159,6 +168,10 @@ def expected_sarsa(
     probs_a_t: action probabilities at time t.
     stop_target_gradients: bool indicating whether or not to apply stop gradient
       to targets.
+    legal_actions_mask: optional boolean mask of the actions that are legal at
+      time t, with the same shape as `q_t`. At least one action must be legal.
+      Illegal actions are excluded from the expectation, whatever their
+      probability or Q-value.
 
   Returns:
     Expected SARSA temporal difference error.
@@ -168,7 +181,63 @@ def expected_sarsa(
   chex.assert_type([q_tm1, a_tm1, r_t, discount_t, q_t, probs_a_t],
                    [float, int, float, float, float, float])
 
-  target_tm1 = r_t + discount_t * jnp.dot(q_t, probs_a_t)
+  if legal_actions_mask is None:
+    v_t = jnp.dot(q_t, probs_a_t)
+  else:
+    chex.assert_equal_shape([q_t, legal_actions_mask])
+    # Zero illegal Q-values first, as they are often encoded as -inf or NaN.
+    q_t = jnp.where(legal_actions_mask, q_t, 0.)
+    v_t = jnp.sum(q_t * probs_a_t, where=legal_actions_mask)
+  target_tm1 = r_t + discount_t * v_t
+  target_tm1 = jax.lax.select(stop_target_gradients,
+                              jax.lax.stop_gradient(target_tm1), target_tm1)
+  return target_tm1 - q_tm1[a_tm1]
+
+
+def expected_sarsa_sparse(
+    q_tm1: Array,
+    a_tm1: Numeric,
+    r_t: Numeric,
+    discount_t: Numeric,
+    q_t: Array,
+    pi_indices_t: Array,
+    pi_probs_t: Array,
+    stop_target_gradients: bool = True,
+) -> Numeric:
+  """Calculates the expected SARSA error for a policy with sparse support.
+
+  The policy at time t is given by the `K` actions it supports and their
+  probabilities, and the expected value is computed by gathering only the `K`
+  supported Q-values.
+
+  See "A Theoretical and Empirical Analysis of Expected Sarsa" by Seijen,
+  van Hasselt, Whiteson et al.
+  (http://www.cs.ox.ac.uk/people/shimon.whiteson/pubs/vanseijenadprl09.pdf).
+
+  Args:
+    q_tm1: Q-values at time t-1.
+    a_tm1: action index at time t-1.
+    r_t: reward at time t.
+    discount_t: discount at time t.
+    q_t: Q-values at time t.
+    pi_indices_t: indices of the `K` actions supported by the policy at time t.
+    pi_probs_t: probabilities of the actions `pi_indices_t` at time t.
+    stop_target_gradients: bool indicating whether or not to apply stop gradient
+      to targets.
+
+  Returns:
+    Expected SARSA temporal difference error.
+  """
+  chex.assert_rank(
+      [q_tm1, a_tm1, r_t, discount_t, q_t, pi_indices_t, pi_probs_t],
+      [1, 0, 0, 0, 1, 1, 1])
+  chex.assert_type(
+      [q_tm1, a_tm1, r_t, discount_t, q_t, pi_indices_t, pi_probs_t],
+      [float, int, float, float, float, int, float])
+  chex.assert_equal_shape([pi_indices_t, pi_probs_t])
+
+  target_tm1 = r_t + discount_t * base.sparse_expectation(
+      pi_indices_t, pi_probs_t, q_t)
   target_tm1 = jax.lax.select(stop_target_gradients,
                               jax.lax.stop_gradient(target_tm1), target_tm1)
   return target_tm1 - q_tm1[a_tm1]
@@ -183,6 +252,7 @@ def sarsa_lambda(
     a_t: Array,
     lambda_: Numeric,
     stop_target_gradients: bool = True,
+    time_major: bool = False,
 ) -> Array:
   """Calculates the SARSA(lambda) temporal difference error.
 
@@ -199,18 +269,23 @@ def sarsa_lambda(
     lambda_: mixing parameter lambda, either a scalar or a sequence.
     stop_target_gradients: bool indicating whether or not to apply stop gradient
       to targets.
+    time_major: if True, all sequences have an additional batch dimension after
+      the time dimension, e.g. `q_t` has shape `[T, B, A]` and `r_t` `[T, B]`.
 
   Returns:
     SARSA(lambda) temporal difference error.
   """
+  seq_rank = 2 if time_major else 1
   chex.assert_rank([q_tm1, a_tm1, r_t, discount_t, q_t, a_t, lambda_],
-                   [2, 1, 1, 1, 2, 1, {0, 1}])
+                   [seq_rank + 1, seq_rank, seq_rank, seq_rank, seq_rank + 1,
+                    seq_rank, {0, seq_rank}])
   chex.assert_type([q_tm1, a_tm1, r_t, discount_t, q_t, a_t, lambda_],
                    [float, int, float, float, float, int, float])
 
   qa_tm1 = base.batched_index(q_tm1, a_tm1)
   qa_t = base.batched_index(q_t, a_t)
-  target_tm1 = multistep.lambda_returns(r_t, discount_t, qa_t, lambda_)
+  target_tm1 = multistep.lambda_returns(
+      r_t, discount_t, qa_t, lambda_, time_major=time_major)
   target_tm1 = jax.lax.select(stop_target_gradients,
                               jax.lax.stop_gradient(target_tm1), target_tm1)
   return target_tm1 - qa_tm1
@@ -223,6 +298,7 @@ def q_learning(
     discount_t: Numeric,
     q_t: Array,
     stop_target_gradients: bool = True,
+    legal_actions_mask: Optional[Array] = None,
 ) -> Numeric:
   """Calculates the Q-learning temporal difference error.
 
@@ -237,6 +313,8 @@ def q_learning(
     q_t: Q-values at time t.
     stop_target_gradients: bool indicating whether or not to apply stop gradient
       to targets.
+    legal_actions_mask: optional boolean mask of the actions that are legal at
+      time t, with the same shape as `q_t`. At least one action must be legal.
 
   Returns:
     Q-learning temporal difference error.
@@ -245,7 +323,12 @@ def q_learning(
   chex.assert_type([q_tm1, a_tm1, r_t, discount_t, q_t],
                    [float, int, float, float, float])
 
-  target_tm1 = r_t + discount_t * jnp.max(q_t)
+  if legal_actions_mask is None:
+    max_q_t = jnp.max(q_t)
+  else:
+    chex.assert_equal_shape([q_t, legal_actions_mask])
+    max_q_t = jnp.max(q_t, where=legal_actions_mask, initial=-jnp.inf)
+  target_tm1 = r_t + discount_t * max_q_t
   target_tm1 = jax.lax.select(stop_target_gradients,
                               jax.lax.stop_gradient(target_tm1), target_tm1)
   return target_tm1 - q_tm1[a_tm1]
@@ -259,6 +342,7 @@ def double_q_learning(
     q_t_value: Array,
     q_t_selector: Array,
     stop_target_gradients: bool = True,
+    legal_actions_mask: Optional[Array] = None,
 ) -> Numeric:
   """Calculates the double Q-learning temporal difference error.
 
@@ -274,6 +358,9 @@ def double_q_learning(
     q_t_selector: selector Q-values at time t.
     stop_target_gradients: bool indicating whether or not to apply stop gradient
       to targets.
+    legal_actions_mask: optional boolean mask of the actions that are legal at
+      time t, with the same shape as `q_t_selector`. At least one action must
+      be legal.
 
   Returns:
     Double Q-learning temporal difference error.
@@ -283,12 +370,159 @@ def double_q_learning(
   chex.assert_type([q_tm1, a_tm1, r_t, discount_t, q_t_value, q_t_selector],
                    [float, int, float, float, float, float])
 
+  if legal_actions_mask is not None:
+    chex.assert_equal_shape([q_t_selector, legal_actions_mask])
+    q_t_selector = jnp.where(legal_actions_mask, q_t_selector, -jnp.inf)
   target_tm1 = r_t + discount_t * q_t_value[q_t_selector.argmax()]
   target_tm1 = jax.lax.select(stop_target_gradients,
                               jax.lax.stop_gradient(target_tm1), target_tm1)
   return target_tm1 - q_tm1[a_tm1]
 
 
+def _ensemble_td_error(
+    q_tm1: Array,
+    a_tm1: Numeric,
+    target_tm1: Array,
+    bootstrap_mask: Optional[Array],
+    stop_target_gradients: bool,
+) -> Array:
+  """Computes per-head TD errors, zeroed for heads not trained on the data."""
+  target_tm1 = jax.lax.select(stop_target_gradients,
+                              jax.lax.stop_gradient(target_tm1), target_tm1)
+  td_error = target_tm1 - q_tm1[:, a_tm1]
+  if bootstrap_mask is not None:
+    chex.assert_equal_shape([td_error, bootstrap_mask])
+    td_error = td_error * bootstrap_mask
+  return td_error
+
+
+def ensemble_q_learning(
+    q_tm1: Array,
+    a_tm1: Numeric,
+    r_t: Numeric,
+    discount_t: Numeric,
+    q_t: Array,
+    bootstrap_mask: Optional[Array] = None,
+    stop_target_gradients: bool = True,
+    legal_actions_mask: Optional[Array] = None,
+) -> Array:
+  """Calculates the Q-learning TD errors of an ensemble of Q-value heads.
+
+  All heads are processed in a single pass over a leading ensemble axis, rather
+  than by mapping `q_learning` over the heads. Each head bootstraps from its
+  own Q-values, as in bootstrapped DQN.
+
+  See "Deep Exploration via Bootstrapped DQN" by Osband et al.
+  (https://arxiv.org/abs/1602.04621).
+
+  Args:
+    q_tm1: Q-values at time t-1 of each head, of shape `[H, A]`.
+    a_tm1: action index at time t-1.
+    r_t: reward at time t.
+    discount_t: discount at time t.
+    q_t: Q-values at time t of each head, of shape `[H, A]`.
+    bootstrap_mask: optional weights of shape `[H]`, e.g. binary masks of the
+      heads that are trained on this transition; errors are scaled by them.
+    stop_target_gradients: bool indicating whether or not to apply stop gradient
+      to targets.
+    legal_actions_mask: optional boolean mask of the actions that are legal at
+      time t, of shape `[A]`. At least one action must be legal.
+
+  Returns:
+    Q-learning temporal difference errors, of shape `[H]`.
+  """
+  chex.assert_rank([q_tm1, a_tm1, r_t, discount_t, q_t], [2, 0, 0, 0, 2])
+  chex.assert_type([q_tm1, a_tm1, r_t, discount_t, q_t],
+                   [float, int, float, float, float])
+  chex.assert_equal_shape([q_tm1, q_t])
+
+  if legal_actions_mask is None:
+    max_q_t = jnp.max(q_t, axis=-1)
+  else:
+    chex.assert_equal_shape([q_t[0], legal_actions_mask])
+    max_q_t = jnp.max(q_t, axis=-1, where=legal_actions_mask, initial=-jnp.inf)
+  target_tm1 = r_t + discount_t * max_q_t
+  return _ensemble_td_error(
+      q_tm1, a_tm1, target_tm1, bootstrap_mask, stop_target_gradients)
+
+
+def ensemble_double_q_learning(
+    q_tm1: Array,
+    a_tm1: Numeric,
+    r_t: Numeric,
+    discount_t: Numeric,
+    q_t_value: Array,
+    q_t_selector: Array,
+    bootstrap_mask: Optional[Array] = None,
+    stop_target_gradients: bool = True,
+    legal_actions_mask: Optional[Array] = None,
+) -> Array:
+  """Calculates the double Q-learning TD errors of an ensemble of heads.
+
+  Each head selects its bootstrap action with its own selector Q-values, and
+  evaluates it with its own value Q-values, in a single vectorized pass.
+
+  See "Deep Exploration via Bootstrapped DQN" by Osband et al.
+  (https://arxiv.org/abs/1602.04621).
+
+  Args:
+    q_tm1: Q-values at time t-1 of each head, of shape `[H, A]`.
+    a_tm1: action index at time t-1.
+    r_t: reward at time t.
+    discount_t: discount at time t.
+    q_t_value: Q-values at time t of each head, of shape `[H, A]`.
+    q_t_selector: selector Q-values at time t of each head, of shape `[H, A]`.
+    bootstrap_mask: optional weights of shape `[H]`, e.g. binary masks of the
+      heads that are trained on this transition; errors are scaled by them.
+    stop_target_gradients: bool indicating whether or not to apply stop gradient
+      to targets.
+    legal_actions_mask: optional boolean mask of the actions that are legal at
+      time t, of shape `[A]`. At least one action must be legal.
+
+  Returns:
+    Double Q-learning temporal difference errors, of shape `[H]`.
+  """
+  chex.assert_rank([q_tm1, a_tm1, r_t, discount_t, q_t_value, q_t_selector],
+                   [2, 0, 0, 0, 2, 2])
+  chex.assert_type([q_tm1, a_tm1, r_t, discount_t, q_t_value, q_t_selector],
+                   [float, int, float, float, float, float])
+  chex.assert_equal_shape([q_tm1, q_t_value, q_t_selector])
+
+  if legal_actions_mask is not None:
+    chex.assert_equal_shape([q_t_selector[0], legal_actions_mask])
+    q_t_selector = jnp.where(legal_actions_mask, q_t_selector, -jnp.inf)
+  a_t = jnp.argmax(q_t_selector, axis=-1)
+  target_tm1 = r_t + discount_t * base.batched_index(q_t_value, a_t)
+  return _ensemble_td_error(
+      q_tm1, a_tm1, target_tm1, bootstrap_mask, stop_target_gradients)
+
+
+def ensemble_statistics(q: Array) -> EnsembleStatistics:
+  """Calculates statistics of Q-values across the heads of an ensemble.
+
+  These can be computed from the same Q-values that are fed to the ensemble
+  TD errors, e.g. to derive exploration bonuses from the heads' uncertainty.
+
+  Args:
+    q: Q-values of each head, of shape `[H, A]`.
+
+  Returns:
+    An `EnsembleStatistics` with the `mean` and `std` of each action's value
+    across heads, of shape `[A]`, and the `disagreement` of the heads: the
+    fraction of them whose greedy action differs from that of the mean.
+  """
+  chex.assert_rank(q, 2)
+  chex.assert_type(q, float)
+
+  mean = jnp.mean(q, axis=0)
+  var = jnp.mean(jnp.square(q - mean), axis=0)
+  # Keep gradients finite where all heads agree, e.g. at initialization.
+  positive = var > 0.
+  std = jnp.where(positive, jnp.sqrt(jnp.where(positive, var, 1.)), 0.)
+  disagreement = jnp.mean(jnp.argmax(q, axis=-1) != jnp.argmax(mean))
+  return EnsembleStatistics(mean=mean, std=std, disagreement=disagreement)
+
+
 def persistent_q_learning(
     q_tm1: Array,
     a_tm1: Numeric,
@@ -407,6 +641,7 @@ def q_lambda(
     q_t: Array,
     lambda_: Numeric,
     stop_target_gradients: bool = True,
+    time_major: bool = False,
 ) -> Array:
   """Calculates Peng's or Watkins' Q(lambda) temporal difference error.
 
@@ -423,18 +658,23 @@ def q_lambda(
       a sequence (e.g. Watkin's Q(lambda)).
     stop_target_gradients: bool indicating whether or not to apply stop gradient
       to targets.
+    time_major: if True, all sequences have an additional batch dimension after
+      the time dimension, e.g. `q_t` has shape `[T, B, A]` and `r_t` `[T, B]`.
 
   Returns:
     Q(lambda) temporal difference error.
   """
+  seq_rank = 2 if time_major else 1
   chex.assert_rank([q_tm1, a_tm1, r_t, discount_t, q_t, lambda_],
-                   [2, 1, 1, 1, 2, {0, 1}])
+                   [seq_rank + 1, seq_rank, seq_rank, seq_rank, seq_rank + 1,
+                    {0, seq_rank}])
   chex.assert_type([q_tm1, a_tm1, r_t, discount_t, q_t, lambda_],
                    [float, int, float, float, float, float])
 
   qa_tm1 = base.batched_index(q_tm1, a_tm1)
   v_t = jnp.max(q_t, axis=-1)
-  target_tm1 = multistep.lambda_returns(r_t, discount_t, v_t, lambda_)
+  target_tm1 = multistep.lambda_returns(
+      r_t, discount_t, v_t, lambda_, time_major=time_major)
 
   target_tm1 = jax.lax.select(stop_target_gradients,
                               jax.lax.stop_gradient(target_tm1), target_tm1)
@@ -453,12 +693,18 @@ def retrace(
     lambda_: float,
     eps: float = 1e-8,
     stop_target_gradients: bool = True,
+    time_major: bool = False,
+    segment_ids: Optional[Array] = None,
 ) -> Array:
   """Calculates Retrace errors.
 
   See "Safe and Efficient Off-Policy Reinforcement Learning" by Munos et al.
   (https://arxiv.org/abs/1606.02647).
 
+  Variable-length episodes can be packed end to end into one sequence, with
+  `segment_ids` identifying the episode of each timestep; the traces are then
+  cut at the last timestep of every episode.
+
   Args:
     q_tm1: Q-values at time t-1.
     q_t: Q-values at time t.
@@ -472,19 +718,136 @@ def retrace(
     eps: small value to add to mu_t for numerical stability.
     stop_target_gradients: bool indicating whether or not to apply stop gradient
       to targets.
+    time_major: if True, all sequences have an additional batch dimension after
+      the time dimension, e.g. `q_t` has shape `[T, B, A]` and `r_t` `[T, B]`.
+    segment_ids: optional integer ids of the packed episode each timestep
+      belongs to, with the same shape as `r_t`.
 
   Returns:
     Retrace error.
   """
+  seq_rank = 2 if time_major else 1
   chex.assert_rank([q_tm1, q_t, a_tm1, a_t, r_t, discount_t, pi_t, mu_t],
-                   [2, 2, 1, 1, 1, 1, 2, 1])
+                   [seq_rank + 1, seq_rank + 1, seq_rank, seq_rank, seq_rank,
+                    seq_rank, seq_rank + 1, seq_rank])
   chex.assert_type([q_tm1, q_t, a_tm1, a_t, r_t, discount_t, pi_t, mu_t],
                    [float, float, int, int, float, float, float, float])
 
-  pi_a_t = base.batched_index(pi_t, a_t)
-  c_t = jnp.minimum(1.0, pi_a_t / (mu_t + eps)) * lambda_
-  target_tm1 = multistep.general_off_policy_returns_from_action_values(
-      q_t, a_t, r_t, discount_t, c_t, pi_t)
+  chex.assert_equal_shape([q_t[..., 0], a_t, r_t, discount_t, pi_t[..., 0],
+                           mu_t])
+
+  # Gather the selected actions only where the traces consume them, and take
+  # the expectation under π, over the whole batch before a single scan.
+  q_a_t = base.batched_index(q_t[:-1], a_t[:-1])
+  pi_a_t = base.batched_index(pi_t[:-1], a_t[:-1])
+  exp_q_t = jnp.sum(pi_t * q_t, axis=-1)
+  return _retrace_from_action_values(
+      q_tm1, a_tm1, q_a_t, pi_a_t, exp_q_t, r_t, discount_t, mu_t, lambda_,
+      eps, stop_target_gradients, time_major, segment_ids)
+
+
+def retrace_sparse(
+    q_tm1: Array,
+    q_t: Array,
+    a_tm1: Array,
+    a_t: Array,
+    r_t: Array,
+    discount_t: Array,
+    pi_indices_t: Array,
+    pi_probs_t: Array,
+    mu_t: Array,
+    lambda_: float,
+    eps: float = 1e-8,
+    stop_target_gradients: bool = True,
+    time_major: bool = False,
+    segment_ids: Optional[Array] = None,
+) -> Array:
+  """Calculates Retrace errors for a target policy with sparse support.
+
+  The target policy at each step is given by the `K` actions it supports and
+  their probabilities, rather than by a dense `[A]` vector of probabilities.
+  Expectations under the target policy are then computed by gathering the
+  `K` supported Q-values, and π(aₜ) by matching `a_t` against the supported
+  actions, so that no tensor of shape `[T, A]` is built besides `q_t` itself.
+
+  See "Safe and Efficient Off-Policy Reinforcement Learning" by Munos et al.
+  (https://arxiv.org/abs/1606.02647).
+
+  Args:
+    q_tm1: Q-values at time t-1.
+    q_t: Q-values at time t.
+    a_tm1: action index at time t-1.
+    a_t: action index at time t.
+    r_t: reward at time t.
+    discount_t: discount at time t.
+    pi_indices_t: indices of the `K` actions supported by the target policy at
+      time t, e.g. of shape `[T, K]`.
+    pi_probs_t: target policy probs of the actions `pi_indices_t` at time t.
+    mu_t: behavior policy probs at time t.
+    lambda_: scalar mixing parameter lambda.
+    eps: small value to add to mu_t for numerical stability.
+    stop_target_gradients: bool indicating whether or not to apply stop gradient
+      to targets.
+    time_major: if True, all sequences have an additional batch dimension after
+      the time dimension, e.g. `q_t` has shape `[T, B, A]` and `r_t` `[T, B]`.
+    segment_ids: optional integer ids of the packed episode each timestep
+      belongs to, with the same shape as `r_t`.
+
+  Returns:
+    Retrace error.
+  """
+  seq_rank = 2 if time_major else 1
+  chex.assert_rank(
+      [q_tm1, q_t, a_tm1, a_t, r_t, discount_t, pi_indices_t, pi_probs_t, mu_t],
+      [seq_rank + 1, seq_rank + 1, seq_rank, seq_rank, seq_rank, seq_rank,
+       seq_rank + 1, seq_rank + 1, seq_rank])
+  chex.assert_type(
+      [q_tm1, q_t, a_tm1, a_t, r_t, discount_t, pi_indices_t, pi_probs_t, mu_t],
+      [float, float, int, int, float, float, int, float, float])
+  chex.assert_equal_shape([pi_indices_t, pi_probs_t])
+  chex.assert_equal_shape([q_t[..., 0], a_t, r_t, discount_t,
+                           pi_indices_t[..., 0], mu_t])
+
+  q_a_t = base.batched_index(q_t[:-1], a_t[:-1])
+  pi_a_t = base.sparse_probs_of_actions(
+      pi_indices_t[:-1], pi_probs_t[:-1], a_t[:-1])
+  exp_q_t = base.sparse_expectation(pi_indices_t, pi_probs_t, q_t)
+  return _retrace_from_action_values(
+      q_tm1, a_tm1, q_a_t, pi_a_t, exp_q_t, r_t, discount_t, mu_t, lambda_,
+      eps, stop_target_gradients, time_major, segment_ids)
+
+
+def _retrace_from_action_values(
+    q_tm1: Array,
+    a_tm1: Array,
+    q_a_t: Array,
+    pi_a_t: Array,
+    exp_q_t: Array,
+    r_t: Array,
+    discount_t: Array,
+    mu_t: Array,
+    lambda_: float,
+    eps: float,
+    stop_target_gradients: bool,
+    time_major: bool,
+    segment_ids: Optional[Array],
+    target_fn: Optional[Callable[[Array], Array]] = None,
+) -> Array:
+  """Computes Retrace errors from already gathered action values and probs.
+
+  `q_a_t` and `pi_a_t` hold the Q-values and target probabilities of the
+  actions taken at times [1, T - 1]; `exp_q_t` the expected Q-values under π.
+  If given, `target_fn` is applied to the returns before computing the errors,
+  e.g. to transform them back into the space of `q_tm1`.
+  """
+  c_t = jnp.minimum(1.0, pi_a_t / (mu_t[:-1] + eps)) * lambda_
+  if segment_ids is not None:
+    chex.assert_equal_shape([segment_ids, discount_t])
+    c_t = c_t * base.segment_continuation_mask(segment_ids, c_t.dtype)[:-1]
+  target_tm1 = multistep.general_off_policy_returns_from_q_and_v(
+      q_a_t, exp_q_t, r_t, discount_t, c_t, time_major=time_major)
+  if target_fn is not None:
+    target_tm1 = target_fn(target_tm1)
 
   q_a_tm1 = base.batched_index(q_tm1, a_tm1)
 
@@ -500,7 +863,8 @@ def retrace_continuous(q_tm1: Array,
                        discount_t: Array,
                        log_rhos: Array,
                        lambda_: Union[Array, float],
-                       stop_target_gradients: bool = True) -> Array:
+                       stop_target_gradients: bool = True,
+                       time_major: bool = False) -> Array:
   """Retrace continuous.
 
   See "Safe and Efficient Off-Policy Reinforcement Learning" by Munos et al.
@@ -518,13 +882,15 @@ def retrace_continuous(q_tm1: Array,
     lambda_: scalar or a vector of mixing parameter lambda.
     stop_target_gradients: bool indicating whether or not to apply stop gradient
       to targets.
+    time_major: if True, all sequences have shape `[T, B]`.
 
   Returns:
     Retrace error.
   """
 
+  seq_rank = 2 if time_major else 1
   chex.assert_rank([q_tm1, q_t, r_t, discount_t, log_rhos, lambda_],
-                   [1, 1, 1, 1, 1, {0, 1}])
+                   [seq_rank] * 5 + [{0, seq_rank}])
   chex.assert_type([q_tm1, q_t, r_t, discount_t, log_rhos],
                    [float, float, float, float, float])
 
@@ -533,17 +899,101 @@ def retrace_continuous(q_tm1: Array,
   # The generalized returns are independent of Q-values and cs at the final
   # state.
   target_tm1 = multistep.general_off_policy_returns_from_q_and_v(
-      q_t, v_t, r_t, discount_t, c_t)
+      q_t, v_t, r_t, discount_t, c_t, time_major=time_major)
 
   target_tm1 = jax.lax.select(stop_target_gradients,
                               jax.lax.stop_gradient(target_tm1), target_tm1)
   return target_tm1 - q_tm1
 
 
-def categorical_l2_project(
+def _split_between_neighbours(
+    z_p: Array,
+    z_q: Array
+) -> Tuple[Array, Array, Array]:
+  """Finds the neighbours in z_q of each clipped atom of z_p.
+
+  Args:
+    z_p: support of the distribution to project.
+    z_q: increasing support to project onto.
+
+  Returns:
+    The indices of the lower and upper neighbours of each atom of z_p, and the
+    fraction of its probability that is projected onto the upper neighbour.
+  """
+  z_q = jnp.asarray(z_q)
+  kq = z_q.shape[0]
+
+  # Index of the atom of z_q immediately below each clipped atom of z_p.
+  z_p = jnp.clip(z_p, z_q[0], z_q[-1])
+  lower = jnp.searchsorted(z_q, z_p, side='right') - 1
+  lower = jnp.clip(lower, 0, max(kq - 2, 0))
+  upper = jnp.minimum(lower + 1, kq - 1)
+
+  # Split the probability of each atom linearly between its two neighbours.
+  gap = z_q[upper] - z_q[lower]
+  safe_gap = jnp.where(gap > 0, gap, jnp.ones_like(gap))
+  upper_frac = jnp.where(gap > 0, (z_p - z_q[lower]) / safe_gap, 0.)
+  return lower, upper, upper_frac
+
+
+def _scatter_categorical_l2_project(
     z_p: Array,
     probs: Array,
     z_q: Array
+) -> Array:
+  """Projects (z_p, p) onto z_q splitting each atom between two neighbours."""
+  lower, upper, upper_frac = _split_between_neighbours(z_p, z_q)
+  return jax.ops.segment_sum(
+      jnp.concatenate([probs * (1. - upper_frac), probs * upper_frac]),
+      jnp.concatenate([lower, upper]),
+      num_segments=z_q.shape[0])
+
+
+def _projected_cross_entropy(
+    z_p: Array,
+    probs: Array,
+    z_q: Array,
+    logits_q: Array,
+    stop_target_gradients: bool,
+    method: str,
+) -> Array:
+  """Cross entropy of logits on z_q to the projection of (z_p, probs) on z_q.
+
+  With the 'fused' method, each atom of z_p contributes the log-probabilities
+  of its two neighbours in z_q, weighted by the probability it projects onto
+  them, so that the projected distribution is never materialized.
+
+  Args:
+    z_p: support of the target distribution.
+    probs: probabilities of the target distribution.
+    z_q: support to project the target distribution onto.
+    logits_q: logits of the predicted distribution on z_q.
+    stop_target_gradients: whether or not to apply stop gradient to targets.
+    method: either 'dense', 'scatter' or 'fused'.
+
+  Returns:
+    The cross entropy loss.
+  """
+  if method != 'fused':
+    target = categorical_l2_project(z_p, probs, z_q, method=method)
+    target = jax.lax.select(stop_target_gradients,
+                            jax.lax.stop_gradient(target), target)
+    return -jnp.sum(target * jax.nn.log_softmax(logits_q))
+
+  z_p = jax.lax.select(stop_target_gradients, jax.lax.stop_gradient(z_p), z_p)
+  probs = jax.lax.select(stop_target_gradients,
+                         jax.lax.stop_gradient(probs), probs)
+  lower, upper, upper_frac = _split_between_neighbours(z_p, z_q)
+  log_q = jax.nn.log_softmax(logits_q)
+  return -jnp.sum(probs * ((1. - upper_frac) * log_q[lower] +
+                           upper_frac * log_q[upper]))
+
+
+def categorical_l2_project(
+    z_p: Array,
+    probs: Array,
+    z_q: Array,
+    method: str = 'dense',
 ) -> Array:
   """Projects a categorical distribution (z_p, p) onto a different support z_q.
 
@@ -553,6 +1003,12 @@ def categorical_l2_project(
   Let kq be len(z_q) and kp be len(z_p). This projection works for any
   support z_q, in particular kq need not be equal to kp.
 
+  The 'dense' method compares all pairs of atoms, with O(kp kq) time and
+  memory. The 'scatter' method instead finds the two neighbours in z_q of each
+  atom of z_p with a binary search, and adds its probability to them with a
+  `segment_sum`, in O(kp log kq) time and O(kp + kq) memory. Both methods agree
+  for strictly increasing supports z_q, uniform or not.
+
   See "A Distributional Perspective on RL" by Bellemare et al.
   (https://arxiv.org/abs/1707.06887).
 
@@ -560,6 +1016,7 @@ def categorical_l2_project(
     z_p: support of distribution p.
     probs: probability values.
     z_q: support to project distribution (z_p, probs) onto.
+    method: either 'dense' or 'scatter'.
 
   Returns:
     Projection of (z_p, p) onto support z_q under Cramer distance.
@@ -567,6 +1024,11 @@ def categorical_l2_project(
   chex.assert_rank([z_p, probs, z_q], 1)
   chex.assert_type([z_p, probs, z_q], float)
 
+  if method == 'scatter':
+    return _scatter_categorical_l2_project(z_p, probs, z_q)
+  elif method != 'dense':
+    raise ValueError(f'Unknown method {method}')
+
   kp = z_p.shape[0]
   kq = z_q.shape[0]
 
@@ -610,12 +1072,18 @@ def categorical_td_learning(
     v_atoms_t: Array,
     v_logits_t: Array,
     stop_target_gradients: bool = True,
+    method: str = 'dense',
 ) -> Numeric:
   """Implements TD-learning for categorical value distributions.
 
   See "A Distributional Perspective on Reinforcement Learning", by
   Bellemere, Dabney and Munos (https://arxiv.org/pdf/1707.06887.pdf).
 
+  The target distribution is projected onto `v_atoms_tm1` with the 'dense' or
+  'scatter' methods of `categorical_l2_project`. With `method='fused'` the loss
+  is instead accumulated directly from the two neighbours of each target atom,
+  without materializing the projected target distribution.
+
   Args:
     v_atoms_tm1: atoms of V distribution at time t-1.
     v_logits_tm1: logits of V distribution at time t-1.
@@ -625,6 +1093,7 @@ def categorical_td_learning(
     v_logits_t: logits of V distribution at time t.
     stop_target_gradients: bool indicating whether or not to apply stop gradient
       to targets.
+    method: either 'dense', 'scatter' or 'fused'.
 
   Returns:
     Categorical Q learning loss (i.e. temporal difference error).
@@ -642,14 +1111,11 @@ def categorical_td_learning(
   # Convert logits to distribution.
   v_t_probs = jax.nn.softmax(v_logits_t)
 
-  # Project using the Cramer distance and maybe stop gradient flow to targets.
-  target = categorical_l2_project(target_z, v_t_probs, v_atoms_tm1)
-  target = jax.lax.select(stop_target_gradients, jax.lax.stop_gradient(target),
-                          target)
-
-  # Compute loss (i.e. temporal difference error).
-  return distributions.categorical_cross_entropy(
-      labels=target, logits=v_logits_tm1)
+  # Project using the Cramer distance, maybe stopping gradient flow to targets,
+  # and compute loss (i.e. temporal difference error).
+  return _projected_cross_entropy(
+      target_z, v_t_probs, v_atoms_tm1, v_logits_tm1, stop_target_gradients,
+      method)
 
 
 def categorical_q_learning(
@@ -661,12 +1127,16 @@ def categorical_q_learning(
     q_atoms_t: Array,
     q_logits_t: Array,
     stop_target_gradients: bool = True,
+    method: str = 'dense',
 ) -> Numeric:
   """Implements Q-learning for categorical Q distributions.
 
   See "A Distributional Perspective on Reinforcement Learning", by
   Bellemere, Dabney and Munos (https://arxiv.org/pdf/1707.06887.pdf).
 
+  As in `categorical_td_learning`, `method='fused'` computes the loss without
+  materializing the projected target distribution.
+
   Args:
     q_atoms_tm1: atoms of Q distribution at time t-1.
     q_logits_tm1: logits of Q distribution at time t-1.
@@ -677,6 +1147,7 @@ def categorical_q_learning(
     q_logits_t: logits of Q distribution at time t.
     stop_target_gradients: bool indicating whether or not to apply stop gradient
       to targets.
+    method: either 'dense', 'scatter' or 'fused'.
 
   Returns:
     Categorical Q-learning loss (i.e. temporal difference error).
@@ -699,15 +1170,12 @@ def categorical_q_learning(
   # Compute distribution for greedy action.
   p_target_z = q_t_probs[pi_t]
 
-  # Project using the Cramer distance and maybe stop gradient flow to targets.
-  target = categorical_l2_project(target_z, p_target_z, q_atoms_tm1)
-  target = jax.lax.select(stop_target_gradients, jax.lax.stop_gradient(target),
-                          target)
-
-  # Compute loss (i.e. temporal difference error).
+  # Project using the Cramer distance, maybe stopping gradient flow to targets,
+  # and compute loss (i.e. temporal difference error).
   logit_qa_tm1 = q_logits_tm1[a_tm1]
-  return distributions.categorical_cross_entropy(
-      labels=target, logits=logit_qa_tm1)
+  return _projected_cross_entropy(
+      target_z, p_target_z, q_atoms_tm1, logit_qa_tm1, stop_target_gradients,
+      method)
 
 
 def categorical_double_q_learning(
@@ -720,6 +1188,7 @@ def categorical_double_q_learning(
     q_logits_t: Array,
     q_t_selector: Array,
     stop_target_gradients: bool = True,
+    method: str = 'dense',
 ) -> Numeric:
   """Implements double Q-learning for categorical Q distributions.
 
@@ -728,6 +1197,9 @@ def categorical_double_q_learning(
   and "Double Q-learning" by van Hasselt.
   (https://papers.nips.cc/paper/3964-double-q-learning.pdf).
 
+  As in `categorical_td_learning`, `method='fused'` computes the loss without
+  materializing the projected target distribution.
+
   Args:
     q_atoms_tm1: atoms of Q distribution at time t-1.
     q_logits_tm1: logits of Q distribution at time t-1.
@@ -739,6 +1211,7 @@ def categorical_double_q_learning(
     q_t_selector: selector Q-values at time t.
     stop_target_gradients: bool indicating whether or not to apply stop gradient
       to targets.
+    method: either 'dense', 'scatter' or 'fused'.
 
   Returns:
     Categorical double Q-learning loss (i.e. temporal difference error).
@@ -758,15 +1231,89 @@ def categorical_double_q_learning(
   # Select logits for greedy action in state s_t and convert to distribution.
   p_target_z = jax.nn.softmax(q_logits_t[q_t_selector.argmax()])
 
-  # Project using the Cramer distance and maybe stop gradient flow to targets.
-  target = categorical_l2_project(target_z, p_target_z, q_atoms_tm1)
-  target = jax.lax.select(stop_target_gradients, jax.lax.stop_gradient(target),
-                          target)
-
-  # Compute loss (i.e. temporal difference error).
+  # Project using the Cramer distance, maybe stopping gradient flow to targets,
+  # and compute loss (i.e. temporal difference error).
   logit_qa_tm1 = q_logits_tm1[a_tm1]
-  return distributions.categorical_cross_entropy(
-      labels=target, logits=logit_qa_tm1)
+  return _projected_cross_entropy(
+      target_z, p_target_z, q_atoms_tm1, logit_qa_tm1, stop_target_gradients,
+      method)
+
+
+def _pairwise_quantile_regression_loss(
+    dist_src: Array,
+    tau_src: Array,
+    dist_target: Array,
+    huber_param: float,
+    stop_target_gradients: bool,
+) -> Array:
+  """Computes the QR loss of each source quantile against all the targets."""
+  # Calculate quantile error.
+  delta = dist_target[None, :] - dist_src[:, None]
+  delta_neg = (delta < 0.).astype(jnp.float32)
+  delta_neg = jax.lax.select(stop_target_gradients,
+                             jax.lax.stop_gradient(delta_neg), delta_neg)
+  weight = jnp.abs(tau_src[:, None] - delta_neg)
+
+  # Calculate Huber loss.
+  if huber_param > 0.:
+    loss = clipping.huber_loss(delta, huber_param)
+  else:
+    loss = jnp.abs(delta)
+  loss *= weight
+
+  # Average over target-samples dimension.
+  return jnp.mean(loss, axis=-1)
+
+
+def _chunked_quantile_regression_loss(
+    dist_src: Array,
+    tau_src: Array,
+    dist_target: Array,
+    huber_param: float,
+    stop_target_gradients: bool,
+    chunk_size: int,
+) -> Array:
+  """Computes the pairwise QR loss for chunks of source quantiles in turn."""
+  num_src = dist_src.shape[0]
+  num_chunks = -(-num_src // chunk_size)
+  padding = num_chunks * chunk_size - num_src
+
+  # Pad the source quantiles to a whole number of chunks.
+  pad = lambda x: jnp.pad(x, (0, padding)).reshape((num_chunks, chunk_size))
+  mask = pad(jnp.ones_like(dist_src))
+
+  # Rematerialize the pairwise errors of each chunk in the backward pass, so
+  # that only one chunk of them is ever in memory.
+  @jax.checkpoint
+  def chunk_loss(inputs):
+    dist_src, tau_src, mask = inputs
+    return jnp.sum(mask * _pairwise_quantile_regression_loss(
+        dist_src, tau_src, dist_target, huber_param, stop_target_gradients))
+
+  return jnp.sum(jax.lax.map(chunk_loss, (pad(dist_src), pad(tau_src), mask)))
+
+
+def _sorted_quantile_regression_loss(
+    dist_src: Array,
+    tau_src: Array,
+    dist_target: Array,
+) -> Array:
+  """Computes the QR loss without Huber from sorted targets and prefix sums."""
+  num_target = dist_target.shape[0]
+  sorted_target = jnp.sort(dist_target)
+  prefix_sum = jnp.concatenate(
+      [jnp.zeros_like(sorted_target[:1]), jnp.cumsum(sorted_target)])
+
+  # Count and sum the targets below and above each source quantile.
+  num_below = jnp.searchsorted(sorted_target, dist_src, side='left')
+  sum_below = prefix_sum[num_below]
+  sum_above = prefix_sum[-1] - sum_below
+  num_above = num_target - num_below
+
+  # Targets above each quantile are weighted by tau, those below by 1 - tau.
+  loss = (tau_src * (sum_above - num_above * dist_src) +
+          (1. - tau_src) * (num_below * dist_src - sum_below))
+  return jnp.sum(loss) / num_target
 
 
 def quantile_regression_loss(
@@ -775,12 +1322,25 @@ def quantile_regression_loss(
     dist_target: Array,
     huber_param: float = 0.,
     stop_target_gradients: bool = True,
+    method: str = 'pairwise',
+    chunk_size: Optional[int] = None,
 ) -> Numeric:
   """Compute (Huber) QR loss between two discrete quantile-valued distributions.
 
   See "Distributional Reinforcement Learning with Quantile Regression" by
   Dabney et al. (https://arxiv.org/abs/1710.10044).
 
+  The 'pairwise' method compares all pairs of source and target quantiles,
+  with O(N_src N_target) time and memory. Passing a `chunk_size` bounds its
+  peak memory to O(chunk_size N_target), by processing chunks of source
+  quantiles in turn, and recomputing their pairwise errors for gradients.
+
+  Without Huber loss, the loss of each source quantile is a sum of absolute
+  differences to the targets, weighted by τ above it and by 1 - τ below it.
+  The 'sorted' method computes these sums with one sort of the targets, prefix
+  sums and a binary search per source quantile, in O(N log N) time and O(N)
+  memory. It only supports `huber_param=0`.
+
   Args:
     dist_src: source probability distribution.
     tau_src: source distribution probability thresholds.
@@ -788,6 +1348,9 @@ def quantile_regression_loss(
     huber_param: Huber loss parameter, defaults to 0 (no Huber loss).
     stop_target_gradients: bool indicating whether or not to apply stop gradient
       to targets.
+    method: either 'pairwise' or 'sorted'.
+    chunk_size: optional number of source quantiles processed at once by the
+      'pairwise' method.
 
   Returns:
     Quantile regression loss.
@@ -795,22 +1358,25 @@ def quantile_regression_loss(
   chex.assert_rank([dist_src, tau_src, dist_target], 1)
   chex.assert_type([dist_src, tau_src, dist_target], float)
 
-  # Calculate quantile error.
-  delta = dist_target[None, :] - dist_src[:, None]
-  delta_neg = (delta < 0.).astype(jnp.float32)
-  delta_neg = jax.lax.select(stop_target_gradients,
-                             jax.lax.stop_gradient(delta_neg), delta_neg)
-  weight = jnp.abs(tau_src[:, None] - delta_neg)
-
-  # Calculate Huber loss.
-  if huber_param > 0.:
-    loss = clipping.huber_loss(delta, huber_param)
-  else:
-    loss = jnp.abs(delta)
-  loss *= weight
-
-  # Average over target-samples dimension, sum over src-samples dimension.
-  return jnp.sum(jnp.mean(loss, axis=-1))
+  if chunk_size is not None and chunk_size <= 0:
+    raise ValueError(f'chunk_size must be positive, got {chunk_size}.')
+  if method == 'sorted':
+    if huber_param > 0.:
+      raise ValueError('The sorted method does not support a Huber loss.')
+    if chunk_size is not None:
+      raise ValueError('The sorted method does not support a chunk_size.')
+    return _sorted_quantile_regression_loss(dist_src, tau_src, dist_target)
+  elif method != 'pairwise':
+    raise ValueError(f'Unknown method {method}')
+
+  if chunk_size is not None:
+    return _chunked_quantile_regression_loss(
+        dist_src, tau_src, dist_target, huber_param, stop_target_gradients,
+        chunk_size)
+
+  # Sum over src-samples dimension.
+  return jnp.sum(_pairwise_quantile_regression_loss(
+      dist_src, tau_src, dist_target, huber_param, stop_target_gradients))
 
 
 def quantile_q_learning(
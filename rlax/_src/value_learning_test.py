@@ -82,6 +82,15 @@ class TDLambdaTest(parameterized.TestCase):
     actual = td_lambda(self.v_tm1, self.r_t, self.discount_t, v_t)
     np.testing.assert_allclose(self.expected, actual, rtol=1e-4)
 
+  @chex.all_variants()
+  def test_td_lambda_time_major(self):
+    """Tests time major inputs match the batch major reference."""
+    td_lambda = self.variant(functools.partial(
+        value_learning.td_lambda, lambda_=self.lambda_, time_major=True))
+    v_t = np.concatenate([self.v_tm1[:, 1:], self.bootstrap_v[:, None]], axis=1)
+    actual = td_lambda(self.v_tm1.T, self.r_t.T, self.discount_t.T, v_t.T)
+    np.testing.assert_allclose(self.expected, actual.T, rtol=1e-4)
+
 
 class SarsaTest(parameterized.TestCase):
 
@@ -137,6 +146,52 @@ class ExpectedSarsaTest(parameterized.TestCase):
                             self.q_t, self.probs_a_t)
     np.testing.assert_allclose(self.expected, actual)
 
+  @chex.all_variants()
+  def test_expected_sarsa_legal_actions_mask(self):
+    """Tests illegal actions are excluded, even with undefined Q-values."""
+    expected_sarsa = self.variant(jax.vmap(value_learning.expected_sarsa))
+    legal_actions_mask = np.array([[True, True, False], [True, True, True]])
+    q_t = np.where(legal_actions_mask, self.q_t, np.nan)
+    actual = expected_sarsa(self.q_tm1, self.a_tm1, self.r_t, self.discount_t,
+                            q_t, self.probs_a_t,
+                            legal_actions_mask=legal_actions_mask)
+    np.testing.assert_allclose(np.array([3.8, 2.]), actual, rtol=1e-6)
+
+  @chex.all_variants()
+  def test_expected_sarsa_legal_actions_mask_gradients(self):
+    """Tests gradients stay finite when illegal actions have infinite Q."""
+    legal_actions_mask = np.array([[True, True, False], [True, True, True]])
+    q_t = np.where(legal_actions_mask, self.q_t, -np.inf)
+
+    def loss(probs_a_t):
+      errors = jax.vmap(functools.partial(
+          value_learning.expected_sarsa, stop_target_gradients=False))(
+              self.q_tm1, self.a_tm1, self.r_t, self.discount_t, q_t,
+              probs_a_t, legal_actions_mask=legal_actions_mask)
+      return jnp.sum(errors)
+
+    grad = self.variant(jax.grad(loss))(self.probs_a_t)
+    expected = self.discount_t[:, None] * np.where(
+        legal_actions_mask, self.q_t, 0.)
+    np.testing.assert_allclose(expected, grad, rtol=1e-6)
+
+  @chex.all_variants()
+  def test_expected_sarsa_sparse_matches_dense(self):
+    """Tests a policy given by its support matches the dense reference."""
+    expected_sarsa = self.variant(
+        jax.vmap(value_learning.expected_sarsa_sparse))
+    # Keep the two most likely actions of each policy, in descending order.
+    pi_indices_t = np.argsort(-self.probs_a_t, axis=-1)[:, :2].astype(np.int32)
+    pi_probs_t = np.take_along_axis(self.probs_a_t, pi_indices_t, axis=-1)
+    dense_probs_t = np.zeros_like(self.probs_a_t)
+    np.put_along_axis(dense_probs_t, pi_indices_t, pi_probs_t, axis=-1)
+    actual = expected_sarsa(self.q_tm1, self.a_tm1, self.r_t, self.discount_t,
+                            self.q_t, pi_indices_t, pi_probs_t)
+    expected = jax.vmap(value_learning.expected_sarsa)(
+        self.q_tm1, self.a_tm1, self.r_t, self.discount_t, self.q_t,
+        dense_probs_t)
+    np.testing.assert_allclose(expected, actual, rtol=1e-6)
+
 
 class SarsaLambdaTest(parameterized.TestCase):
 
@@ -183,6 +238,16 @@ class SarsaLambdaTest(parameterized.TestCase):
                           self.q_t, self.a_t)
     np.testing.assert_allclose(self.expected, actual, rtol=1e-4)
 
+  @chex.all_variants()
+  def test_sarsa_lambda_time_major(self):
+    """Tests time major inputs match the batch major reference."""
+    sarsa_lambda = self.variant(functools.partial(
+        value_learning.sarsa_lambda, lambda_=self.lambda_, time_major=True))
+    actual = sarsa_lambda(
+        self.q_tm1.swapaxes(0, 1), self.a_tm1.T, self.r_t.T,
+        self.discount_t.T, self.q_t.swapaxes(0, 1), self.a_t.T)
+    np.testing.assert_allclose(self.expected, actual.T, rtol=1e-4)
+
 
 class QLearningTest(parameterized.TestCase):
 
@@ -206,6 +271,15 @@ class QLearningTest(parameterized.TestCase):
                         self.q_t)
     np.testing.assert_allclose(self.expected, actual)
 
+  @chex.all_variants()
+  def test_q_learning_legal_actions_mask(self):
+    """Tests the bootstrap maximises over the legal actions only."""
+    q_learning = self.variant(jax.vmap(value_learning.q_learning))
+    legal_actions_mask = np.array([[True, False, True], [True, False, True]])
+    actual = q_learning(self.q_tm1, self.a_tm1, self.r_t, self.discount_t,
+                        self.q_t, legal_actions_mask=legal_actions_mask)
+    np.testing.assert_allclose(np.array([0., 0.]), actual)
+
 
 class DoubleQLearningTest(parameterized.TestCase):
 
@@ -231,6 +305,94 @@ class DoubleQLearningTest(parameterized.TestCase):
                                self.q_t_selector)
     np.testing.assert_allclose(self.expected, actual)
 
+  @chex.all_variants()
+  def test_double_q_learning_legal_actions_mask(self):
+    """Tests the selector picks the best legal action."""
+    double_q_learning = self.variant(jax.vmap(value_learning.double_q_learning))
+    legal_actions_mask = np.array([[True, False, True], [True, False, True]])
+    actual = double_q_learning(self.q_tm1, self.a_tm1, self.r_t,
+                               self.discount_t, self.q_t_value,
+                               self.q_t_selector,
+                               legal_actions_mask=legal_actions_mask)
+    np.testing.assert_allclose(np.array([0., 90.]), actual)
+
+
+class EnsembleQLearningTest(parameterized.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    num_heads, batch_size, num_actions = 3, 4, 5
+    rng = np.random.RandomState(0)
+
+    self.q_tm1 = rng.normal(
+        size=(batch_size, num_heads, num_actions)).astype(np.float32)
+    self.a_tm1 = rng.randint(num_actions, size=batch_size).astype(np.int32)
+    self.r_t = rng.normal(size=batch_size).astype(np.float32)
+    self.discount_t = rng.uniform(size=batch_size).astype(np.float32)
+    self.q_t_value = rng.normal(
+        size=(batch_size, num_heads, num_actions)).astype(np.float32)
+    self.q_t_selector = rng.normal(
+        size=(batch_size, num_heads, num_actions)).astype(np.float32)
+    self.bootstrap_mask = rng.randint(
+        2, size=(batch_size, num_heads)).astype(np.float32)
+
+  def _per_head(self, fn, *q_values):
+    """Maps `fn` over the heads, then over the batch."""
+    per_head = jax.vmap(fn, in_axes=(0, None, None, None) + (0,) * len(
+        q_values))
+    return jax.vmap(per_head)(
+        self.q_tm1, self.a_tm1, self.r_t, self.discount_t, *q_values)
+
+  @chex.all_variants()
+  def test_ensemble_q_learning_batch(self):
+    """Tests a single pass matches mapping over the heads."""
+    ensemble_q_learning = self.variant(
+        jax.vmap(value_learning.ensemble_q_learning))
+    actual = ensemble_q_learning(self.q_tm1, self.a_tm1, self.r_t,
+                                 self.discount_t, self.q_t_value,
+                                 self.bootstrap_mask)
+    expected = self._per_head(value_learning.q_learning, self.q_t_value)
+    np.testing.assert_allclose(
+        expected * self.bootstrap_mask, actual, rtol=1e-6)
+
+  @chex.all_variants()
+  def test_ensemble_double_q_learning_batch(self):
+    """Tests a single pass matches mapping over the heads."""
+    ensemble_double_q_learning = self.variant(
+        jax.vmap(value_learning.ensemble_double_q_learning))
+    actual = ensemble_double_q_learning(self.q_tm1, self.a_tm1, self.r_t,
+                                        self.discount_t, self.q_t_value,
+                                        self.q_t_selector, self.bootstrap_mask)
+    expected = self._per_head(
+        value_learning.double_q_learning, self.q_t_value, self.q_t_selector)
+    np.testing.assert_allclose(
+        expected * self.bootstrap_mask, actual, rtol=1e-6)
+
+  @chex.all_variants()
+  def test_ensemble_statistics(self):
+    """Tests statistics across heads."""
+    ensemble_statistics = self.variant(value_learning.ensemble_statistics)
+    q = np.array([[1., 2., 0.], [3., 0., 0.], [2., 4., 0.]], dtype=np.float32)
+    actual = ensemble_statistics(q)
+    np.testing.assert_allclose(np.array([2., 2., 0.]), actual.mean)
+    np.testing.assert_allclose(np.std(q, axis=0), actual.std, rtol=1e-6)
+    # The mean is greedy in the first action, as is only the second head.
+    np.testing.assert_allclose(2. / 3., actual.disagreement, rtol=1e-6)
+
+  @chex.all_variants()
+  def test_ensemble_statistics_std_gradients(self):
+    """Tests gradients of the std are finite where all heads agree."""
+    # All heads agree on the last action, as after identical initialization.
+    q = np.array([[1., 2., 0.], [3., 0., 0.], [2., 4., 0.]], dtype=np.float32)
+    grad_fn = self.variant(jax.grad(
+        lambda q: jnp.sum(value_learning.ensemble_statistics(q).std)))
+    actual = grad_fn(q)
+    centered = q - q.mean(axis=0)
+    std = np.std(q, axis=0)
+    expected = np.zeros_like(q)
+    expected[:, :2] = centered[:, :2] / (q.shape[0] * std[:2])
+    np.testing.assert_allclose(expected, actual, rtol=1e-5, atol=1e-6)
+
 
 class PersistentQLearningTest(parameterized.TestCase):
 
@@ -356,6 +518,16 @@ class QLambdaTest(parameterized.TestCase):
                       self.q_t)
     np.testing.assert_allclose(self.expected, actual, rtol=1e-5)
 
+  @chex.all_variants()
+  def test_q_lambda_time_major(self):
+    """Tests time major inputs match the batch major reference."""
+    q_lambda = self.variant(functools.partial(
+        value_learning.q_lambda, lambda_=self.lambda_, time_major=True))
+    actual = q_lambda(
+        self.q_tm1.swapaxes(0, 1), self.a_tm1.T, self.r_t.T,
+        self.discount_t.T, self.q_t.swapaxes(0, 1))
+    np.testing.assert_allclose(self.expected, actual.T, rtol=1e-5)
+
 
 class RetraceTest(parameterized.TestCase):
 
@@ -413,6 +585,63 @@ class RetraceTest(parameterized.TestCase):
     actual_loss = 0.5 * np.square(actual_td)
     np.testing.assert_allclose(self.expected, actual_loss, rtol=1e-5)
 
+  @chex.all_variants()
+  def test_retrace_time_major(self):
+    """Tests time major inputs match the batch major reference."""
+    retrace = self.variant(functools.partial(
+        value_learning.retrace, lambda_=self._lambda, time_major=True))
+    # Move the time dimension first.
+    qs, targnet_qs, actions, rewards, pcontinues, pi, mu = [
+        x.swapaxes(0, 1) for x in self._inputs]
+    actual_td = retrace(qs[:-1], targnet_qs[1:], actions[:-1], actions[1:],
+                        rewards[:-1], pcontinues[:-1], pi[1:], mu[1:])
+    actual_loss = 0.5 * np.square(actual_td)
+    np.testing.assert_allclose(self.expected, actual_loss.T, rtol=1e-5)
+
+  @chex.all_variants()
+  def test_retrace_segment_ids(self):
+    """Tests packed episodes match separate calls on each episode."""
+    retrace = self.variant(functools.partial(
+        value_learning.retrace, lambda_=self._lambda))
+    # Pack the two sequences of the batch end to end.
+    pack = lambda x: x.reshape((-1,) + x.shape[2:])
+    qs, targnet_qs, actions, rewards, pcontinues, pi, mu = self._inputs
+    segment_ids = np.repeat(np.arange(2), 3)
+    actual_td = retrace(
+        pack(qs[:, :-1]), pack(targnet_qs[:, 1:]), pack(actions[:, :-1]),
+        pack(actions[:, 1:]), pack(rewards[:, :-1]), pack(pcontinues[:, :-1]),
+        pack(pi[:, 1:]), pack(mu[:, 1:]), segment_ids=segment_ids)
+    actual_loss = 0.5 * np.square(actual_td)
+    np.testing.assert_allclose(
+        self.expected.reshape(-1), actual_loss, rtol=1e-5)
+
+  @chex.all_variants()
+  @parameterized.named_parameters(
+      ('batch_major', False), ('time_major', True))
+  def test_retrace_sparse(self, time_major):
+    """Tests a target policy given by its support matches the dense one."""
+    retrace_sparse = functools.partial(
+        value_learning.retrace_sparse, lambda_=self._lambda,
+        time_major=time_major)
+    if not time_major:
+      retrace_sparse = jax.vmap(retrace_sparse)
+    retrace_sparse = self.variant(retrace_sparse)
+    qs, targnet_qs, actions, rewards, pcontinues, pi, mu = self._inputs
+    # List the support of π in reverse order.
+    pi_indices = np.broadcast_to(
+        np.arange(pi.shape[-1])[::-1], pi.shape).astype(np.int32)
+    pi_probs = pi[..., ::-1]
+    inputs = [qs[:, :-1], targnet_qs[:, 1:], actions[:, :-1], actions[:, 1:],
+              rewards[:, :-1], pcontinues[:, :-1], pi_indices[:, 1:],
+              pi_probs[:, 1:], mu[:, 1:]]
+    if time_major:
+      inputs = [x.swapaxes(0, 1) for x in inputs]
+    actual_td = retrace_sparse(*inputs)
+    if time_major:
+      actual_td = actual_td.T
+    actual_loss = 0.5 * np.square(actual_td)
+    np.testing.assert_allclose(self.expected, actual_loss, rtol=1e-5)
+
 
 def _generate_sorted_support(size):
   """Generate a random support vector."""
@@ -485,6 +714,19 @@ class RetraceContinuousTest(parameterized.TestCase):
     actual_loss = 0.5 * np.square(actual_td)
     np.testing.assert_allclose(expected, actual_loss, rtol=1e-5)
 
+  @chex.all_variants()
+  def test_retrace_time_major(self):
+    """Tests time major inputs match the batch major reference."""
+    retrace = self.variant(functools.partial(
+        value_learning.retrace_continuous, time_major=True))
+    # Move the time dimension first.
+    qs, targnet_qs, exp_q_t, rewards, pcontinues, log_rhos = [
+        x.T for x in self._inputs]
+    actual_td = retrace(qs[:-1], targnet_qs[1:-1], exp_q_t, rewards[:-1],
+                        pcontinues[:-1], log_rhos[1:], self._lambda.T)
+    actual_loss = 0.5 * np.square(actual_td)
+    np.testing.assert_allclose(self.expected, actual_loss.T, rtol=1e-5)
+
 
 class L2ProjectTest(parameterized.TestCase):
 
@@ -513,6 +755,44 @@ class L2ProjectTest(parameterized.TestCase):
     # Test outputs.
     np.testing.assert_allclose(actual, self.expected)
 
+  @chex.all_variants()
+  def test_scatter_categorical_l2_project_batch(self):
+    """Tests the scatter projection for a full batch."""
+    l2_project = self.variant(jax.vmap(functools.partial(
+        value_learning.categorical_l2_project, method='scatter')))
+    actual = l2_project(self.old_supports, self.weights, self.new_supports)
+    np.testing.assert_allclose(actual, self.expected, atol=1e-6)
+
+  @chex.all_variants()
+  @parameterized.named_parameters(
+      ('fewer_atoms', 51, 11), ('more_atoms', 11, 51), ('one_atom', 7, 1))
+  def test_scatter_matches_dense(self, kp, kq):
+    """Tests both methods agree on non-uniform supports, with gradients."""
+    rng = np.random.RandomState(0)
+    z_p = np.sort(rng.normal(scale=2., size=kp)).astype(np.float32)
+    probs = rng.dirichlet(np.ones(kp)).astype(np.float32)
+    z_q = np.sort(rng.choice(
+        np.linspace(-3., 3., 10 * kq), kq, replace=False)).astype(np.float32)
+
+    def project(z_p, probs, method):
+      projected = value_learning.categorical_l2_project(
+          z_p, probs, z_q, method=method)
+      return jnp.sum(projected * np.arange(kq)), projected
+
+    value_and_grad = self.variant(jax.value_and_grad(
+        project, argnums=(0, 1), has_aux=True), static_argnums=2)
+    expected = value_and_grad(z_p, probs, 'dense')
+    actual = value_and_grad(z_p, probs, 'scatter')
+    jax.tree_util.tree_map(
+        lambda x, y: np.testing.assert_allclose(x, y, rtol=1e-4, atol=1e-5),
+        expected, actual)
+
+  def test_unknown_method_raises(self):
+    with self.assertRaises(ValueError):
+      value_learning.categorical_l2_project(
+          self.old_supports[0], self.weights[0], self.new_supports[0],
+          method='sparse')
+
 
 class CategoricalTDLearningTest(parameterized.TestCase):
 
@@ -555,6 +835,25 @@ class CategoricalTDLearningTest(parameterized.TestCase):
         self.logits_tm1, self.r_t, self.discount_t, self.logits_t)
     np.testing.assert_allclose(self.expected, actual, rtol=1e-4)
 
+  @chex.all_variants()
+  @parameterized.named_parameters(
+      ('stop_target_gradients', True), ('no_stop_target_gradients', False))
+  def test_fused_matches_dense(self, stop_target_gradients):
+    """Tests the fused loss and its gradients match the dense projection."""
+    def loss(v_logits_tm1, v_logits_t, method):
+      return jnp.sum(jax.vmap(functools.partial(
+          value_learning.categorical_td_learning, self.atoms,
+          v_atoms_t=self.atoms, stop_target_gradients=stop_target_gradients,
+          method=method))(v_logits_tm1, r_t=self.r_t,
+                          discount_t=self.discount_t, v_logits_t=v_logits_t))
+    value_and_grad = self.variant(
+        jax.value_and_grad(loss, argnums=(0, 1)), static_argnums=2)
+    expected = value_and_grad(self.logits_tm1, self.logits_t, 'dense')
+    actual = value_and_grad(self.logits_tm1, self.logits_t, 'fused')
+    jax.tree_util.tree_map(
+        lambda x, y: np.testing.assert_allclose(x, y, rtol=1e-4, atol=1e-5),
+        expected, actual)
+
 
 class CategoricalQLearningTest(parameterized.TestCase):
 
@@ -611,6 +910,27 @@ class CategoricalQLearningTest(parameterized.TestCase):
     actual = categorical_q_learning(*self.inputs)
     np.testing.assert_allclose(self.expected, actual, rtol=1e-4)
 
+  @chex.all_variants()
+  @parameterized.named_parameters(
+      ('stop_target_gradients', True), ('no_stop_target_gradients', False))
+  def test_fused_matches_dense(self, stop_target_gradients):
+    """Tests the fused loss and its gradients match the dense projection."""
+    def loss(q_logits_tm1, q_logits_t, method):
+      fn = functools.partial(
+          value_learning.categorical_q_learning, self.atoms,
+          q_atoms_t=self.atoms, stop_target_gradients=stop_target_gradients,
+          method=method)
+      return jnp.sum(jax.vmap(fn)(
+          q_logits_tm1, a_tm1=self.a_tm1, r_t=self.r_t,
+          discount_t=self.discount_t, q_logits_t=q_logits_t))
+    value_and_grad = self.variant(
+        jax.value_and_grad(loss, argnums=(0, 1)), static_argnums=2)
+    expected = value_and_grad(self.q_logits_tm1, self.q_logits_t, 'dense')
+    actual = value_and_grad(self.q_logits_tm1, self.q_logits_t, 'fused')
+    jax.tree_util.tree_map(
+        lambda x, y: np.testing.assert_allclose(x, y, rtol=1e-4, atol=1e-5),
+        expected, actual)
+
 
 class CategoricalDoubleQLearningTest(parameterized.TestCase):
 
@@ -671,6 +991,28 @@ class CategoricalDoubleQLearningTest(parameterized.TestCase):
     actual = categorical_double_q_learning(*self.inputs)
     np.testing.assert_allclose(self.expected, actual, rtol=1e-4)
 
+  @chex.all_variants()
+  @parameterized.named_parameters(
+      ('stop_target_gradients', True), ('no_stop_target_gradients', False))
+  def test_fused_matches_dense(self, stop_target_gradients):
+    """Tests the fused loss and its gradients match the dense projection."""
+    def loss(q_logits_tm1, q_logits_t, method):
+      fn = functools.partial(
+          value_learning.categorical_double_q_learning, self.atoms,
+          q_atoms_t=self.atoms, stop_target_gradients=stop_target_gradients,
+          method=method)
+      return jnp.sum(jax.vmap(fn)(
+          q_logits_tm1, a_tm1=self.a_tm1, r_t=self.r_t,
+          discount_t=self.discount_t, q_logits_t=q_logits_t,
+          q_t_selector=self.q_t_selector))
+    value_and_grad = self.variant(
+        jax.value_and_grad(loss, argnums=(0, 1)), static_argnums=2)
+    expected = value_and_grad(self.q_logits_tm1, self.q_logits_t, 'dense')
+    actual = value_and_grad(self.q_logits_tm1, self.q_logits_t, 'fused')
+    jax.tree_util.tree_map(
+        lambda x, y: np.testing.assert_allclose(x, y, rtol=1e-4, atol=1e-5),
+        expected, actual)
+
   @chex.all_variants()
   def test_single_double_q_learning_eq_batch(self):
     """Tests equivalence to categorical_q_learning when q_t_selector == q_t."""
@@ -757,6 +1099,61 @@ class QuantileRegressionLossTest(parameterized.TestCase):
     np.testing.assert_allclose(actual, self.expected_loss[huber_param],
                                rtol=3e-7)
 
+  @chex.all_variants()
+  @parameterized.named_parameters(
+      ('sorted', 0., 'sorted', None),
+      ('chunked_nohuber', 0., 'pairwise', 1),
+      ('chunked_huber', 2., 'pairwise', 1))
+  def test_methods_batch(self, huber_param, method, chunk_size):
+    """Tests the sorted and chunked methods for a full batch."""
+    loss_fn = self.variant(jax.vmap(functools.partial(
+        value_learning.quantile_regression_loss, huber_param=huber_param,
+        method=method, chunk_size=chunk_size)))
+    actual = loss_fn(self.dist_src, self.tau_src, self.dist_target)
+    np.testing.assert_allclose(actual, self.expected_loss[huber_param],
+                               rtol=1e-6)
+
+  @chex.all_variants()
+  @parameterized.named_parameters(
+      ('sorted', 0., 'sorted', None),
+      ('chunked_nohuber', 0., 'pairwise', 16),
+      ('chunked_huber', 1., 'pairwise', 24))
+  def test_methods_match_pairwise(self, huber_param, method, chunk_size):
+    """Tests the sorted and chunked methods match, with gradients."""
+    rng = np.random.RandomState(0)
+    dist_src = rng.normal(size=64).astype(np.float32)
+    tau_src = ((np.arange(64) + 0.5) / 64).astype(np.float32)
+    dist_target = rng.normal(size=100).astype(np.float32)
+
+    def loss_fn(dist_src, dist_target, method, chunk_size):
+      return value_learning.quantile_regression_loss(
+          dist_src, tau_src, dist_target, huber_param, method=method,
+          chunk_size=chunk_size)
+
+    value_and_grad = self.variant(jax.value_and_grad(
+        loss_fn, argnums=(0, 1)), static_argnums=(2, 3))
+    expected = value_and_grad(dist_src, dist_target, 'pairwise', None)
+    actual = value_and_grad(dist_src, dist_target, method, chunk_size)
+    jax.tree_util.tree_map(
+        lambda x, y: np.testing.assert_allclose(x, y, rtol=1e-4, atol=1e-6),
+        expected, actual)
+
+  def test_sorted_huber_raises(self):
+    with self.assertRaises(ValueError):
+      value_learning.quantile_regression_loss(
+          self.dist_src[0], self.tau_src[0], self.dist_target[0],
+          huber_param=1., method='sorted')
+
+  @parameterized.named_parameters(
+      ('sorted_with_chunks', 'sorted', 4),
+      ('zero_chunk_size', 'pairwise', 0),
+      ('negative_chunk_size', 'pairwise', -1))
+  def test_invalid_chunk_size_raises(self, method, chunk_size):
+    with self.assertRaises(ValueError):
+      value_learning.quantile_regression_loss(
+          self.dist_src[0], self.tau_src[0], self.dist_target[0],
+          method=method, chunk_size=chunk_size)
+
 
 class QuantileLearningTest(parameterized.TestCase):
 
@@ -23,16 +23,25 @@ a special case of the multistep return estimates from `multistep.py`.
 """
 
 import collections
+from typing import Optional, Tuple
 
 import chex
 import jax
 import jax.numpy as jnp
+from rlax._src import base
+from rlax._src import pop_art
 
 
 Array = chex.Array
 Numeric = chex.Numeric
 VTraceOutput = collections.namedtuple(
     'vtrace_output', ['errors', 'pg_advantage', 'q_estimate'])
+PopArtVTraceOutput = collections.namedtuple(
+    'popart_vtrace_output', ['errors', 'pg_advantage', 'targets',
+                             'normalized_targets'])
+ImpalaLossOutput = collections.namedtuple(
+    'impala_loss_output', ['pg_loss', 'baseline_loss', 'entropy_loss',
+                           'entropy', 'rho_tm1', 'vtrace'])
 
 
 def vtrace(
@@ -44,12 +53,23 @@ def vtrace(
     lambda_: Numeric = 1.0,
     clip_rho_threshold: float = 1.0,
     stop_target_gradients: bool = True,
+    method: str = 'scan',
+    time_major: bool = False,
+    segment_ids: Optional[Array] = None,
 ) -> Array:
   """Calculates V-Trace errors from importance weights.
 
   V-trace computes TD-errors from multistep trajectories by applying
   off-policy corrections based on clipped importance sampling ratios.
 
+  The errors follow the affine recursion δₜ = ρₜ TDₜ + γₜ cₜ δₜ₊₁, which can be
+  evaluated with a sequential scan or, with `method='associative'`, with a
+  parallel associative scan of logarithmic depth in the sequence length.
+
+  Variable-length episodes can be packed end to end into one sequence, with
+  `segment_ids` identifying the episode of each timestep; the traces are then
+  cut at the last timestep of every episode.
+
   See "IMPALA: Scalable Distributed Deep-RL with Importance Weighted Actor
   Learner Architectures" by Espeholt et al. (https://arxiv.org/abs/1802.01561).
 
@@ -62,12 +82,69 @@ def vtrace(
     lambda_: mixing parameter; a scalar or a vector for timesteps t.
     clip_rho_threshold: clip threshold for importance weights.
     stop_target_gradients: whether or not to apply stop gradient to targets.
+    method: either 'scan' (sequential) or 'associative' (parallel prefix scan).
+    time_major: if True, all sequences have shape `[T, B]`, and the errors of
+      the whole batch are computed in a single scan over time.
+    segment_ids: optional integer ids of the packed episode each timestep
+      belongs to, with the same shape as `r_t`.
 
   Returns:
     V-Trace error.
   """
+  if segment_ids is not None:
+    chex.assert_equal_shape([segment_ids, discount_t])
+    lambda_ = lambda_ * base.segment_continuation_mask(
+        segment_ids, discount_t.dtype)
+  errors, _ = chunked_vtrace(
+      v_tm1, v_t, r_t, discount_t, rho_tm1, lambda_, carry=None,
+      clip_rho_threshold=clip_rho_threshold,
+      stop_target_gradients=stop_target_gradients, method=method,
+      time_major=time_major)
+  return errors
+
+
+def chunked_vtrace(
+    v_tm1: Array,
+    v_t: Array,
+    r_t: Array,
+    discount_t: Array,
+    rho_tm1: Array,
+    lambda_: Numeric = 1.0,
+    carry: Optional[Array] = None,
+    clip_rho_threshold: float = 1.0,
+    stop_target_gradients: bool = True,
+    method: str = 'scan',
+    time_major: bool = False,
+) -> Tuple[Array, Array]:
+  """Calculates V-Trace errors for one chunk of a longer trajectory.
+
+  A long trajectory can be split into consecutive chunks, which are then
+  processed from the last to the first: the carry returned for each chunk is
+  passed as `carry` to the chunk that precedes it. The concatenated errors are
+  identical to those computed by `vtrace` on the whole trajectory.
+
+  Args:
+    v_tm1: values at time t-1.
+    v_t: values at time t.
+    r_t: reward at time t.
+    discount_t: discount at time t.
+    rho_tm1: importance sampling ratios at time t-1.
+    lambda_: mixing parameter; a scalar or a vector for timesteps t.
+    carry: the V-Trace error at the first timestep of the following chunk. If
+      `None`, the chunk ends the trajectory.
+    clip_rho_threshold: clip threshold for importance weights.
+    stop_target_gradients: whether or not to apply stop gradient to targets.
+    method: either 'scan' (sequential) or 'associative' (parallel prefix scan).
+    time_major: if True, all sequences have shape `[T, B]` and `carry` has
+      shape `[B]`.
+
+  Returns:
+    A tuple of the V-Trace errors for this chunk, and the carry to pass to the
+    preceding chunk.
+  """
+  seq_rank = 2 if time_major else 1
   chex.assert_rank([v_tm1, v_t, r_t, discount_t, rho_tm1, lambda_],
-                   [1, 1, 1, 1, 1, {0, 1}])
+                   [seq_rank] * 5 + [{0, seq_rank}])
   chex.assert_type([v_tm1, v_t, r_t, discount_t, rho_tm1, lambda_],
                    [float, float, float, float, float, float])
   chex.assert_equal_shape([v_tm1, v_t, r_t, discount_t, rho_tm1])
@@ -78,21 +155,84 @@ def vtrace(
 
   # Compute the temporal difference errors.
   td_errors = clipped_rhos_tm1 * (r_t + discount_t * v_t - v_tm1)
+  if carry is None:
+    carry = jnp.zeros_like(td_errors[0])
+  chex.assert_shape(carry, td_errors.shape[1:])
 
   # Work backwards computing the td-errors.
-  def _body(acc, xs):
-    td_error, discount, c = xs
-    acc = td_error + discount * c * acc
-    return acc, acc
+  errors = base.reverse_linear_recurrence(
+      a_t=discount_t * c_tm1,
+      b_t=td_errors,
+      x_bootstrap=carry,
+      method=method)
 
-  _, errors = jax.lax.scan(
-      _body, 0.0, (td_errors, discount_t, c_tm1), reverse=True)
+  # The carry is the unprocessed error, that is continued by preceding chunks.
+  carry = jax.lax.select(
+      stop_target_gradients, jax.lax.stop_gradient(errors[0]), errors[0])
 
   # Return errors, maybe disabling gradient flow through bootstrap targets.
-  return jax.lax.select(
+  errors = jax.lax.select(
       stop_target_gradients,
       jax.lax.stop_gradient(errors + v_tm1) - v_tm1,
       errors)
+  return errors, carry
+
+
+def time_sharded_vtrace(
+    v_tm1: Array,
+    v_t: Array,
+    r_t: Array,
+    discount_t: Array,
+    rho_tm1: Array,
+    lambda_: Numeric = 1.0,
+    axis_name: str = 'time',
+    clip_rho_threshold: float = 1.0,
+    stop_target_gradients: bool = True,
+    time_major: bool = False,
+) -> Array:
+  """Calculates V-Trace errors for a trajectory sharded in time across devices.
+
+  Each device along `axis_name` holds a consecutive shard of the trajectory,
+  ordered by device index. Every device first summarises its shard as one
+  affine map of the error that follows it, the summaries are exchanged with a
+  single `all_gather`, and each device then completes its shard locally from
+  the carry of the shards that follow it. The concatenated errors match those
+  of `vtrace` on the whole trajectory, up to floating point rounding.
+
+  This function must be called in a mapped context, such as `jax.pmap` or
+  `shard_map` over the time dimension.
+
+  Args:
+    v_tm1: local shard of values at time t-1.
+    v_t: local shard of values at time t.
+    r_t: local shard of rewards at time t.
+    discount_t: local shard of discounts at time t.
+    rho_tm1: local shard of importance sampling ratios at time t-1.
+    lambda_: mixing parameter; a scalar or a local shard of lambdas.
+    axis_name: name of the mapped axis over which time is sharded.
+    clip_rho_threshold: clip threshold for importance weights.
+    stop_target_gradients: whether or not to apply stop gradient to targets.
+    time_major: if True, all local shards have shape `[T, B]`.
+
+  Returns:
+    V-Trace errors for the local shard.
+  """
+  lambda_ = jnp.ones_like(discount_t) * lambda_
+
+  # Summarise the shard as δₜ₀ = B + A δ, where δ follows the shard.
+  _, x_first = chunked_vtrace(
+      v_tm1, v_t, r_t, discount_t, rho_tm1, lambda_,
+      carry=jnp.zeros_like(v_t[-1]), clip_rho_threshold=clip_rho_threshold,
+      stop_target_gradients=False, time_major=time_major)
+  carry = base.carry_from_following_shards(
+      discount_t * jnp.minimum(1.0, rho_tm1) * lambda_, x_first,
+      jnp.zeros_like(x_first), axis_name)
+
+  errors, _ = chunked_vtrace(
+      v_tm1, v_t, r_t, discount_t, rho_tm1, lambda_, carry=carry,
+      clip_rho_threshold=clip_rho_threshold,
+      stop_target_gradients=stop_target_gradients, time_major=time_major)
+  return errors
 
 
 def leaky_vtrace(
@@ -104,11 +244,15 @@ def leaky_vtrace(
     alpha_: float = 1.0,
     lambda_: Numeric = 1.0,
     clip_rho_threshold: float = 1.0,
-    stop_target_gradients: bool = True):
+    stop_target_gradients: bool = True,
+    method: str = 'scan',
+    time_major: bool = False):
   """Calculates Leaky V-Trace errors from importance weights.
 
   Leaky-Vtrace is a combination of Importance sampling and V-trace, where the
   degree of mixing is controlled by a scalar `alpha` (that may be meta-learnt).
+  As for `vtrace`, the errors can be computed with a sequential scan or with a
+  parallel associative scan (`method='associative'`).
 
   See "Self-Tuning Deep Reinforcement Learning"
   by Zahavy et al. (https://arxiv.org/abs/2002.12928)
@@ -123,12 +267,16 @@ def leaky_vtrace(
     lambda_: mixing parameter; a scalar or a vector for timesteps t.
     clip_rho_threshold: clip threshold for importance weights.
     stop_target_gradients: whether or not to apply stop gradient to targets.
+    method: either 'scan' (sequential) or 'associative' (parallel prefix scan).
+    time_major: if True, all sequences have shape `[T, B]`, and the errors of
+      the whole batch are computed in a single scan over time.
 
   Returns:
     Leaky V-Trace error.
   """
+  seq_rank = 2 if time_major else 1
   chex.assert_rank([v_tm1, v_t, r_t, discount_t, rho_tm1, lambda_],
-                   [1, 1, 1, 1, 1, {0, 1}])
+                   [seq_rank] * 5 + [{0, seq_rank}])
   chex.assert_type([v_tm1, v_t, r_t, discount_t, rho_tm1, lambda_],
                    [float, float, float, float, float, float])
   chex.assert_equal_shape([v_tm1, v_t, r_t, discount_t, rho_tm1])
@@ -144,13 +292,11 @@ def leaky_vtrace(
   td_errors = clipped_rhos_tm1 * (r_t + discount_t * v_t - v_tm1)
 
   # Work backwards computing the td-errors.
-  def _body(acc, xs):
-    td_error, discount, c = xs
-    acc = td_error + discount * c * acc
-    return acc, acc
-
-  _, errors = jax.lax.scan(
-      _body, 0.0, (td_errors, discount_t, c_tm1), reverse=True)
+  errors = base.reverse_linear_recurrence(
+      a_t=discount_t * c_tm1,
+      b_t=td_errors,
+      x_bootstrap=jnp.zeros_like(td_errors[0]),
+      method=method)
 
   # Return errors, maybe disabling gradient flow through bootstrap targets.
   return jax.lax.select(
@@ -169,12 +315,19 @@ def vtrace_td_error_and_advantage(
     clip_rho_threshold: float = 1.0,
     clip_pg_rho_threshold: float = 1.0,
     stop_target_gradients: bool = True,
+    method: str = 'scan',
+    time_major: bool = False,
+    segment_ids: Optional[Array] = None,
 ) -> VTraceOutput:
   """Calculates V-Trace errors and PG advantage from importance weights.
 
   This functions computes the TD-errors and policy gradient Advantage terms
   as used by the IMPALA distributed actor-critic agent.
 
+  As for `vtrace`, packed episodes can be separated by `segment_ids`; the last
+  timestep of every episode then bootstraps its Q-value estimate from its own
+  `v_t` rather than from the next episode.
+
   See "IMPALA: Scalable Distributed Deep-RL with Importance Weighted Actor
   Learner Architectures" by Espeholt et al. (https://arxiv.org/abs/1802.01561)
 
@@ -188,12 +341,17 @@ def vtrace_td_error_and_advantage(
     clip_rho_threshold: clip threshold for importance ratios.
     clip_pg_rho_threshold: clip threshold for policy gradient importance ratios.
     stop_target_gradients: whether or not to apply stop gradient to targets.
+    method: either 'scan' (sequential) or 'associative' (parallel prefix scan).
+    time_major: if True, all sequences have shape `[T, B]`.
+    segment_ids: optional integer ids of the packed episode each timestep
+      belongs to, with the same shape as `r_t`.
 
   Returns:
     a tuple of V-Trace error, policy gradient advantage, and estimated Q-values.
   """
+  seq_rank = 2 if time_major else 1
   chex.assert_rank([v_tm1, v_t, r_t, discount_t, rho_tm1, lambda_],
-                   [1, 1, 1, 1, 1, {0, 1}])
+                   [seq_rank] * 5 + [{0, seq_rank}])
   chex.assert_type([v_tm1, v_t, r_t, discount_t, rho_tm1, lambda_],
                    [float, float, float, float, float, float])
   chex.assert_equal_shape([v_tm1, v_t, r_t, discount_t, rho_tm1])
@@ -203,12 +361,17 @@ def vtrace_td_error_and_advantage(
 
   errors = vtrace(
       v_tm1, v_t, r_t, discount_t, rho_tm1,
-      lambda_, clip_rho_threshold, stop_target_gradients)
+      lambda_, clip_rho_threshold, stop_target_gradients, method, time_major,
+      segment_ids)
   targets_tm1 = errors + v_tm1
   q_bootstrap = jnp.concatenate([
       lambda_[:-1] * targets_tm1[1:] + (1 - lambda_[:-1]) * v_tm1[1:],
       v_t[-1:],
   ], axis=0)
+  if segment_ids is not None:
+    # Bootstrap the last timestep of each episode from its own value.
+    continues = base.segment_continuation_mask(segment_ids, discount_t.dtype)
+    q_bootstrap = continues * q_bootstrap + (1 - continues) * v_t
   q_estimate = r_t + discount_t * q_bootstrap
   clipped_pg_rho_tm1 = jnp.minimum(clip_pg_rho_threshold, rho_tm1)
   pg_advantages = clipped_pg_rho_tm1 * (q_estimate - v_tm1)
@@ -227,6 +390,8 @@ def leaky_vtrace_td_error_and_advantage(
     clip_rho_threshold: float = 1.0,
     clip_pg_rho_threshold: float = 1.0,
     stop_target_gradients: bool = True,
+    method: str = 'scan',
+    time_major: bool = False,
 ) -> VTraceOutput:
   """Calculates Leaky V-Trace errors and PG advantage from importance weights.
 
@@ -252,12 +417,15 @@ def leaky_vtrace_td_error_and_advantage(
     clip_rho_threshold: clip threshold for importance ratios.
     clip_pg_rho_threshold: clip threshold for policy gradient importance ratios.
     stop_target_gradients: whether or not to apply stop gradient to targets.
+    method: either 'scan' (sequential) or 'associative' (parallel prefix scan).
+    time_major: if True, all sequences have shape `[T, B]`.
 
   Returns:
     a tuple of V-Trace error, policy gradient advantage, and estimated Q-values.
   """
+  seq_rank = 2 if time_major else 1
   chex.assert_rank([v_tm1, v_t, r_t, discount_t, rho_tm1, lambda_],
-                   [1, 1, 1, 1, 1, {0, 1}])
+                   [seq_rank] * 5 + [{0, seq_rank}])
   chex.assert_type([v_tm1, v_t, r_t, discount_t, rho_tm1, lambda_],
                    [float, float, float, float, float, float])
   chex.assert_equal_shape([v_tm1, v_t, r_t, discount_t, rho_tm1])
@@ -266,8 +434,8 @@ def leaky_vtrace_td_error_and_advantage(
   lambda_ = jnp.ones_like(discount_t) * lambda_
 
   errors = leaky_vtrace(
-      v_tm1, v_t, r_t, discount_t, rho_tm1, alpha,
-      lambda_, clip_rho_threshold, stop_target_gradients)
+      v_tm1, v_t, r_t, discount_t, rho_tm1, alpha, lambda_,
+      clip_rho_threshold, stop_target_gradients, method, time_major)
   targets_tm1 = errors + v_tm1
   q_bootstrap = jnp.concatenate([
       lambda_[:-1] * targets_tm1[1:] + (1 - lambda_[:-1]) * v_tm1[1:],
@@ -279,3 +447,159 @@ def leaky_vtrace_td_error_and_advantage(
   pg_advantages = clipped_pg_rho_tm1 * (q_estimate - v_tm1)
   return VTraceOutput(
       errors=errors, pg_advantage=pg_advantages, q_estimate=q_estimate)
+
+
+def popart_vtrace_td_error_and_advantage(
+    normalized_v_tm1: Array,
+    normalized_v_t: Array,
+    r_t: Array,
+    discount_t: Array,
+    rho_tm1: Array,
+    task_ids: Array,
+    popart_state: pop_art.PopArtState,
+    lambda_: Numeric = 1.0,
+    clip_rho_threshold: float = 1.0,
+    clip_pg_rho_threshold: float = 1.0,
+    stop_target_gradients: bool = True,
+    method: str = 'scan',
+    time_major: bool = False,
+) -> PopArtVTraceOutput:
+  """Calculates multi-task V-Trace errors and advantages with PopArt.
+
+  In multi-task IMPALA with PopArt the value head outputs normalized values for
+  each task. These are unnormalized with the statistics of the task they belong
+  to, V-Trace targets are computed in the unnormalized space, and errors and
+  advantages are then normalized again with the same statistics. Here the
+  shift and scale of every element are gathered once for all tasks, so a whole
+  multi-task batch is handled by one call and one V-Trace scan.
+
+  The returned unnormalized `targets` are those to pass to `pop_art.art`, with
+  the same `task_ids`, to update the statistics.
+
+  See "Multi-task Deep Reinforcement Learning with PopArt" by Hessel et al.
+  (https://arxiv.org/abs/1809.04474).
+
+  Args:
+    normalized_v_tm1: normalized values at time t-1 of the task of each element.
+    normalized_v_t: normalized values at time t of the task of each element.
+    r_t: reward at time t.
+    discount_t: discount at time t.
+    rho_tm1: importance weights at time t-1.
+    task_ids: integer task index of each element, with the shape of `r_t`.
+    popart_state: the PopArt statistics of all tasks.
+    lambda_: mixing parameter; a scalar or a vector for timesteps t.
+    clip_rho_threshold: clip threshold for importance ratios.
+    clip_pg_rho_threshold: clip threshold for policy gradient importance ratios.
+    stop_target_gradients: whether or not to apply stop gradient to targets.
+    method: either 'scan' (sequential) or 'associative' (parallel prefix scan).
+    time_major: if True, all sequences have shape `[T, B]`.
+
+  Returns:
+    a tuple of normalized V-Trace errors and policy gradient advantages, and
+    unnormalized and normalized V-Trace targets.
+  """
+  chex.assert_equal_shape([normalized_v_tm1, task_ids])
+  chex.assert_type(task_ids, int)
+
+  # Gather the shift and scale of all elements at once.
+  shift_and_scale = jnp.stack([popart_state.shift, popart_state.scale], axis=-1)
+  shift, scale = jnp.moveaxis(
+      jax.lax.stop_gradient(shift_and_scale[task_ids]), -1, 0)
+
+  v_tm1 = scale * normalized_v_tm1 + shift
+  v_t = scale * normalized_v_t + shift
+  vtrace_output = vtrace_td_error_and_advantage(
+      v_tm1, v_t, r_t, discount_t, rho_tm1, lambda_, clip_rho_threshold,
+      clip_pg_rho_threshold, stop_target_gradients, method, time_major)
+
+  targets = vtrace_output.errors + v_tm1
+  normalized_targets = (targets - shift) / scale
+  return PopArtVTraceOutput(
+      errors=normalized_targets - normalized_v_tm1,
+      pg_advantage=vtrace_output.pg_advantage / scale,
+      targets=targets,
+      normalized_targets=normalized_targets)
+
+
+def impala_loss(
+    logits_tm1: Array,
+    a_tm1: Array,
+    mu_logprob_tm1: Array,
+    v_tm1: Array,
+    v_t: Array,
+    r_t: Array,
+    discount_t: Array,
+    lambda_: Numeric = 1.0,
+    baseline_cost: float = 0.5,
+    entropy_cost: float = 0.01,
+    clip_rho_threshold: float = 1.0,
+    clip_pg_rho_threshold: float = 1.0,
+    method: str = 'scan',
+    time_major: bool = False,
+) -> Tuple[Array, ImpalaLossOutput]:
+  """Calculates the IMPALA loss from policy logits and values.
+
+  Combines the V-Trace policy gradient loss, the baseline (value) loss and the
+  entropy regularization loss of the IMPALA agent. A single `log_softmax` of
+  the logits provides the log-probabilities of the taken actions, from which
+  the importance weights are derived, and the policy entropy. This replaces
+  separate calls to `vtrace_td_error_and_advantage`, `policy_gradient_loss` and
+  `entropy_loss`, each normalising the logits again.
+
+  The diagnostics are always returned; when they are not used, they are
+  removed by the compiler under `jax.jit` at no cost.
+
+  See "IMPALA: Scalable Distributed Deep-RL with Importance Weighted Actor
+  Learner Architectures" by Espeholt et al. (https://arxiv.org/abs/1802.01561)
+
+  Args:
+    logits_tm1: unnormalized action preferences of the learner policy at time
+      t-1, with an additional trailing action dimension.
+    a_tm1: actions taken at time t-1.
+    mu_logprob_tm1: log-probabilities of the actions `a_tm1` under the
+      behaviour policy.
+    v_tm1: values at time t-1.
+    v_t: values at time t.
+    r_t: reward at time t.
+    discount_t: discount at time t.
+    lambda_: mixing parameter; a scalar or a vector for timesteps t.
+    baseline_cost: weight of the baseline loss.
+    entropy_cost: weight of the entropy loss.
+    clip_rho_threshold: clip threshold for importance ratios.
+    clip_pg_rho_threshold: clip threshold for policy gradient importance ratios.
+    method: either 'scan' (sequential) or 'associative' (parallel prefix scan).
+    time_major: if True, all sequences have shape `[T, B]` (`[T, B, A]` for
+      `logits_tm1`), and all losses are averaged over time and batch.
+
+  Returns:
+    A tuple of the total scalar loss and an `ImpalaLossOutput` holding the
+    separate losses, the per step entropy, the importance weights and the
+    V-Trace outputs.
+  """
+  seq_rank = 2 if time_major else 1
+  chex.assert_rank([logits_tm1, a_tm1, mu_logprob_tm1],
+                   [seq_rank + 1, seq_rank, seq_rank])
+  chex.assert_type([logits_tm1, a_tm1, mu_logprob_tm1], [float, int, float])
+  chex.assert_equal_shape([logits_tm1[..., 0], a_tm1, mu_logprob_tm1, v_tm1])
+
+  # The only normalisation of the logits, shared by all the terms below.
+  logpi_tm1 = jax.nn.log_softmax(logits_tm1)
+  logpi_a_tm1 = base.batched_index(logpi_tm1, a_tm1)
+  rho_tm1 = jnp.exp(jax.lax.stop_gradient(logpi_a_tm1) - mu_logprob_tm1)
+
+  vtrace_output = vtrace_td_error_and_advantage(
+      v_tm1, v_t, r_t, discount_t, rho_tm1, lambda_,
+      clip_rho_threshold=clip_rho_threshold,
+      clip_pg_rho_threshold=clip_pg_rho_threshold,
+      stop_target_gradients=True, method=method, time_major=time_major)
+
+  pg_advantage = jax.lax.stop_gradient(vtrace_output.pg_advantage)
+  pg_loss = -jnp.mean(logpi_a_tm1 * pg_advantage)
+  baseline_loss = jnp.mean(0.5 * jnp.square(vtrace_output.errors))
+  entropy = -jnp.sum(jnp.exp(logpi_tm1) * logpi_tm1, axis=-1)
+  entropy_loss = -jnp.mean(entropy)
+
+  loss = pg_loss + baseline_cost * baseline_loss + entropy_cost * entropy_loss
+  return loss, ImpalaLossOutput(
+      pg_loss=pg_loss, baseline_loss=baseline_loss, entropy_loss=entropy_loss,
+      entropy=entropy, rho_tm1=rho_tm1, vtrace=vtrace_output)
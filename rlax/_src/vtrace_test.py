@@ -19,8 +19,11 @@ from absl.testing import absltest
 from absl.testing import parameterized
 import chex
 import jax
+import jax.numpy as jnp
 import numpy as np
 from rlax._src import distributions
+from rlax._src import policy_gradients
+from rlax._src import pop_art
 from rlax._src import vtrace
 
 
@@ -157,6 +160,290 @@ class VTraceTest(parameterized.TestCase):
     # Test output.
     np.testing.assert_allclose(vtrace_output, leaky_vtrace_output, rtol=1e-3)
 
+  @chex.all_variants()
+  @parameterized.named_parameters(
+      ('vtrace', vtrace.vtrace),
+      ('leaky_vtrace', functools.partial(vtrace.leaky_vtrace, alpha_=0.5)),
+      ('vtrace_td_error_and_advantage', vtrace.vtrace_td_error_and_advantage),
+      ('leaky_vtrace_td_error_and_advantage', functools.partial(
+          vtrace.leaky_vtrace_td_error_and_advantage, alpha=0.5)))
+  def test_time_major(self, vtrace_fn):
+    """Tests time major inputs match vmapping over the batch dimension."""
+    r_t, discount_t, rho_tm1, v_tm1, bootstrap_value = self._inputs
+    v_t = np.concatenate([v_tm1[:, 1:], bootstrap_value[:, None]], axis=1)
+    # Inputs are batch major, compute the expected output by vmapping.
+    expected = jax.vmap(functools.partial(vtrace_fn, lambda_=0.9))(
+        v_tm1, v_t, r_t, discount_t, rho_tm1)
+    time_major_fn = self.variant(functools.partial(
+        vtrace_fn, lambda_=0.9, time_major=True))
+    actual = time_major_fn(v_tm1.T, v_t.T, r_t.T, discount_t.T, rho_tm1.T)
+    jax.tree_util.tree_map(
+        lambda x, y: np.testing.assert_allclose(x, y.T, rtol=1e-5),
+        expected, actual)
+
+  @chex.all_variants()
+  @parameterized.named_parameters(
+      ('stop_target_gradients', True), ('no_stop_target_gradients', False))
+  def test_chunked_vtrace(self, stop_target_gradients):
+    """Tests processing chunks back to front matches the one-shot call."""
+    rng = np.random.RandomState(0)
+    v_tm1, r_t, rho_tm1, lambda_ = rng.uniform(size=(4, 11)).astype(np.float32)
+    v_t = rng.uniform(size=11).astype(np.float32)
+    discount_t = rng.choice([0., 0.9], size=11).astype(np.float32)
+    expected = self.variant(functools.partial(
+        vtrace.vtrace, stop_target_gradients=stop_target_gradients))(
+            v_tm1, v_t, r_t, discount_t, rho_tm1, lambda_)
+    chunked_vtrace = self.variant(functools.partial(
+        vtrace.chunked_vtrace, stop_target_gradients=stop_target_gradients))
+    carry, chunks = None, []
+    for start in (8, 4, 0):
+      end = start + 4
+      errors, carry = chunked_vtrace(
+          v_tm1[start:end], v_t[start:end], r_t[start:end],
+          discount_t[start:end], rho_tm1[start:end], lambda_[start:end], carry)
+      chunks.insert(0, errors)
+    np.testing.assert_array_equal(expected, np.concatenate(chunks))
+
+  @chex.all_variants()
+  def test_time_sharded_vtrace(self):
+    """Tests sharding time along a mapped axis matches the one-shot call."""
+    rng = np.random.RandomState(0)
+    v_tm1, v_t, r_t, rho_tm1 = rng.uniform(
+        size=(4, 12)).astype(np.float32) * 2.
+    discount_t = rng.choice([0., 0.9], size=12).astype(np.float32)
+    expected = vtrace.vtrace(v_tm1, v_t, r_t, discount_t, rho_tm1, 0.9)
+    # Map over time shards with `vmap`, which supports the same collectives.
+    sharded_fn = self.variant(jax.vmap(functools.partial(
+        vtrace.time_sharded_vtrace, lambda_=0.9, axis_name='time'),
+                                       axis_name='time'))
+    shard = lambda x: x.reshape((3, 4))
+    actual = sharded_fn(shard(v_tm1), shard(v_t), shard(r_t),
+                        shard(discount_t), shard(rho_tm1))
+    np.testing.assert_allclose(expected, actual.reshape(-1), rtol=1e-5)
+
+  @chex.all_variants()
+  @parameterized.named_parameters(
+      ('vtrace', vtrace.vtrace, True),
+      ('vtrace_no_stop_target_gradients', vtrace.vtrace, False),
+      ('leaky_vtrace',
+       functools.partial(vtrace.leaky_vtrace, alpha_=0.5), True),
+      ('leaky_vtrace_no_stop_target_gradients',
+       functools.partial(vtrace.leaky_vtrace, alpha_=0.5), False))
+  def test_associative_matches_scan(self, vtrace_fn, stop_target_gradients):
+    """Tests the associative scan matches the sequential one, with gradients."""
+    rng = np.random.RandomState(0)
+    v_tm1, v_t, r_t, rho_tm1 = rng.uniform(
+        size=(4, 200)).astype(np.float32) * 2.
+    discount_t = rng.choice([0., 0.99], size=200).astype(np.float32)
+
+    def loss(v_tm1, v_t, method):
+      errors = vtrace_fn(
+          v_tm1, v_t, r_t, discount_t, rho_tm1, lambda_=0.95,
+          stop_target_gradients=stop_target_gradients, method=method)
+      return 0.5 * jnp.sum(errors**2)
+
+    value_and_grad = self.variant(
+        jax.value_and_grad(loss, argnums=(0, 1)), static_argnums=2)
+    expected = value_and_grad(v_tm1, v_t, 'scan')
+    actual = value_and_grad(v_tm1, v_t, 'associative')
+    jax.tree_util.tree_map(
+        lambda x, y: np.testing.assert_allclose(x, y, rtol=1e-4, atol=1e-5),
+        expected, actual)
+
+  @chex.all_variants()
+  def test_segment_ids(self):
+    """Tests packed episodes match separate calls on each episode."""
+    rng = np.random.RandomState(0)
+    v_tm1, v_t, r_t, rho_tm1 = rng.uniform(
+        size=(4, 12)).astype(np.float32) * 2.
+    discount_t = rng.choice([0., 0.9], size=12).astype(np.float32)
+    segment_ids = np.array([0, 0, 0, 1, 1, 1, 1, 1, 2, 3, 3, 3])
+    packed_fn = self.variant(functools.partial(vtrace.vtrace, lambda_=0.9))
+    actual = packed_fn(v_tm1, v_t, r_t, discount_t, rho_tm1,
+                       segment_ids=segment_ids)
+    for i in range(4):
+      mask = segment_ids == i
+      expected = vtrace.vtrace(v_tm1[mask], v_t[mask], r_t[mask],
+                               discount_t[mask], rho_tm1[mask], 0.9)
+      np.testing.assert_allclose(expected, actual[mask], rtol=1e-5)
+
+  @chex.all_variants()
+  def test_segment_ids_td_error_and_advantage(self):
+    """Tests pg advantages of packed episodes do not leak across episodes."""
+    rng = np.random.RandomState(0)
+    v_tm1, v_t, r_t, rho_tm1 = rng.uniform(
+        size=(4, 12)).astype(np.float32) * 2.
+    discount_t = rng.choice([0., 0.9], size=12).astype(np.float32)
+    segment_ids = np.array([0, 0, 0, 1, 1, 1, 1, 1, 2, 3, 3, 3])
+    packed_fn = self.variant(functools.partial(
+        vtrace.vtrace_td_error_and_advantage, lambda_=0.9))
+    actual = packed_fn(v_tm1, v_t, r_t, discount_t, rho_tm1,
+                       segment_ids=segment_ids)
+    for i in range(4):
+      mask = segment_ids == i
+      expected = vtrace.vtrace_td_error_and_advantage(
+          v_tm1[mask], v_t[mask], r_t[mask], discount_t[mask], rho_tm1[mask],
+          0.9)
+      for x, y in zip(expected, actual):
+        np.testing.assert_allclose(x, y[mask], rtol=1e-5)
+
+
+class PopArtVTraceTest(parameterized.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    rng = np.random.RandomState(0)
+    self._normalized_v_tm1, self._normalized_v_t, self._r_t = rng.normal(
+        size=(3, 6, 10)).astype(np.float32)
+    self._rho_tm1 = rng.uniform(0.2, 2., size=(6, 10)).astype(np.float32)
+    self._discount_t = rng.choice([0., 0.9], size=(6, 10)).astype(np.float32)
+    # Each sequence of the batch belongs to one of three tasks.
+    self._task_ids = np.repeat(
+        np.array([2, 0, 1, 0, 2, 2]), 10).reshape(6, 10).astype(np.int32)
+    shift = np.array([-1., 0.5, 3.], dtype=np.float32)
+    scale = np.array([2., 0.5, 10.], dtype=np.float32)
+    self._state = pop_art.PopArtState(
+        shift, scale, np.square(scale) + np.square(shift))
+
+  def _per_task_reference(self):
+    """Normalizes, runs and normalizes V-Trace separately for each task."""
+    errors, pg_advantages, targets = [np.zeros((6, 10)) for _ in range(3)]
+    for task in range(3):
+      mask = self._task_ids[:, 0] == task
+      indices = self._task_ids[mask]
+      v_tm1, v_t = [
+          pop_art.unnormalize(self._state, v[mask], indices)
+          for v in (self._normalized_v_tm1, self._normalized_v_t)]
+      output = jax.vmap(functools.partial(
+          vtrace.vtrace_td_error_and_advantage, lambda_=0.9))(
+              v_tm1, v_t, self._r_t[mask], self._discount_t[mask],
+              self._rho_tm1[mask])
+      targets[mask] = output.errors + v_tm1
+      errors[mask] = pop_art.normalize(
+          self._state, targets[mask], indices) - self._normalized_v_tm1[mask]
+      pg_advantages[mask] = output.pg_advantage / self._state.scale[indices]
+    return errors, pg_advantages, targets
+
+  @chex.all_variants()
+  @parameterized.named_parameters(
+      ('batch_major', False), ('time_major', True))
+  def test_matches_per_task_calls(self, time_major):
+    """Tests one batched call matches separate calls for each task."""
+    inputs = (self._normalized_v_tm1, self._normalized_v_t, self._r_t,
+              self._discount_t, self._rho_tm1, self._task_ids)
+    if time_major:
+      popart_vtrace = functools.partial(
+          vtrace.popart_vtrace_td_error_and_advantage, time_major=True)
+      inputs = [x.T for x in inputs]
+    else:
+      popart_vtrace = jax.vmap(
+          vtrace.popart_vtrace_td_error_and_advantage,
+          in_axes=(0, 0, 0, 0, 0, 0, None, None))
+    output = self.variant(popart_vtrace)(*inputs, self._state, 0.9)
+    if time_major:
+      output = jax.tree_util.tree_map(lambda x: x.T, output)
+    errors, pg_advantages, targets = self._per_task_reference()
+    np.testing.assert_allclose(errors, output.errors, rtol=1e-5, atol=1e-5)
+    np.testing.assert_allclose(
+        pg_advantages, output.pg_advantage, rtol=1e-5, atol=1e-5)
+    np.testing.assert_allclose(targets, output.targets, rtol=1e-5, atol=1e-5)
+    np.testing.assert_allclose(
+        pop_art.normalize(self._state, targets, self._task_ids),
+        output.normalized_targets, rtol=1e-5, atol=1e-5)
+
+  @chex.all_variants()
+  def test_gradients_flow_to_normalized_values_only(self):
+    """Tests the normalized baseline gradient ignores targets and statistics."""
+    def loss(normalized_v_tm1, state):
+      output = vtrace.popart_vtrace_td_error_and_advantage(
+          normalized_v_tm1, self._normalized_v_t[0], self._r_t[0],
+          self._discount_t[0], self._rho_tm1[0], self._task_ids[0], state)
+      return 0.5 * jnp.sum(jnp.square(output.errors)), output.errors
+    (_, errors), (grad_v_tm1, grad_state) = self.variant(
+        jax.value_and_grad(loss, argnums=(0, 1), has_aux=True))(
+            self._normalized_v_tm1[0], self._state)
+    np.testing.assert_allclose(-errors, grad_v_tm1, rtol=1e-5, atol=1e-6)
+    for grad in grad_state:
+      np.testing.assert_array_equal(np.zeros_like(grad), grad)
+
+
+class ImpalaLossTest(parameterized.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    rng = np.random.RandomState(0)
+    self._logits_tm1 = rng.normal(size=(3, 9, 4)).astype(np.float32)
+    self._a_tm1 = rng.randint(4, size=(3, 9)).astype(np.int32)
+    self._mu_logprob_tm1 = np.log(
+        rng.uniform(0.1, 1., size=(3, 9))).astype(np.float32)
+    self._v_tm1, self._v_t, self._r_t = rng.normal(
+        size=(3, 3, 9)).astype(np.float32)
+    self._discount_t = rng.choice([0., 0.9], size=(3, 9)).astype(np.float32)
+
+  def _separate_ops_loss(self, logits_tm1, v_tm1, v_t):
+    """Computes the IMPALA loss with the separate ops, per sequence."""
+    def loss_fn(logits_tm1, a_tm1, mu_logprob_tm1, v_tm1, v_t, r_t, discount_t):
+      logpi_a_tm1 = distributions.softmax().logprob(a_tm1, logits_tm1)
+      rho_tm1 = jnp.exp(jax.lax.stop_gradient(logpi_a_tm1) - mu_logprob_tm1)
+      output = vtrace.vtrace_td_error_and_advantage(
+          v_tm1, v_t, r_t, discount_t, rho_tm1, lambda_=0.9)
+      ones = jnp.ones_like(v_tm1)
+      pg_loss = policy_gradients.policy_gradient_loss(
+          logits_tm1, a_tm1, output.pg_advantage, ones)
+      entropy_loss = policy_gradients.entropy_loss(logits_tm1, ones)
+      baseline_loss = jnp.mean(0.5 * jnp.square(output.errors))
+      return pg_loss + 0.5 * baseline_loss + 0.01 * entropy_loss
+    return jnp.mean(jax.vmap(loss_fn)(
+        logits_tm1, self._a_tm1, self._mu_logprob_tm1, v_tm1, v_t, self._r_t,
+        self._discount_t))
+
+  @chex.all_variants()
+  @parameterized.named_parameters(
+      ('batch_major', False), ('time_major', True))
+  def test_matches_separate_ops(self, time_major):
+    """Tests the loss and its gradients match the separate ops."""
+    def fused_loss(logits_tm1, v_tm1, v_t):
+      if time_major:
+        logits_tm1, a_tm1, mu_logprob_tm1, v_tm1, v_t, r_t, discount_t = [
+            x.swapaxes(0, 1) for x in (
+                logits_tm1, self._a_tm1, self._mu_logprob_tm1, v_tm1, v_t,
+                self._r_t, self._discount_t)]
+        return vtrace.impala_loss(
+            logits_tm1, a_tm1, mu_logprob_tm1, v_tm1, v_t, r_t, discount_t,
+            lambda_=0.9, time_major=True)[0]
+      return jnp.mean(jax.vmap(
+          lambda *x: vtrace.impala_loss(*x, lambda_=0.9)[0])(
+              logits_tm1, self._a_tm1, self._mu_logprob_tm1, v_tm1, v_t,
+              self._r_t, self._discount_t))
+
+    args = (self._logits_tm1, self._v_tm1, self._v_t)
+    expected = jax.value_and_grad(self._separate_ops_loss, argnums=(0, 1, 2))(
+        *args)
+    actual = self.variant(jax.value_and_grad(fused_loss, argnums=(0, 1, 2)))(
+        *args)
+    jax.tree_util.tree_map(
+        lambda x, y: np.testing.assert_allclose(x, y, rtol=1e-5, atol=1e-6),
+        expected, actual)
+
+  @chex.all_variants()
+  def test_diagnostics(self):
+    """Tests the diagnostics are consistent with the separate ops."""
+    impala_loss = self.variant(functools.partial(
+        vtrace.impala_loss, lambda_=0.9, entropy_cost=0.))
+    loss, output = impala_loss(
+        self._logits_tm1[0], self._a_tm1[0], self._mu_logprob_tm1[0],
+        self._v_tm1[0], self._v_t[0], self._r_t[0], self._discount_t[0])
+    np.testing.assert_allclose(
+        loss, output.pg_loss + 0.5 * output.baseline_loss, rtol=1e-6)
+    np.testing.assert_allclose(
+        output.entropy,
+        distributions.softmax().entropy(self._logits_tm1[0]), rtol=1e-5)
+    expected_errors = vtrace.vtrace(
+        self._v_tm1[0], self._v_t[0], self._r_t[0], self._discount_t[0],
+        output.rho_tm1, lambda_=0.9)
+    np.testing.assert_allclose(
+        expected_errors, output.vtrace.errors, rtol=1e-5, atol=1e-6)
+
 
 if __name__ == '__main__':
   jax.config.update('jax_numpy_rank_promotion', 'raise')